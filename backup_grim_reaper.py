@@ -3,11 +3,15 @@
 
 import json
 import logging
+import os
 from datetime import datetime, timedelta
 from daemon import runner
+from pymongo import ASCENDING, IndexModel, errors
+from socket import gethostname
 from time import sleep
 from kairoslib.catalog import Catalog
-from kairoslib.ontap import ClusterSession, Snapshot
+from kairoslib.concurrency import RateLimiter, run_parallel
+from kairoslib.ontap import ClusterSessionRegistry, SnapshotBulkDelete
 
 LOGGER = logging.getLogger(__name__)
 
@@ -18,79 +22,143 @@ def load_config_file(config_file=None):
 
 
 class Backup_Grim_Reaper:
-    def __init__(self, catalog_sess=None, check_interval=None):
+    # -- Several reapers may run against the same catalog: an expired backup is claimed atomically with a lease
+    #    before being deleted, and a lease left behind by a reaper that died expires after lease_time seconds.
+    def __init__(self, catalog_sess=None, check_interval=None, max_workers=8, deletes_per_second=5, lease_time=900):
         self.check_interval = check_interval
         self.catalog = catalog_sess
-
-    def check_expired_backups(self):
-        check_timenow = datetime.now() - timedelta(seconds=self.check_interval)
-        results = self.catalog.find_all(coll_name='backups', query={'retention': {'$lte': check_timenow}})
+        self.max_workers = max_workers
+        self.lease_time = lease_time
+        self.reaper_id = '{}:{}'.format(gethostname(), os.getpid())
+        self.rate_limiter = RateLimiter(rate=deletes_per_second)
+        self.svm_sessions = ClusterSessionRegistry(loader=lambda: self.catalog.find_all(coll_name='ntapsystems',
+                                                                                      query={}))
+        try:
+            self.catalog.create_indexes(coll_name='backups',
+                                        indexes=[IndexModel([('retention', ASCENDING)], name='idx_backups_retention')])
+        except errors.OperationFailure, e:
+            LOGGER.error(e)
+
+    def _claimable(self, now):
+        return {'retention': {'$lte': now},
+                '$or': [{'reaper_lease': {'$exists': False}}, {'reaper_lease.expires': {'$lt': now}}]}
+
+    def claim_expired_backups(self):
+        claimed = list()
+        while len(claimed) < self.max_workers:
+            now = datetime.now()
+            backup = self.catalog.claim(coll_name='backups', query=self._claimable(now),
+                                        update={'$set': {'reaper_lease': {
+                                            'owner': self.reaper_id,
+                                            'expires': now + timedelta(seconds=self.lease_time)}}},
+                                        ordered=[('retention', ASCENDING)])
+            if backup is None:
+                break
+            claimed.append(backup)
+        return claimed
+
+    def next_wakeup(self):
+        # -- Seconds until the next backup expires or a lease runs out, capped by check_interval so backups
+        #    created in the meantime with a shorter retention are not missed
+        now = datetime.now()
+        wakeups = [now + timedelta(seconds=self.check_interval)]
+        next_expiry = self.catalog.find_one(coll_name='backups', query={'retention': {'$gt': now}},
+                                            ordered=[('retention', ASCENDING)])
+        if next_expiry is not None:
+            wakeups.append(next_expiry['retention'])
+        next_lease = self.catalog.find_one(coll_name='backups', query={'reaper_lease.expires': {'$gt': now}},
+                                           ordered=[('reaper_lease.expires', ASCENDING)])
+        if next_lease is not None:
+            wakeups.append(next_lease['reaper_lease']['expires'])
+        return max((min(wakeups) - now).total_seconds(), 1)
+
+    @staticmethod
+    def _volumes_per_svm(backup):
+        delete_list = dict()
+        members = list()
+        if backup['mongo_topology']['cluster_type'] == 'replSet':
+            members.extend(backup['mongo_topology']['members'])
+        elif backup['mongo_topology']['cluster_type'] == 'sharded':
+            members.extend(backup['mongo_topology']['config_servers'])
+            for shard_replset in backup['mongo_topology']['shards']:
+                members.extend(shard_replset['shard_members'])
+
+        for member in members:
+            if member['stateStr'] == 'PRIMARY' or member['stateStr'] == 'SECONDARY':
+                for vol in member['storage_info']['volume_topology']:
+                    if vol['svm-name'] not in delete_list.keys():
+                        delete_list[vol['svm-name']] = list()
+                    delete_list[vol['svm-name']].append(vol['volume'])
+        return delete_list
+
+    def _delete_snapshots(self, backup=None, svm=None, volumes=None):
+        svm_session = self.svm_sessions.get(svm)
+        if svm_session is None:
+            LOGGER.error('Cannot find SVM {} in the netapp repository collection.'.format(svm))
+            return dict([(volume, ('failed', 'unknown SVM')) for volume in volumes])
+        bulk_delete = SnapshotBulkDelete(svm=svm_session, snapname=backup['backup_name'], volumes=volumes)
+
+        # -- Volumes whose snapshot is already gone (deleted by an earlier sweep that did not finish) are done
+        status, existing = bulk_delete.get_busy()
+        if status == 'failed':
+            return dict([(volume, ('failed', existing)) for volume in volumes])
+        results = dict([(volume, ('passed', None)) for volume in volumes if volume not in existing])
+        remaining = [volume for volume in volumes if volume in existing]
+        if len(remaining) > 0:
+            results.update(bulk_delete.delete(volumes=remaining, rate_limiter=self.rate_limiter))
         return results
 
     def delete_expired_backups(self, expired_backups=None):
-        if expired_backups.count() > 0:
-            for backup in expired_backups:
-                delete_list = dict()
-                if backup['mongo_topology']['cluster_type'] == 'replSet':
-                    for rs_member in backup['mongo_topology']['members']:
-                        if rs_member['stateStr'] == 'PRIMARY' or rs_member['stateStr'] == 'SECONDARY':
-                            for vol in rs_member['storage_info']['volume_topology']:
-                                if vol['svm-name'] not in delete_list.keys():
-                                    delete_list[vol['svm-name']] = list()
-                                    delete_list[vol['svm-name']].append(vol['volume'])
-                                else:
-                                    delete_list[vol['svm-name']].append(vol['volume'])
-                elif backup['mongo_topology']['cluster_type'] == 'sharded':
-                    for cs_member in backup['mongo_topology']['config_servers']:
-                        if cs_member['stateStr'] == 'PRIMARY' or cs_member['stateStr'] == 'SECONDARY':
-                            for vol in cs_member['storage_info']['volume_topology']:
-                                if vol['svm-name'] not in delete_list.keys():
-                                    delete_list[vol['svm-name']] = list()
-                                    delete_list[vol['svm-name']].append(vol['volume'])
-                                else:
-                                    delete_list[vol['svm-name']].append(vol['volume'])
-
-                    for shard_replset in backup['mongo_topology']['shards']:
-                        for shard_member in shard_replset['shard_members']:
-                            if shard_member['stateStr'] == 'PRIMARY' or shard_member['stateStr'] == 'SECONDARY':
-                                for vol in shard_member['storage_info']['volume_topology']:
-                                    if vol['svm-name'] not in delete_list.keys():
-                                        delete_list[vol['svm-name']] = list()
-                                        delete_list[vol['svm-name']].append(vol['volume'])
-                                    else:
-                                        delete_list[vol['svm-name']].append(vol['volume'])
-
-                for svm in delete_list.keys():
-                    svm_info = self.catalog.find_one(coll_name='ntapsystems', query={'svm-name': svm})
-                    cs_svm = ClusterSession(cluster_ip=svm_info['netapp-ip'], user=svm_info['username'],
-                                            password=svm_info['password'], vserver=svm_info['svm-name']
-                                            )
-                    for volume in delete_list[svm]:
-                        snap_spec = dict()
-                        snap_spec['volume'] = volume
-                        snap_spec['snapname'] = backup['backup_name']
-
-                        snapshot = Snapshot(snap_spec)
-                        delete_result = snapshot.delete(svm=cs_svm)
-                        if delete_result[0] == 'passed':
-                            LOGGER.info('Snapshot {} on volume {} has been deleted for cluster {}.'.format(snap_spec['snapname'],
-                                                                                                            snap_spec['volume'],
-                                                                                                            backup['cluster_name']
-                                                                                                            ))
-                        else:
-                            LOGGER.error('Failed to delete snapshot {} on volume for cluster {}.'.format(snap_spec['snapname'],
-                                                                                                            snap_spec['volume'],
-                                                                                                            backup['cluster_name']
-                                                                                                            ))
-                remove_from_catalog = self.catalog.remove_one(coll_name='backups', query={'backup_name': backup['backup_name']})
-                if remove_from_catalog > 0:
-                    LOGGER.info('Backup {} for cluster {} has been deleted successfuly.'.format(backup['backup_name'],
-                                                                                                 backup['cluster_name']
-                                                                                                 ))
-                else:
-                    LOGGER.error('Failed to remove backup {} for cluster {} from kairos catalog.'.format(backup['backup_name'],
-                                                                                                          backup['cluster_name']
-                                                                                                          ))
+        # -- Snapshots of every claimed backup on every SVM are deleted at the same time; the rate limiter is shared
+        #    by all of them so the storage systems never get more than deletes_per_second requests
+        tasks = list()
+        for backup in expired_backups:
+            for svm, volumes in self._volumes_per_svm(backup).items():
+                tasks.append(((backup['_id'], svm), self._delete_snapshots,
+                              {'backup': backup, 'svm': svm, 'volumes': volumes}))
+
+        results = dict()
+        for task in run_parallel(tasks=tasks, max_workers=self.max_workers):
+            results[task.key] = task
+
+        for backup in expired_backups:
+            all_deleted = True
+            for svm, volumes in self._volumes_per_svm(backup).items():
+                task = results[(backup['_id'], svm)]
+                for volume in volumes:
+                    if task.ok() and task.result.get(volume, ('failed',))[0] == 'passed':
+                        LOGGER.info('Snapshot {} on volume {} has been deleted for cluster {}.'.format(backup['backup_name'],
+                                                                                                        volume,
+                                                                                                        backup['cluster_name']
+                                                                                                        ))
+                    else:
+                        all_deleted = False
+                        LOGGER.error('Failed to delete snapshot {} on volume {} for cluster {}.'.format(backup['backup_name'],
+                                                                                                         volume,
+                                                                                                         backup['cluster_name']
+                                                                                                         ))
+            if not all_deleted:
+                # -- The backup stays in the catalog so its remaining snapshots are not orphaned. The lease is
+                #    shortened rather than removed, otherwise the next claim would pick the backup up again right away.
+                retry_at = datetime.now() + timedelta(seconds=self.check_interval)
+                self.catalog.edit(coll_name='backups',
+                                  query={'_id': backup['_id'], 'reaper_lease.owner': self.reaper_id},
+                                  update={'$set': {'reaper_lease.expires': retry_at}})
+                LOGGER.error('Backup {} for cluster {} will be retried in {} seconds.'.format(backup['backup_name'],
+                                                                                               backup['cluster_name'],
+                                                                                               self.check_interval))
+                continue
+
+            remove_from_catalog = self.catalog.remove_one(coll_name='backups', query={'_id': backup['_id'],
+                                                                                      'reaper_lease.owner': self.reaper_id})
+            if remove_from_catalog > 0:
+                LOGGER.info('Backup {} for cluster {} has been deleted successfuly.'.format(backup['backup_name'],
+                                                                                             backup['cluster_name']
+                                                                                             ))
+            else:
+                LOGGER.error('Failed to remove backup {} for cluster {} from kairos catalog.'.format(backup['backup_name'],
+                                                                                                      backup['cluster_name']
+                                                                                                      ))
 
 
 class AppBackupGrimReaper():
@@ -108,11 +176,14 @@ class AppBackupGrimReaper():
         catalog = Catalog(repo_uri=self.kcfg['kairos-repo']['repo-uri'], repo_name=self.kcfg['kairos-repo']['db-name'])
         catalog.connect()
 
-        bgr = Backup_Grim_Reaper(catalog_sess=catalog, check_interval=60)
+        bgr = Backup_Grim_Reaper(catalog_sess=catalog, check_interval=300)
 
         while True:
-            bgr.delete_expired_backups(expired_backups=bgr.check_expired_backups())
-            sleep(bgr.check_interval)
+            expired_backups = bgr.claim_expired_backups()
+            if len(expired_backups) > 0:
+                bgr.delete_expired_backups(expired_backups=expired_backups)
+            else:
+                sleep(bgr.next_wakeup())
 
 
 def main():
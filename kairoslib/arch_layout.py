@@ -0,0 +1,110 @@
+#!/usr/bin/env python2
+
+import logging
+import re
+import pymongo.errors
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, IndexModel
+
+LOGGER = logging.getLogger(__name__)
+
+BUCKET_FORMATS = {'day': '%Y%m%d', 'hour': '%Y%m%d%H'}
+BUCKET_SPANS = {'day': timedelta(days=1), 'hour': timedelta(hours=1)}
+
+ARCHIVE_INDEXES = [
+    IndexModel([('created_at', ASCENDING)], name='idx_arch_created_at'),
+    IndexModel([('ns.db', ASCENDING), ('ns.coll', ASCENDING), ('_id', ASCENDING)], name='idx_arch_ns_id'),
+    IndexModel([('documentKey._id', ASCENDING)], name='idx_arch_document_key')
+]
+
+STATS_INDEXES = [
+    IndexModel([('_id.minute', ASCENDING)], name='idx_opstats_minute')
+]
+
+
+class ArchLayout:
+    # -- Layout of a cluster's archived operations in the archive repository. Without buckets everything goes to
+    #    the collection named after the cluster (the original layout). With 'hour' or 'day' buckets, operations
+    #    go to <cluster>.<YYYYMMDD[HH]> according to their created_at, so readers only open the buckets of their
+    #    window and old operations are purged by dropping whole collections. Both layouts can coexist: readers
+    #    always include the unbucketed collection when it exists.
+    def __init__(self, catalog_sess=None, cluster_name=None, bucket=None):
+        if bucket is not None and bucket not in BUCKET_FORMATS:
+            LOGGER.error('Invalid archive bucket {}, it must be one of {}.'.format(bucket, ', '.join(BUCKET_FORMATS)))
+            exit(1)
+
+        self.catalog_sess = catalog_sess
+        self.cluster_name = cluster_name
+        self.bucket = bucket
+        self.indexed = set()
+        self.bucket_re = re.compile('^' + re.escape(self.cluster_name) + r'\.(\d{8}|\d{10})$')
+
+    def collection_for(self, created_at=None):
+        if self.bucket is None:
+            return self.cluster_name
+        else:
+            return self.cluster_name + '.' + created_at.strftime(BUCKET_FORMATS[self.bucket])
+
+    def stats_collection(self):
+        # -- Per minute operation counters maintained by the archiver
+        return self.cluster_name + '_opstats'
+
+    def ensure_indexes(self, coll_name=None, indexes=None):
+        if coll_name in self.indexed:
+            return
+        if indexes is None:
+            indexes = ARCHIVE_INDEXES
+        try:
+            self.catalog_sess.create_indexes(coll_name=coll_name, indexes=indexes)
+            self.indexed.add(coll_name)
+        except pymongo.errors.OperationFailure, e:
+            LOGGER.error('Cannot create indexes on archive collection {}: {}'.format(coll_name, e))
+
+    def _buckets(self):
+        # -- (collection name, bucket start, bucket end) for every bucket of the cluster, oldest first
+        buckets = list()
+        for coll_name in self.catalog_sess.list_collections():
+            match = self.bucket_re.match(coll_name)
+            if match is None:
+                continue
+            suffix = match.group(1)
+            span = 'day' if len(suffix) == 8 else 'hour'
+            start = datetime.strptime(suffix, BUCKET_FORMATS[span])
+            buckets.append((coll_name, start, start + BUCKET_SPANS[span]))
+        return sorted(buckets, key=lambda bucket: bucket[1])
+
+    def collections_in_window(self, from_date=None, until_date=None):
+        # -- Archive collections that may hold operations created between from_date and until_date, oldest first
+        collections = list()
+        if self.cluster_name in self.catalog_sess.list_collections():
+            collections.append(self.cluster_name)
+
+        for coll_name, start, end in self._buckets():
+            if from_date is not None and end <= from_date:
+                continue
+            if until_date is not None and start > until_date:
+                continue
+            collections.append(coll_name)
+        return collections
+
+    def drop_buckets_before(self, before=None):
+        # -- Buckets entirely older than 'before' are dropped. Operations in the unbucketed collection can only be
+        #    deleted one by one.
+        dropped = list()
+        stats_cutoff = before.replace(second=0, microsecond=0)
+        for coll_name, start, end in self._buckets():
+            if end > before:
+                stats_cutoff = min(stats_cutoff, start)
+            else:
+                self.catalog_sess.drop_collection(coll_name=coll_name)
+                dropped.append(coll_name)
+                LOGGER.info('Archive bucket {} has been dropped.'.format(coll_name))
+
+        deleted = 0
+        if self.cluster_name in self.catalog_sess.list_collections():
+            deleted = self.catalog_sess.remove_many(coll_name=self.cluster_name,
+                                                    query={'created_at': {'$lt': before}})
+
+        # -- Statistics of the minutes whose operations are all gone
+        self.catalog_sess.remove_many(coll_name=self.stats_collection(), query={'_id.minute': {'$lt': stats_cutoff}})
+        return dropped, deleted
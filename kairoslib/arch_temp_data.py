@@ -3,31 +3,43 @@
 import logging
 import pymongo
 import pymongo.errors
+from bson import BSON
+from zlib import crc32
+from kairoslib.arch_layout import ArchLayout
 from kairoslib.catalog import Catalog
 
 LOGGER = logging.getLogger(__name__)
 
 
 class ArchTempData:
+    # -- Reduces the archived operations of a time window to the last operation of every document and streams
+    #    them to the recover consumers. Nothing is materialised in the archive repository: the aggregation cursor
+    #    is read directly, one batch at a time.
     def __init__(self, arch_repo_uri=None, arch_repo_name=None, source_cluster_name=None, begin_from=None, upto=None,
-                 temp_coll=None, arch_queue=None):
+                 arch_queue=None, allow_disk_use=False, skip_filter=None):
         self.source_cluster_name = source_cluster_name
         self.begin_from = begin_from
         self.until = upto
-        self.temp_coll = temp_coll
         self.arch_repo_uri = arch_repo_uri
         self.arch_repo_name = arch_repo_name
         self.arch_queue = arch_queue
+        self.allow_disk_use = allow_disk_use
+        self.skip_filter = skip_filter
         self.op_arch_sess = None
 
-    def create_temp_data(self):
-        self.op_arch_sess = Catalog(repo_uri=self.arch_repo_uri, repo_name=self.arch_repo_name)
-        self.op_arch_sess.connect()
+    def last_ops_pipeline(self):
+        # -- The $match on created_at uses the created_at index. The $sort on _id (the resume token, i.e. the oplog
+        #    order) that follows it is a blocking sort of the whole window, which is why large windows need
+        #    --allow-disk-use. $last of a single sub-document keeps one operation per document in the group state
+        #    instead of its whole history.
+        window = [{'created_at': {'$gte': self.begin_from}}, {'created_at': {'$lte': self.until}}]
+        if self.skip_filter is not None and self.skip_filter.match() is not None:
+            window.append(self.skip_filter.match())
 
-        pipeline = [
+        return [
             {
                 '$match': {
-                    '$and': [{'created_at': {'$gte': self.begin_from}}, {'created_at': {'$lte': self.until}}]
+                    '$and': window
                 }
             },
             {
@@ -36,8 +48,8 @@ class ArchTempData:
             {
                 '$group': {
                     '_id': {'dbname': '$ns.db', 'collname': '$ns.coll', 'doc_id': '$documentKey._id'},
-                    'ops': {
-                        '$push': {
+                    'lastOp': {
+                        '$last': {
                             'op_id': '$_id',
                             'created_at': '$created_at',
                             'op_type': '$operationType',
@@ -47,42 +59,92 @@ class ArchTempData:
                 }
             },
             {
-                '$project': {
-                    '_id': '$_id',
-                    'lastOp': {'$arrayElemAt': ['$ops', -1]}
-                }
-            },
-            {
-                '$out': self.temp_coll
+                '$sort': {'lastOp.op_id': 1}
             }
         ]
 
+    @staticmethod
+    def route(operation, num_partitions):
+        # -- Partition of a document: crc32 of its BSON encoded (db, coll, doc id), stable across runs and
+        #    processes, so every operation on a document (and most of a namespace's batches) lands on the same worker
+        key = BSON.encode({'k': [operation['_id']['dbname'], operation['_id']['collname'],
+                                 operation['_id']['doc_id']]})
+        return (crc32(key) & 0xffffffff) % num_partitions
+
+    @staticmethod
+    def op_position(bucket_idx, op_id):
+        # -- Position of an operation in the recovery stream: buckets in order, then resume token order
+        return bucket_idx, op_id.get('_data')
+
+    def read_last_ops(self, batch_size=1000, stats_queue=None, checkpoints=None):
+        # -- Runs in its own process: streams the last operations and hands them to the consumers one batch at a
+        #    time. arch_queue holds one bounded queue per consumer, so put() blocks while a consumer is behind and
+        #    memory use does not depend on the size of the recovery window. A None on each queue marks the end of
+        #    the stream. The number of operations routed to each consumer and namespace is reported on stats_queue.
+        #
+        #    Buckets are reduced one at a time, oldest first. A document changed in several buckets is sent once
+        #    per bucket, always to the same consumer and in bucket order, so the newest operation is applied last.
+        #
+        #    Within a bucket operations are sent in op_id order. checkpoints ({partition: {'bucket', 'op_id'}}) is
+        #    the last operation each consumer applied in a previous run; everything up to it is not sent again.
+        num_partitions = len(self.arch_queue)
+        batches = [list() for partition in range(num_partitions)]
+        routed = [0] * num_partitions
+        per_namespace = dict()
         try:
-            self.op_arch_sess.run_aggregation(coll_name=self.source_cluster_name, aggr_pipeline=pipeline)
-            LOGGER.info('Temporary collection created according to the specified date/time boundaries')
-            self.op_arch_sess.close()
-        except:
-            LOGGER.error('Failed to create temporary collection with the required data for recovery.')
-            self.op_arch_sess.close()
-            exit(1)
+            self.op_arch_sess = Catalog(repo_uri=self.arch_repo_uri, repo_name=self.arch_repo_name)
+            self.op_arch_sess.connect()
 
-    def read_temp_data(self):
-        self.op_arch_sess = Catalog(repo_uri=self.arch_repo_uri, repo_name=self.arch_repo_name)
-        self.op_arch_sess.connect()
+            layout = ArchLayout(catalog_sess=self.op_arch_sess, cluster_name=self.source_cluster_name)
+            arch_colls = layout.collections_in_window(from_date=self.begin_from, until_date=self.until)
 
-        temp_data = self.op_arch_sess.find_all(coll_name=self.temp_coll, query={}, ordered=[('_id', pymongo.ASCENDING)])
-        # iter cursor and ingest data into the queue
-        [self.arch_queue.put(operation) for operation in temp_data]
-        self.op_arch_sess.close()
+            resume_from = dict()
+            if checkpoints is not None:
+                for partition, checkpoint in checkpoints.items():
+                    bucket_idx = arch_colls.index(checkpoint['bucket']) if checkpoint['bucket'] in arch_colls else -1
+                    resume_from[partition] = self.op_position(bucket_idx, checkpoint['op_id'])
 
-    def destroy_temp_data(self):
-        self.op_arch_sess = Catalog(repo_uri=self.arch_repo_uri, repo_name=self.arch_repo_name)
-        self.op_arch_sess.connect()
+            for bucket_idx, arch_coll in enumerate(arch_colls):
+                pipeline = self.last_ops_pipeline()
+                done = [p for p in resume_from.keys() if resume_from[p][0] > bucket_idx]
+                if len(done) == num_partitions:
+                    continue
+                if len([p for p in range(num_partitions) if p in resume_from and resume_from[p][0] >= bucket_idx]) \
+                        == num_partitions:
+                    # -- Every consumer got past the start of this bucket, the server skips what all of them applied
+                    resume_op = min([checkpoints[p]['op_id'] for p in resume_from.keys()
+                                     if resume_from[p][0] == bucket_idx], key=lambda op_id: op_id.get('_data'))
+                    pipeline.append({'$match': {'lastOp.op_id': {'$gt': resume_op}}})
 
-        try:
-            self.op_arch_sess.drop_collection(coll_name=self.temp_coll)
-            self.op_arch_sess.close()
-            LOGGER.info('Temporary collection {} has been dropped.'.format(self.temp_coll))
-        except:
-            LOGGER.error('Failed to drop temporary collection {}.'.format(self.temp_coll))
+                last_ops = self.op_arch_sess.aggregate(coll_name=arch_coll, aggr_pipeline=pipeline,
+                                                       batch_size=batch_size, allow_disk_use=self.allow_disk_use)
+                for operation in last_ops:
+                    partition = self.route(operation, num_partitions)
+                    if partition in resume_from and \
+                            self.op_position(bucket_idx, operation['lastOp']['op_id']) <= resume_from[partition]:
+                        continue
+                    operation['bucket'] = arch_coll
+                    batches[partition].append(operation)
+                    routed[partition] += 1
+                    ns_name = '{}.{}'.format(operation['_id']['dbname'], operation['_id']['collname'])
+                    per_namespace[ns_name] = per_namespace.get(ns_name, 0) + 1
+                    if len(batches[partition]) >= batch_size:
+                        self.arch_queue[partition].put(batches[partition])
+                        batches[partition] = list()
+
+            for partition in range(num_partitions):
+                if len(batches[partition]) > 0:
+                    self.arch_queue[partition].put(batches[partition])
+        except pymongo.errors.OperationFailure, e:
+            LOGGER.error('Failed to read the operations to recover: {}'.format(e))
+            if not self.allow_disk_use:
+                LOGGER.error('Large recovery windows may need --allow-disk-use.')
             exit(1)
+        finally:
+            for partition in range(num_partitions):
+                self.arch_queue[partition].put(None)
+            if self.op_arch_sess is not None and self.op_arch_sess.session is not None:
+                self.op_arch_sess.close()
+
+        if stats_queue is not None:
+            stats_queue.put(('reader', {'routed': routed, 'per_namespace': per_namespace}))
@@ -3,7 +3,7 @@
 import logging
 from pymongo import MongoClient
 from pymongo import errors
-from pymongo import ASCENDING, IndexModel
+from pymongo import ASCENDING, IndexModel, ReturnDocument
 from pymongo.database import Database
 
 
@@ -57,6 +57,9 @@ class Catalog:
                                              unique=True
                                              )
 
+        # -- expiry lookups of the backup grim reaper
+        retention_index = IndexModel([('retention', ASCENDING)], name='idx_backups_retention')
+
         coll_indexes['oplogarchiver'] = IndexModel([('cluster_name', ASCENDING),
                                               ('archiver_name', ASCENDING)],
                                              name='idx_oplogarch_cluster_name_archiver_name',
@@ -67,7 +70,10 @@ class Catalog:
             try:
                 logging.info('Creating index on repository collection {}.'.format(coll_idx))
                 coll = db_kairos[coll_idx]
-                coll.create_indexes([coll_indexes[coll_idx]])
+                if coll_idx == 'backups':
+                    coll.create_indexes([coll_indexes[coll_idx], retention_index])
+                else:
+                    coll.create_indexes([coll_indexes[coll_idx]])
             except errors.OperationFailure, e:
                 logging.error(e)
                 exit(1)
@@ -81,9 +87,35 @@ class Catalog:
             logging.error(e)
             return
 
-    def edit(self, coll_name=None, query=None, update=None):
+    def add_many(self, coll_name=None, docs=None):
+        # -- Unordered bulk insert. Documents already in the collection (duplicate _id) are not an error, so a batch
+        #    can be replayed safely after a reconnect. Any other write error is raised to the caller. Returns the
+        #    documents that were actually inserted.
+        coll = self.kairosdb[coll_name]
+        try:
+            coll.insert_many(docs, ordered=False)
+            return docs
+        except errors.BulkWriteError, e:
+            write_errors = e.details.get('writeErrors', [])
+            if len([err for err in write_errors if err['code'] != 11000]) > 0 or \
+                    len(e.details.get('writeConcernErrors', [])) > 0:
+                raise
+            duplicates = set([err['index'] for err in write_errors])
+            return [doc for idx, doc in enumerate(docs) if idx not in duplicates]
+
+    def bulk_write(self, coll_name=None, requests=None):
+        coll = self.kairosdb[coll_name]
+        return coll.bulk_write(requests, ordered=False)
+
+    def edit(self, coll_name=None, query=None, update=None, upsert=False):
+        coll = self.kairosdb[coll_name]
+        coll.find_one_and_update(filter=query, update=update, upsert=upsert)
+
+    def claim(self, coll_name=None, query=None, update=None, ordered=None):
+        # Atomically updates the first document matching query and returns it as updated, None if nothing matched
         coll = self.kairosdb[coll_name]
-        coll.find_one_and_update(filter=query, update=update)
+        return coll.find_one_and_update(filter=query, update=update, sort=ordered,
+                                        return_document=ReturnDocument.AFTER)
 
     def remove_one(self, coll_name=None, query=None):
         coll = self.kairosdb[coll_name]
@@ -119,6 +151,21 @@ class Catalog:
         coll = self.kairosdb[coll_name]
         return list(coll.aggregate(aggr_pipeline))
 
+    def create_indexes(self, coll_name=None, indexes=None):
+        coll = self.kairosdb[coll_name]
+        return coll.create_indexes(indexes)
+
+    def list_collections(self):
+        return self.kairosdb.list_collection_names()
+
+    def aggregate(self, coll_name=None, aggr_pipeline=None, batch_size=None, allow_disk_use=False):
+        # Returns the aggregation cursor itself, for results too large to be held in a list
+        coll = self.kairosdb[coll_name]
+        if batch_size is not None:
+            return coll.aggregate(aggr_pipeline, allowDiskUse=allow_disk_use, batchSize=batch_size)
+        else:
+            return coll.aggregate(aggr_pipeline, allowDiskUse=allow_disk_use)
+
     def drop_collection(self, coll_name=None):
         coll = self.kairosdb[coll_name]
         coll.drop()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python2
+
+import logging
+from kairoslib.concurrency import run_parallel
+from kairoslib.host_conn import HOST_CONN_POOL
+from kairoslib.ontap import InitiatorGroup, VolumeBulkDestroy
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CloneTeardown:
+    # -- Tears a clone down in four steps, each one running on every host or SVM at the same time:
+    #      1. mongos is stopped on every mongos host
+    #      2. on every host, mongod is stopped, then the file system of every data member is unmounted and its
+    #         volume group disabled
+    #      3. on every SVM, the FlexClones of the members torn down on step 2 are taken offline and destroyed in
+    #         bulk, then their igroups are destroyed
+    #      4. one iSCSI rescan on every host, once all the LUNs of its members are gone
+    #    Every step done is added to the clone's teardown_done list, so running the delete again after a failure
+    #    resumes where the previous run stopped.
+    def __init__(self, clone_doc=None, clones_coll=None, svm_sessions=None, username=None, max_workers=8):
+        self.clone_doc = clone_doc
+        self.clones_coll = clones_coll
+        self.svm_sessions = svm_sessions
+        self.username = username
+        self.max_workers = max_workers
+        self.done = set(clone_doc.get('teardown_done', list()))
+
+        self.members = list(clone_doc['config_server'])
+        for shard in clone_doc['shards']:
+            self.members.extend(shard['members'])
+
+    def _is_done(self, step):
+        return step in self.done
+
+    def _mark_done(self, step):
+        self.clones_coll.update_one({'_id': self.clone_doc['_id']}, {'$addToSet': {'teardown_done': step}})
+        self.done.add(step)
+
+    @staticmethod
+    def _member_step(member):
+        if member['arbiter_only']:
+            return 'member:' + member['hostname']
+        return 'member:' + member['hostname'] + ':' + member['mountpoint']
+
+    @staticmethod
+    def _volume_step(member, volume):
+        return 'volume:' + member['svm_name'] + ':' + volume
+
+    @staticmethod
+    def _igroup_step(member):
+        return 'igroup:' + member['svm_name'] + ':' + member['igroup_name']
+
+    def _steps(self):
+        steps = ['mongos:' + mongos for mongos in self.clone_doc['mongos']]
+        for member in self.members:
+            steps.append(self._member_step(member))
+            if not member['arbiter_only']:
+                steps.extend([self._volume_step(member, volume) for volume in member['volclone_topology']])
+                steps.append(self._igroup_step(member))
+        hosts = set([member['hostname'] for member in self.members if not member['arbiter_only']])
+        steps.extend(['rescan:' + hostname for hostname in hosts])
+        return steps
+
+    def _stop_mongos(self, mongos=None):
+        host = HOST_CONN_POOL.get(ipaddr=mongos, username=self.username)
+        try:
+            host.run_command('pkill mongos')
+            if host.wait_process_gone(process_name='mongos')[1] != 0:
+                LOGGER.error('Could not kill mongos on host {}.'.format(mongos))
+                return
+            LOGGER.info('mongos has been stopped on host {}.'.format(mongos))
+            self._mark_done('mongos:' + mongos)
+        finally:
+            host.close()
+
+    def _teardown_host(self, hostname=None, members=None):
+        host = HOST_CONN_POOL.get(ipaddr=hostname, username=self.username)
+        try:
+            # -- pkill fails when mongod is not running anymore, what matters is that it is gone
+            host.run_command('pkill mongod')
+            if host.wait_process_gone(process_name='mongod')[1] != 0:
+                LOGGER.error('Could not kill mongod on host {}.'.format(hostname))
+                return
+            LOGGER.info('mongod has been stopped on host {}.'.format(hostname))
+
+            for member in members:
+                if not member['arbiter_only']:
+                    if host.run_command('mountpoint -q ' + member['mountpoint'])[1] == 0:
+                        host.umount_fs(fs_mountpoint=member['mountpoint'])
+                        if host.wait_unmounted(fs_mountpoint=member['mountpoint'])[1] != 0:
+                            LOGGER.error('Could not unmount mongoDB file system {} on host {}.'.format(
+                                member['mountpoint'], hostname))
+                            continue
+                    LOGGER.info('mongoDB file system {} has been unmounted on host {}.'.format(member['mountpoint'],
+                                                                                               hostname))
+
+                    result = host.disable_vg(vg_name=member['lvm_vgname'])
+                    if result[1] != 0:
+                        LOGGER.error('Could not disable volume group {} on host {}.'.format(member['lvm_vgname'],
+                                                                                            hostname))
+                        continue
+                    LOGGER.info('Volume Group {} has been disabled on host {}.'.format(member['lvm_vgname'], hostname))
+
+                self._mark_done(self._member_step(member))
+        finally:
+            host.close()
+
+    def _teardown_svm(self, svm_name=None, members=None):
+        svm = self.svm_sessions.get(svm_name)
+        if svm is None:
+            LOGGER.error('Cannot find SVM {} in the netapp repository collection.'.format(svm_name))
+            return
+
+        # -- Only the volumes of members whose file system is unmounted
+        volumes = dict()
+        for member in members:
+            if self._is_done(self._member_step(member)):
+                for volume in member['volclone_topology']:
+                    if not self._is_done(self._volume_step(member, volume)):
+                        volumes[volume] = member
+
+        if len(volumes) > 0:
+            results = VolumeBulkDestroy(svm=svm, volumes=volumes.keys()).destroy(max_workers=self.max_workers)
+            for volume, result in results.items():
+                if result[0] == 'failed':
+                    LOGGER.error('Could not delete flexvolume {} on SVM {}: {}'.format(volume, svm_name, result[1]))
+                else:
+                    LOGGER.info('FlexClone volume {} has been deleted on SVM {}.'.format(volume, svm_name))
+                    self._mark_done(self._volume_step(volumes[volume], volume))
+
+        for member in members:
+            if self._is_done(self._igroup_step(member)):
+                continue
+            if len([volume for volume in member['volclone_topology']
+                    if not self._is_done(self._volume_step(member, volume))]) > 0:
+                continue
+
+            igroup = InitiatorGroup({'igroup-name': member['igroup_name']})
+            result = igroup.destroy(svm=svm)
+            if result[0] == 'failed':
+                LOGGER.error('Could not destroy igroup {} on SVM {}.'.format(member['igroup_name'], svm_name))
+            else:
+                LOGGER.info('Igroup {} has been destroyed on SVM {}.'.format(member['igroup_name'], svm_name))
+                self._mark_done(self._igroup_step(member))
+
+    def _rescan(self, hostname=None):
+        host = HOST_CONN_POOL.get(ipaddr=hostname, username=self.username)
+        try:
+            result = host.iscsi_rescan()
+            if result[1] != 0:
+                LOGGER.error('Could not rescan devices on host {}.'.format(hostname))
+            else:
+                LOGGER.info('Stale devices has been removed on host {}.'.format(hostname))
+                self._mark_done('rescan:' + hostname)
+        finally:
+            host.close()
+
+    def _run_step(self, tasks):
+        for task in run_parallel(tasks=tasks, max_workers=self.max_workers):
+            if not task.ok():
+                LOGGER.error('Teardown of {} has failed: {}'.format(task.key, task.error))
+
+    def run(self):
+        """Returns True once every step of the teardown is done."""
+        # -- Step 1 :: mongos
+        self._run_step([(mongos, self._stop_mongos, {'mongos': mongos}) for mongos in self.clone_doc['mongos']
+                        if not self._is_done('mongos:' + mongos)])
+
+        # -- Step 2 :: host side of every member
+        per_host = dict()
+        for member in self.members:
+            if not self._is_done(self._member_step(member)):
+                per_host.setdefault(member['hostname'], list()).append(member)
+        self._run_step([(hostname, self._teardown_host, {'hostname': hostname, 'members': members})
+                        for hostname, members in per_host.items()])
+
+        # -- Step 3 :: FlexClones and igroups
+        per_svm = dict()
+        for member in self.members:
+            if not member['arbiter_only'] and not self._is_done(self._igroup_step(member)):
+                per_svm.setdefault(member['svm_name'], list()).append(member)
+        self._run_step([(svm_name, self._teardown_svm, {'svm_name': svm_name, 'members': members})
+                        for svm_name, members in per_svm.items()])
+
+        # -- Step 4 :: one rescan per host, once the igroups of all its members are gone
+        rescan_hosts = set()
+        for member in self.members:
+            if not member['arbiter_only'] and not self._is_done('rescan:' + member['hostname']):
+                rescan_hosts.add(member['hostname'])
+        for member in self.members:
+            if not member['arbiter_only'] and not self._is_done(self._igroup_step(member)):
+                rescan_hosts.discard(member['hostname'])
+        self._run_step([(hostname, self._rescan, {'hostname': hostname}) for hostname in rescan_hosts])
+
+        return len([step for step in self._steps() if not self._is_done(step)]) == 0
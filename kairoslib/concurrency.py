@@ -0,0 +1,230 @@
+#!/usr/bin/env python2
+"""Concurrency helpers :: bounded worker pools shared by the subcommands
+"""
+
+import logging
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TaskResult:
+    def __init__(self, key=None, result=None, error=None, elapsed=None):
+        self.key = key
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+    def ok(self):
+        return self.error is None
+
+
+def _run_task(task):
+    key, func, kwargs = task
+    start = time()
+    try:
+        result = func(**kwargs)
+        return TaskResult(key=key, result=result, elapsed=time() - start)
+    except (Exception, SystemExit), e:
+        # -- Most of kairos' building blocks call exit(1) on failure. SystemExit is not an Exception subclass and
+        #    would kill the pool worker thread, so it is converted into a failed task here.
+        return TaskResult(key=key, error=e, elapsed=time() - start)
+
+
+def run_parallel(tasks=None, max_workers=None, fail_fast=False):
+    """Runs (key, callable, kwargs) tasks on a bounded thread pool.
+
+    Returns a list of TaskResult in completion order. With fail_fast, the pool stops handing out new tasks as soon
+    as one of them fails; tasks that never started are not part of the result.
+    """
+    if not tasks:
+        return list()
+
+    if max_workers is None or max_workers > len(tasks):
+        max_workers = len(tasks)
+
+    pool = ThreadPool(processes=max_workers)
+    results = list()
+    try:
+        for task_result in pool.imap_unordered(_run_task, tasks):
+            results.append(task_result)
+            if fail_fast and not task_result.ok():
+                LOGGER.error('Task {} failed, cancelling the remaining tasks.'.format(task_result.key))
+                pool.terminate()
+                break
+        else:
+            pool.close()
+    finally:
+        pool.join()
+
+    return results
+
+
+class TaskPool:
+    # -- Long lived bounded pool for pipelines where finished tasks schedule new ones. Callbacks receive the
+    #    TaskResult and run on the pool's result thread, so they must be quick.
+    def __init__(self, max_workers=None):
+        self.pool = ThreadPool(processes=max_workers)
+
+    def submit(self, key=None, func=None, kwargs=None, callback=None):
+        if kwargs is None:
+            kwargs = dict()
+        return self.pool.apply_async(_run_task, ((key, func, kwargs),), callback=callback)
+
+    def join(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class RateLimiter:
+    # -- Token bucket shared by threads: at most 'rate' acquisitions per second on average, 'burst' at once.
+    def __init__(self, rate=None, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(int(rate), 1)
+        self.tokens = float(self.burst)
+        self.updated_at = time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class DependencyScheduler:
+    # -- Runs (key, callable, kwargs) tasks on a bounded thread pool, each one as soon as every task it depends on
+    #    has succeeded. Tasks depending on a failed task are not run and get a failed TaskResult. Start and end times
+    #    are kept so the run's critical path (the chain of tasks that decided its duration) can be reported.
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.tasks = dict()
+        self.order = list()
+        self.results = dict()
+        self.started_at = dict()
+        self.ended_at = dict()
+        self.run_start = None
+
+    def add(self, key=None, func=None, kwargs=None, depends_on=None):
+        if key in self.tasks:
+            raise ValueError('Task {} has already been added.'.format(key))
+        if kwargs is None:
+            kwargs = dict()
+        self.tasks[key] = (func, kwargs, list(depends_on or list()))
+        self.order.append(key)
+
+    def _check(self):
+        waiting = dict()
+        dependents = dict([(key, list()) for key in self.order])
+        for key in self.order:
+            for dep in self.tasks[key][2]:
+                if dep not in self.tasks:
+                    raise ValueError('Task {} depends on unknown task {}.'.format(key, dep))
+                dependents[dep].append(key)
+            waiting[key] = len(self.tasks[key][2])
+
+        ready = [key for key in self.order if waiting[key] == 0]
+        visited = 0
+        pending = dict(waiting)
+        while ready:
+            key = ready.pop()
+            visited += 1
+            for dependent in dependents[key]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    ready.append(dependent)
+        if visited != len(self.order):
+            raise ValueError('Task dependencies have a cycle.')
+        return waiting, dependents
+
+    def run(self, fail_fast=False):
+        """Runs every task and returns a {key: TaskResult} dict.
+
+        With fail_fast, no task is started after the first failure; tasks that never started are not part of
+        the result.
+        """
+        if not self.tasks:
+            return dict()
+
+        waiting, dependents = self._check()
+        max_workers = self.max_workers
+        if max_workers is None or max_workers > len(self.tasks):
+            max_workers = len(self.tasks)
+
+        done = Queue.Queue()
+        pool = ThreadPool(processes=max_workers)
+        running = [0]
+        self.run_start = time()
+
+        def submit(key):
+            func, kwargs, depends_on = self.tasks[key]
+            running[0] += 1
+            pool.apply_async(_run_task, ((key, func, kwargs),), callback=done.put)
+
+        def skip(key, failed_dep):
+            if key in self.results:
+                return
+            self.results[key] = TaskResult(key=key, error=RuntimeError('dependency {} failed'.format(failed_dep)),
+                                           elapsed=0.0)
+            for dependent in dependents[key]:
+                skip(dependent, failed_dep)
+
+        cancelled = False
+        try:
+            for key in self.order:
+                if waiting[key] == 0:
+                    submit(key)
+
+            while running[0] > 0:
+                task_result = done.get()
+                running[0] -= 1
+                self.ended_at[task_result.key] = time()
+                self.started_at[task_result.key] = self.ended_at[task_result.key] - task_result.elapsed
+                self.results[task_result.key] = task_result
+
+                if not task_result.ok():
+                    LOGGER.error('Task {} failed: {}'.format(task_result.key, task_result.error))
+                    if fail_fast:
+                        cancelled = True
+                    for dependent in dependents[task_result.key]:
+                        skip(dependent, task_result.key)
+                    continue
+
+                for dependent in dependents[task_result.key]:
+                    waiting[dependent] -= 1
+                    if waiting[dependent] == 0 and dependent not in self.results and not cancelled:
+                        submit(dependent)
+        finally:
+            pool.close()
+            pool.join()
+
+        if cancelled:
+            return dict([(key, result) for key, result in self.results.items() if key in self.ended_at])
+        return self.results
+
+    def critical_path(self):
+        """Returns the chain of tasks that ended last, as (key, started, elapsed) tuples in run order.
+
+        started is relative to the start of the run; the gap between a task's start and the end of the task before
+        it is time spent waiting for a free worker.
+        """
+        if not self.ended_at:
+            return list()
+
+        path = list()
+        key = max(self.ended_at.keys(), key=lambda k: self.ended_at[k])
+        while key is not None:
+            path.append((key, self.started_at[key] - self.run_start, self.results[key].elapsed))
+            ended_deps = [dep for dep in self.tasks[key][2] if dep in self.ended_at]
+            key = max(ended_deps, key=lambda k: self.ended_at[k]) if ended_deps else None
+        path.reverse()
+        return path
@@ -1,20 +1,28 @@
 #!/usr/bin/env python2
 
+import atexit
 import logging
+import re
+import threading
 from sys import exit
 from paramiko import SSHClient, AutoAddPolicy
 from select import select
+from time import sleep, time
 
 
 class HostConn:
-    def __init__(self, ipaddr=None, port=None, username=None, ssh_keyfile=None, timeout=None):
+    def __init__(self, ipaddr=None, port=None, username=None, ssh_keyfile=None, timeout=None, pool=None):
         self.ipaddr = ipaddr
-        self.username = None
-        self.ssh_keyfile = None
+        self.username = username
+        self.ssh_keyfile = ssh_keyfile
         self.ssh_conn = None
         self.ssh_transport = None
-        self.ssh_channel = None
         self.timeout = timeout
+        # -- Set when the connection is owned by a HostConnPool; close() then hands it back instead of closing it
+        self.pool = pool
+        self.refs = 0
+        self.last_used = time()
+        self.service_manager = None
         # By default SSH will be on port 22
         if port is None:
             self.port = 22
@@ -27,174 +35,419 @@ class HostConn:
         self.ssh_conn.connect(hostname=self.ipaddr, port=self.port, username=self.username, key_filename=self.ssh_keyfile, timeout=self.timeout)
 
     def run_command(self, cmd=None):
-        stdin, stdout, stderr = self.ssh_conn.exec_command(cmd)
-        self.ssh_channel = stdout.channel
-
-        stdin.close()
-        self.ssh_channel.shutdown_write()
-
-        stdout_chunks = list()
-        stdout_chunks.append(stdout.channel.recv(len(stdout.channel.in_buffer)))
-        while not self.ssh_channel.closed or self.ssh_channel.recv_ready() or self.ssh_channel.recv_stderr_ready():
-            got_chunk = False
-            readq, _, _ = select([stdout.channel], [], [], self.timeout)
-            for chunk in readq:
-                if chunk.recv_ready():
-                    stdout_chunks.append(stdout.channel.recv(len(chunk.in_buffer)))
-                    got_chunk = True
-                if chunk.recv_stderr_ready():
-                    stderr.channel.recv_stderr(len(chunk.in_stderr_buffer))
-                    got_chunk = False
-
-            if not got_chunk and stdout.channel.exit_status_ready() and not stderr.channel.recv_stderr_ready() and not stdout.channel.recv_ready():
-                stdout.channel.shutdown_read()
-                stdout.channel.close()
-                break
-
-        stdout.close()
-        stderr.close()
-        return (''.join(stdout_chunks), stdout.channel.recv_exit_status())
+        mux = CommandMux(poll_interval=self.timeout)
+        return mux.submit(self, cmd).result()
+
+    def submit_command(self, cmd=None, mux=None):
+        # -- Runs cmd on its own channel of this connection. Without a mux the command output is returned right
+        #    away, otherwise a CommandFuture is returned and the command runs alongside the others in the mux.
+        if mux is None:
+            return self.run_command(cmd)
+        else:
+            return mux.submit(self, cmd)
 
     def get_storage_layout(self, mongod_path=None, mountpoint=None):
+        # -- Running every probe in a single remote script. sanlun is only called once and its output is matched
+        #    locally against the physical volumes of the volume group.
         if mountpoint is None:
-            # -- grabbing mongodb mount point
-            result_dbpath = self.run_command('grep -i dbpath ' + mongod_path)
-            if result_dbpath[1] == 0:
-                mdb_dbpath = result_dbpath[0].split(':')[1].strip()
-            else:
-                logging.error('Could not get dbpath from host ' + self.ipaddr)
-                exit(1)
-        else:
-            mdb_dbpath = mountpoint
+            mountpoint = ''
+        probe = self.run_command(STORAGE_PROBE_SCRIPT.format(mongod_conf=mongod_path, mountpoint=mountpoint))
+        sections = _split_probe_output(probe[0])
 
-        # -- grabbing mongodb filesystem device
-        result_fs = self.run_command('mount | grep ' + mdb_dbpath)
-        if result_fs[1] == 0:
-            mdb_device = result_fs[0].split()[0]
-            fs_type = result_fs[0].split()[4]
-        else:
+        if sections.get('dbpath_rc') != '0' or len(sections.get('dbpath', '')) == 0:
+            logging.error('Could not get dbpath from host ' + self.ipaddr)
+            exit(1)
+        mdb_dbpath = sections['dbpath']
+
+        if sections.get('mount_rc') != '0' or len(sections.get('mount', '').split()) < 5:
             logging.error('Could not get dbpath device from host ' + self.ipaddr)
             exit(1)
+        mdb_device = sections['mount'].split()[0]
+        fs_type = sections['mount'].split()[4]
+
+        doc = dict()
+        doc['volume_topology'] = list()
+        doc['mountpoint'] = mdb_dbpath
+        doc['fs_type'] = fs_type
 
         # -- Checking if the device is a single LUN or a LVM logical volume
         #    if LVM, then Kairos has to get the list of devices that are part of the Volume Group where
         #    MongoDB's dbpath is located.
-        result_lv = self.run_command('lvdisplay ' + mdb_device)
-        if result_lv[1] == 0:
+        if sections.get('lvdisplay_rc') == '0':
             mdb_vgname = mdb_device.split('/')[3].split('-')[0]
-            result_pvs = self.run_command('pvs | grep ' + mdb_vgname)
             device_list = list()
-            for device in result_pvs[0].split('\n'):
-                if len(device.split()) > 0:
+            for device in sections.get('pvs', '').split('\n'):
+                if mdb_vgname in device and len(device.split()) > 0:
                     device_list.append(device.strip().split()[0].split('/')[3])
 
-            svm_n_vol = list()
+            sanlun_luns = _parse_sanlun_paths(sections.get('sanlun', ''))
             for device in device_list:
-                lun2svm_n_vol = dict()
-
-                # -- grabbing volume and LUN name
-                result_sanlun = self.run_command('sanlun lun show -p | grep -B4 ' + device + ' | grep ONTAP')
-                if result_sanlun[1] == 0:
-                    lun2svm_n_vol['svm-name'] = result_sanlun[0].strip().split(':')[1].strip()
-                    lun2svm_n_vol['volume'] = result_sanlun[0].strip().split(':')[2].split('/')[2].strip()
-                    lun2svm_n_vol['lun-name'] = result_sanlun[0].strip().split(':')[2].split('/')[3].strip()
-                else:
+                if device not in sanlun_luns:
                     logging.error('Could not get output from sanlun for ' + device + '.')
                     exit(1)
+                if 'lun-id' not in sanlun_luns[device]:
+                    logging.error('Could not get LUN id from sanlun for ' + device + '.')
+                doc['volume_topology'].append(sanlun_luns[device])
 
-                # -- grabbing LUN id
-                result_sanlun = self.run_command('sanlun lun show -p | grep -B4 ' + device + ' | grep LUN:')
-                if result_sanlun[1] == 0:
-                    lun2svm_n_vol['lun-id'] = int(result_sanlun[0].strip().split(':')[1].strip())
-                else:
-                    logging.error('Could not get output from sanlun for ' + device + '.')
-
-                svm_n_vol.append(lun2svm_n_vol)
-
+            doc['lvm_vgname'] = mdb_vgname
+            doc['mdb_device'] = mdb_device
         else:
             #TODO: need to create the non-LVM use case.
             pass
 
-        doc = dict()
-        doc['volume_topology'] = list()
-        for svm_vol in svm_n_vol:
-            doc['volume_topology'].append(svm_vol)
-
-        doc['mountpoint'] = mdb_dbpath
-        doc['fs_type'] = fs_type
-        if result_lv[1] == 0:
-            doc['lvm_vgname'] = mdb_vgname
-            doc['mdb_device'] = mdb_device
-
         return doc
 
     def _get_service_manager(self):
-        result = self.run_command('which systemctl')
-        if result[1] == 0:
-            return 'systemctl'
-        else:
-            return 'service'
+        if self.service_manager is None:
+            result = self.run_command('which systemctl')
+            if result[1] == 0:
+                self.service_manager = 'systemctl'
+            else:
+                self.service_manager = 'service'
+        return self.service_manager
 
-    def stop_service(self, service_name=None):
+    def stop_service(self, service_name=None, mux=None):
         svcmgmr = self._get_service_manager()
         if svcmgmr == 'systemctl':
-            result_cmd = self.run_command('systemctl stop ' + service_name)
+            result_cmd = self.submit_command('systemctl stop ' + service_name, mux=mux)
         else:
-            result_cmd = self.run_command('service ' + service_name + ' stop')
+            result_cmd = self.submit_command('service ' + service_name + ' stop', mux=mux)
 
         return result_cmd
 
-    def start_service(self, service_name=None):
+    def start_service(self, service_name=None, mux=None):
         svcmgmr = self._get_service_manager()
         if svcmgmr == 'systemctl':
-            result_cmd = self.run_command('systemctl start ' + service_name)
+            result_cmd = self.submit_command('systemctl start ' + service_name, mux=mux)
         else:
-            result_cmd = self.run_command('service ' + service_name + ' start')
+            result_cmd = self.submit_command('service ' + service_name + ' start', mux=mux)
 
         return result_cmd
 
-    def disable_vg(self, vg_name=None):
-        result_cmd = self.run_command('vgchange -an ' + vg_name)
+    def disable_vg(self, vg_name=None, mux=None):
+        result_cmd = self.submit_command('vgchange -an ' + vg_name, mux=mux)
         return result_cmd
 
-    def enable_vg(self, vg_name=None):
-        result_cmd = self.run_command('vgchange -ay ' + vg_name)
+    def enable_vg(self, vg_name=None, mux=None):
+        result_cmd = self.submit_command('vgchange -ay ' + vg_name, mux=mux)
         return result_cmd
 
-    def umount_fs(self, fs_mountpoint=None):
-        result_cmd = self.run_command('umount -f ' + fs_mountpoint)
+    def umount_fs(self, fs_mountpoint=None, mux=None):
+        result_cmd = self.submit_command('umount -f ' + fs_mountpoint, mux=mux)
         return result_cmd
 
-    def mount_fs(self, fs_mountpoint=None, fs_type=None, device=None):
-        result_cmd = self.run_command('mount -t ' + fs_type + ' -o noatime ' + device + ' ' + fs_mountpoint)
+    def mount_fs(self, fs_mountpoint=None, fs_type=None, device=None, mux=None):
+        result_cmd = self.submit_command('mount -t ' + fs_type + ' -o noatime ' + device + ' ' + fs_mountpoint,
+                                         mux=mux)
         return result_cmd
 
-    def get_hostname(self):
-        result_cmd = self.run_command('hostname')
+    def get_hostname(self, mux=None):
+        result_cmd = self.submit_command('hostname', mux=mux)
         return result_cmd
 
-    def get_iscsi_iqn(self):
-        result_cmd = self.run_command('cat /etc/iscsi/initiatorname.iscsi')
+    def get_iscsi_iqn(self, mux=None):
+        result_cmd = self.submit_command('cat /etc/iscsi/initiatorname.iscsi', mux=mux)
         return result_cmd
 
-    def iscsi_rescan(self):
-        result_cmd = self.run_command('/sbin/iscsiadm -m session --rescan')
+    def iscsi_rescan(self, mux=None):
+        result_cmd = self.submit_command('/sbin/iscsiadm -m session --rescan', mux=mux)
         return result_cmd
 
-    def iscsi_send_targets(self, iscsi_target=None):
-        result_cmd = self.run_command('/sbin/iscsiadm -m discovery -t st -p ' + iscsi_target + ':3260')
+    def iscsi_send_targets(self, iscsi_target=None, mux=None):
+        result_cmd = self.submit_command('/sbin/iscsiadm -m discovery -t st -p ' + iscsi_target + ':3260', mux=mux)
         return result_cmd
 
-    def iscsi_node_login(self):
-        result_cmd = self.run_command('/sbin/iscsiadm -m node -L all')
+    def iscsi_node_login(self, mux=None):
+        result_cmd = self.submit_command('/sbin/iscsiadm -m node -L all', mux=mux)
         return result_cmd
 
     def get_wwpn(self):
         pass
 
-    def remove_file(self, filename=None):
-        result_cmd = self.run_command('/bin/rm -f ' + filename)
+    def wait_for(self, cmd=None, timeout=60, initial_delay=0.2, max_delay=5):
+        # -- Runs cmd until it exits 0, sleeping initial_delay, then twice as long every time (up to max_delay),
+        #    between attempts. Returns the last (output, status); status is not 0 when timeout seconds went by
+        #    without the condition being met.
+        deadline = time() + timeout
+        delay = initial_delay
+        while True:
+            result = self.run_command(cmd)
+            if result[1] == 0 or time() + delay > deadline:
+                return result
+            sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    def wait_process_gone(self, process_name=None, timeout=60):
+        return self.wait_for('! pgrep -x ' + process_name, timeout=timeout)
+
+    def wait_port_open(self, port=None, timeout=60):
+        return self.wait_for("ss -ltn | awk '{print $4}' | grep -q ':" + str(port) + "$'", timeout=timeout)
+
+    def wait_port_closed(self, port=None, timeout=60):
+        return self.wait_for("! ss -ltn | awk '{print $4}' | grep -q ':" + str(port) + "$'", timeout=timeout)
+
+    def wait_vg_visible(self, vg_name=None, timeout=60):
+        # -- The volume group shows up once the rescanned LUNs have been picked up by multipath and LVM
+        return self.wait_for('vgs ' + vg_name, timeout=timeout)
+
+    def wait_mounted(self, fs_mountpoint=None, timeout=60):
+        return self.wait_for('mountpoint -q ' + fs_mountpoint, timeout=timeout)
+
+    def wait_unmounted(self, fs_mountpoint=None, timeout=60):
+        return self.wait_for('! mountpoint -q ' + fs_mountpoint, timeout=timeout)
+
+    def remove_file(self, filename=None, mux=None):
+        result_cmd = self.submit_command('/bin/rm -f ' + filename, mux=mux)
         return result_cmd
 
-    def close(self):
+    def is_alive(self):
+        self.ssh_transport = self.ssh_conn.get_transport()
+        if self.ssh_transport is None or not self.ssh_transport.is_active():
+            return False
+        try:
+            self.ssh_transport.send_ignore()
+        except (EOFError, IOError):
+            return False
+        return True
+
+    def disconnect(self):
         self.ssh_conn.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            self.disconnect()
+
+
+class CommandFuture:
+    def __init__(self, mux=None, host=None, cmd=None, channel=None):
+        self.mux = mux
+        self.host = host
+        self.cmd = cmd
+        self.channel = channel
+        self.stdout_chunks = list()
+        self.exit_status = None
+        self.done = False
+
+    def result(self):
+        if not self.done:
+            self.mux.wait(futures=[self])
+        return ''.join(self.stdout_chunks), self.exit_status
+
+
+class CommandMux:
+    # -- Runs several commands at once, each one on its own channel. Channels opened on the same host share its
+    #    SSH transport, and a single select loop reads every channel, whatever host it belongs to.
+    #    A mux is meant to be driven by one thread at a time.
+    def __init__(self, poll_interval=None):
+        if poll_interval is None:
+            poll_interval = 1.0
+        self.poll_interval = poll_interval
+        self.pending = list()
+
+    def submit(self, host=None, cmd=None):
+        channel = host.ssh_conn.get_transport().open_session()
+        channel.exec_command(cmd)
+        channel.shutdown_write()
+
+        future = CommandFuture(mux=self, host=host, cmd=cmd, channel=channel)
+        self.pending.append(future)
+        return future
+
+    def wait(self, futures=None):
+        if futures is None:
+            futures = list(self.pending)
+
+        # -- Every pending channel is drained, not only the awaited ones, so no remote command stalls on a
+        #    full channel window while another one is being waited for.
+        while len([future for future in futures if not future.done]) > 0:
+            select([future.channel for future in self.pending], [], [], self.poll_interval)
+            for future in list(self.pending):
+                self._drain(future)
+
+        return [future.result() for future in futures]
+
+    def gather(self):
+        return self.wait()
+
+    def _drain(self, future):
+        channel = future.channel
+        while channel.recv_ready():
+            future.stdout_chunks.append(channel.recv(len(channel.in_buffer)))
+        while channel.recv_stderr_ready():
+            channel.recv_stderr(len(channel.in_stderr_buffer))
+
+        if channel.exit_status_ready() and (channel.eof_received or channel.closed) and not channel.recv_ready():
+            future.exit_status = channel.recv_exit_status()
+            channel.close()
+            future.done = True
+            self.pending.remove(future)
+
+
+def run_commands(commands=None, poll_interval=None):
+    # -- commands is a list of (HostConn, command) tuples; results come back in the same order as
+    #    (stdout, exit status) tuples.
+    mux = CommandMux(poll_interval=poll_interval)
+    futures = [mux.submit(host, cmd) for host, cmd in commands]
+    return mux.wait(futures=futures)
+
+
+class HostConnPool:
+    def __init__(self, idle_timeout=300):
+        self.idle_timeout = idle_timeout
+        self.conns = dict()
+        self.key_locks = dict()
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.reuses = 0
+        self.evictions = 0
+
+    def get(self, ipaddr=None, port=None, username=None, ssh_keyfile=None, timeout=None):
+        if port is None:
+            port = 22
+        key = (ipaddr, port, username)
+
+        self._evict_idle()
+
+        # -- One lock per (host, port, user), so connecting to a new host does not hold up other hosts
+        with self.lock:
+            if key not in self.key_locks:
+                self.key_locks[key] = threading.Lock()
+            key_lock = self.key_locks[key]
+
+        with key_lock:
+            with self.lock:
+                host = self.conns.get(key)
+
+            if host is not None:
+                if host.is_alive():
+                    with self.lock:
+                        host.refs += 1
+                        host.last_used = time()
+                        self.reuses += 1
+                    return host
+
+                logging.warning('SSH connection to {} is no longer active, reconnecting.'.format(ipaddr))
+                with self.lock:
+                    self.conns.pop(key, None)
+                    self.evictions += 1
+                host.disconnect()
+
+            host = HostConn(ipaddr=ipaddr, port=port, username=username, ssh_keyfile=ssh_keyfile, timeout=timeout,
+                            pool=self)
+            with self.lock:
+                host.refs = 1
+                self.conns[key] = host
+                self.connects += 1
+            return host
+
+    def release(self, host):
+        with self.lock:
+            host.refs = max(host.refs - 1, 0)
+            host.last_used = time()
+
+    def _evict_idle(self):
+        now = time()
+        with self.lock:
+            idle_keys = [key for key, host in self.conns.items()
+                         if host.refs == 0 and now - host.last_used > self.idle_timeout]
+            idle_hosts = [self.conns.pop(key) for key in idle_keys]
+            self.evictions += len(idle_hosts)
+
+        for host in idle_hosts:
+            host.disconnect()
+
+    def stats(self):
+        with self.lock:
+            return {'connects': self.connects, 'reuses': self.reuses, 'evictions': self.evictions,
+                    'open': len(self.conns)}
+
+    def close_all(self):
+        with self.lock:
+            hosts = self.conns.values()
+            self.conns = dict()
+
+        for host in hosts:
+            host.disconnect()
+
+        stats = self.stats()
+        if stats['connects'] > 0:
+            logging.info('SSH connection pool: {} connects, {} reuses, {} evictions.'.format(stats['connects'],
+                                                                                            stats['reuses'],
+                                                                                            stats['evictions']))
+
+
+# -- Process wide SSH connection pool; every connection left in it is closed when kairos exits
+HOST_CONN_POOL = HostConnPool()
+atexit.register(HOST_CONN_POOL.close_all)
+
+
+# -- Remote script used by get_storage_layout. Each section is delimited by a marker line so the whole
+#    output can be parsed locally after a single round trip.
+STORAGE_PROBE_SCRIPT = """KAIROS_DBPATH='{mountpoint}'
+KAIROS_RC=0
+if [ -z "$KAIROS_DBPATH" ]; then
+    grep -i dbpath {mongod_conf} > /dev/null 2>&1
+    KAIROS_RC=$?
+    KAIROS_DBPATH=$(grep -i dbpath {mongod_conf} | head -n 1 | cut -d: -f2 | tr -d '[:space:]')
+fi
+echo '@@kairos dbpath'; echo "$KAIROS_DBPATH"
+echo '@@kairos dbpath_rc'; echo $KAIROS_RC
+KAIROS_MOUNT=$(mount | grep "$KAIROS_DBPATH" | head -n 1)
+echo '@@kairos mount'; echo "$KAIROS_MOUNT"
+echo '@@kairos mount_rc'; [ -n "$KAIROS_MOUNT" ]; echo $?
+KAIROS_DEVICE=$(echo "$KAIROS_MOUNT" | awk '{{print $1}}')
+lvdisplay "$KAIROS_DEVICE" > /dev/null 2>&1
+KAIROS_LV_RC=$?
+echo '@@kairos lvdisplay_rc'; echo $KAIROS_LV_RC
+if [ $KAIROS_LV_RC -eq 0 ]; then
+    echo '@@kairos pvs'; pvs 2> /dev/null
+    echo '@@kairos sanlun'; sanlun lun show -p 2> /dev/null
+fi
+"""
+
+
+def _split_probe_output(output):
+    sections = dict()
+    current = None
+    lines = list()
+    for line in output.split('\n'):
+        if line.startswith('@@kairos '):
+            if current is not None:
+                sections[current] = '\n'.join(lines).strip()
+            current = line[len('@@kairos '):].strip()
+            lines = list()
+        elif current is not None:
+            lines.append(line)
+    if current is not None:
+        sections[current] = '\n'.join(lines).strip()
+    return sections
+
+
+def _parse_sanlun_paths(output):
+    # -- sanlun lun show -p prints one block per LUN starting with its "ONTAP Path" line. Every block is indexed by
+    #    the device names found in it, the same way grep -B4 <device> used to find it.
+    luns = dict()
+    blocks = list()
+    for line in output.split('\n'):
+        if 'ONTAP Path:' in line:
+            blocks.append(list())
+        if len(blocks) > 0:
+            blocks[-1].append(line.strip())
+
+    for block in blocks:
+        ontap_path = block[0].split(':')
+        lun = dict()
+        lun['svm-name'] = ontap_path[1].strip()
+        lun['volume'] = ontap_path[2].split('/')[2].strip()
+        lun['lun-name'] = ontap_path[2].split('/')[3].strip()
+        for line in block[1:5]:
+            if line.startswith('LUN:'):
+                lun['lun-id'] = int(line.split(':')[1].strip())
+        for line in block[1:5]:
+            for word in re.split(r'[\s:()]+', line):
+                if len(word) > 0 and word not in luns:
+                    luns[word] = lun
+
+    return luns
@@ -1,74 +1,439 @@
 #!/usr/bin/env python2
 
+import Queue
 import logging
+import multiprocessing as mp
+import os
 import pymongo
 import pymongo.errors
+import signal
 import threading
 import daemon
 import daemon.pidfile
+from bson.son import SON
 from datetime import datetime
+from time import sleep, time
+from kairoslib.arch_layout import ArchLayout, STATS_INDEXES
 from kairoslib.catalog import Catalog
+from pymongo import UpdateOne
 
 LOGGER = logging.getLogger(__name__)
 
 
+class ArchiveWriter:
+    # -- Buffers change events and writes them to the archive repository with unordered insert_many. A batch is
+    #    flushed when it reaches batch_size events or when its oldest event has waited flush_interval seconds. The
+    #    buffer never grows past batch_size: the producer stops reading the change stream until a full batch has
+    #    been written, which is what keeps memory bounded when the archive repository is slower than the source.
+    def __init__(self, catalog_sess=None, layout=None, batch_size=500, flush_interval=1.0):
+        self.catalog_sess = catalog_sess
+        self.layout = layout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.buffer = list()
+        self.buffer_since = None
+
+        # -- resume token of the last event known to be in the archive repository
+        self.durable_token = None
+
+        self.started_at = time()
+        self.ops_written = 0
+        self.flushes = 0
+        self.last_flush_at = None
+        self.lag = None
+
+    def add(self, op=None):
+        if len(self.buffer) == 0:
+            self.buffer_since = time()
+        self.buffer.append(op)
+
+    def full(self):
+        return len(self.buffer) >= self.batch_size
+
+    def due(self):
+        return len(self.buffer) > 0 and (self.full() or time() - self.buffer_since >= self.flush_interval)
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return True
+
+        # -- A batch spans several archive collections when it crosses a bucket boundary
+        batches = dict()
+        for op in self.buffer:
+            batches.setdefault(self.layout.collection_for(op['created_at']), list()).append(op)
+
+        try:
+            for coll_name in sorted(batches.keys()):
+                self.layout.ensure_indexes(coll_name=coll_name)
+                inserted = self.catalog_sess.add_many(coll_name=coll_name, docs=batches[coll_name])
+                # -- Batches are removed once written, so a retry after a partial failure is not rolled up twice
+                del batches[coll_name]
+                self._roll_up(inserted)
+        except pymongo.errors.PyMongoError, e:
+            LOGGER.error('Could not write {} operations to the archive repository: {}'.format(len(self.buffer), e))
+            self.buffer = [op for op in self.buffer if self.layout.collection_for(op['created_at']) in batches]
+            return False
+
+        last_op = self.buffer[-1]
+        self.durable_token = last_op['_id']
+        if 'clusterTime' in last_op:
+            self.lag = time() - last_op['clusterTime'].time
+
+        self.ops_written += len(self.buffer)
+        self.flushes += 1
+        self.last_flush_at = time()
+        self.buffer = list()
+        self.buffer_since = None
+        return True
+
+    def _roll_up(self, ops):
+        # -- Per minute counters per (db, coll, operation type) with the first and last created_at, which is what
+        #    the 'operations' subcommand reports on. Written after the operations themselves: a failure here only
+        #    costs accuracy of the reports, never archived operations.
+        rollups = dict()
+        for op in ops:
+            ns = op.get('ns', {})
+            minute = op['created_at'].replace(second=0, microsecond=0)
+            key = (minute, ns.get('db'), ns.get('coll'), op['operationType'])
+            if key not in rollups:
+                rollups[key] = {'count': 0, 'first': op['created_at'], 'last': op['created_at']}
+            rollups[key]['count'] += 1
+            rollups[key]['first'] = min(rollups[key]['first'], op['created_at'])
+            rollups[key]['last'] = max(rollups[key]['last'], op['created_at'])
+
+        if len(rollups) == 0:
+            return
+
+        requests = list()
+        for (minute, db, coll, op_type), rollup in rollups.items():
+            requests.append(UpdateOne({'_id': SON([('minute', minute), ('db', db), ('coll', coll),
+                                                   ('op', op_type)])},
+                                      {'$inc': {'count': rollup['count']},
+                                       '$min': {'first': rollup['first']},
+                                       '$max': {'last': rollup['last']}},
+                                      upsert=True))
+        # -- Rollups only cover what was archived from 'since' on, older operations are read from the archive
+        requests.append(UpdateOne({'_id': 'meta'}, {'$min': {'since': min([op['created_at'] for op in ops])}},
+                                  upsert=True))
+
+        try:
+            self.layout.ensure_indexes(coll_name=self.layout.stats_collection(), indexes=STATS_INDEXES)
+            self.catalog_sess.bulk_write(coll_name=self.layout.stats_collection(), requests=requests)
+        except pymongo.errors.PyMongoError, e:
+            LOGGER.error('Could not update operation statistics: {}'.format(e))
+
+    def discard(self):
+        # -- Events not written yet are read again from the change stream after resuming from durable_token
+        self.buffer = list()
+        self.buffer_since = None
+
+    def stats(self):
+        elapsed = time() - self.started_at
+        stats = dict()
+        stats['ops_written'] = self.ops_written
+        stats['flushes'] = self.flushes
+        stats['buffered'] = len(self.buffer)
+        stats['throughput'] = self.ops_written / elapsed if elapsed > 0 else 0.0
+        stats['avg_batch'] = float(self.ops_written) / self.flushes if self.flushes > 0 else 0.0
+        stats['lag'] = self.lag
+        stats['last_flush_at'] = self.last_flush_at
+        return stats
+
+
 class Producer(threading.Thread):
-    def __init__(self, cluster_name=None, mongodb_uri=None, database=None, collection=None, archiver_repo_uri=None,
-                 archiver_repo_dbname=None):
+    # -- stream_mode 'collection' watches a single collection (collections holds one name). stream_mode 'database'
+    #    opens one change stream on the whole database, filtered on the server by a $match on the collection list,
+    #    so a single cursor and connection serve every archived collection.
+    def __init__(self, cluster_name=None, mongodb_uri=None, database=None, collections=None, archiver_repo_uri=None,
+                 archiver_repo_dbname=None, batch_size=500, flush_interval=1.0, stats_interval=60,
+                 stream_mode='collection', bucket=None):
         threading.Thread.__init__(self)
         self.cluster_name = cluster_name
         self.mongodb_uri = mongodb_uri
         self.database = database
-        self.collection = collection
+        self.collections = collections
+        self.stats_interval = stats_interval
+        self.stream_mode = stream_mode
+        self.stop_event = threading.Event()
+        self.started_at = time()
+        self.ns_counts = dict([(coll, 0) for coll in self.collections])
 
         self.archiver_repo_uri = archiver_repo_uri
         self.archiver_repo_dbname = archiver_repo_dbname
 
-        self.archiver_repo_sess = Catalog(repo_uri=self.archiver_repo_uri, repo_name=self.archiver_repo_dbname)
-        self.archiver_repo_sess.connect()
+        self.archiver_repo_sess = None
+        self.mongo_sess = None
+        self.collec_cursor = None
+        try:
+            self.archiver_repo_sess = Catalog(repo_uri=self.archiver_repo_uri, repo_name=self.archiver_repo_dbname)
+            self.archiver_repo_sess.connect()
+
+            self.layout = ArchLayout(catalog_sess=self.archiver_repo_sess, cluster_name=self.cluster_name,
+                                     bucket=bucket)
+            self.writer = ArchiveWriter(catalog_sess=self.archiver_repo_sess, layout=self.layout,
+                                        batch_size=batch_size, flush_interval=flush_interval)
 
-        l_invalid_op = self.archiver_repo_sess.find_one(coll_name=self.cluster_name,
-                                                        query={'ns.db': self.database,
-                                                               'ns.coll': self.collection,
-                                                               'operationType': 'invalidate'},
-                                                        ordered=[('_id', pymongo.DESCENDING)])
+            # -- Readers (recover, operations) query the archive before the first flush, so the unbucketed
+            #    collection and the statistics get their indexes right away; buckets are indexed when they are
+            #    first written to
+            if self.layout.bucket is None or self.cluster_name in self.archiver_repo_sess.list_collections():
+                self.layout.ensure_indexes(coll_name=self.cluster_name)
+            self.layout.ensure_indexes(coll_name=self.layout.stats_collection(), indexes=STATS_INDEXES)
 
-        l_valid_op = self.archiver_repo_sess.find_one(coll_name=self.cluster_name,
-                                                      query={'ns.db': self.database, 'ns.coll': self.collection},
-                                                      ordered=[('_id', pymongo.DESCENDING)])
+            # -- Invalidate events are tagged by _route: with the collection in collection mode, with the database
+            #    only in database mode
+            if self.stream_mode == 'database':
+                invalid_query = {'ns.db': self.database, 'ns.coll': {'$exists': False}, 'operationType': 'invalidate'}
+            else:
+                invalid_query = {'ns.db': self.database, 'ns.coll': {'$in': self.collections},
+                                 'operationType': 'invalidate'}
+            l_invalid_op = self._find_last_op(query=invalid_query)
+
+            l_valid_op = self._find_last_op(query={'ns.db': self.database, 'ns.coll': {'$in': self.collections}})
+
+            self.mongo_sess = pymongo.MongoClient(self.mongodb_uri, connect=True)
+
+            if l_invalid_op is None and l_valid_op is not None:
+                self.writer.durable_token = l_valid_op['_id']
+
+            self.collec_cursor = self._open_stream(resume_after=self.writer.durable_token)
+        except Exception:
+            # -- The supervisor retries a producer that cannot start, its connections must not pile up
+            self.close()
+            raise
+
+    def _find_last_op(self, query=None):
+        # -- Newest archive collections first, the first one holding a matching operation has the last one
+        for coll_name in reversed(self.layout.collections_in_window()):
+            last_op = self.archiver_repo_sess.find_one(coll_name=coll_name, query=query,
+                                                       ordered=[('_id', pymongo.DESCENDING)])
+            if last_op is not None:
+                return last_op
+        return None
 
-        self.mongo_sess = pymongo.MongoClient(self.mongodb_uri, connect=True)
+    def _watch_target(self):
         db = self.mongo_sess[self.database]
-        self.watching_collec = db[self.collection]
+        if self.stream_mode == 'database':
+            pipeline = [{'$match': {'$or': [{'ns.coll': {'$in': self.collections}},
+                                            {'operationType': {'$in': ['dropDatabase', 'invalidate']}}]}}]
+            return db, pipeline
+        else:
+            return db[self.collections[0]], None
 
-        if l_invalid_op is None:
-            if l_valid_op is None:
-                self.collec_cursor = self.watching_collec.watch(full_document='updateLookup')
-            else:
-                self.collec_cursor = self.watching_collec.watch(resume_after=l_valid_op['_id'],
-                                                                full_document='updateLookup')
+    def _open_stream(self, resume_after=None):
+        watching, pipeline = self._watch_target()
+        # -- max_await_time_ms bounds how long try_next() blocks, so a partial batch is flushed on time even when
+        #    the collection is idle
+        max_await = int(self.writer.flush_interval * 1000)
+        if resume_after is None:
+            return watching.watch(pipeline=pipeline, full_document='updateLookup', max_await_time_ms=max_await)
         else:
-                self.collec_cursor = self.watching_collec.watch(full_document='updateLookup')
+            return watching.watch(pipeline=pipeline, resume_after=resume_after, full_document='updateLookup',
+                                  max_await_time_ms=max_await)
+
+    def _reopen_stream(self):
+        # -- Whatever could not be written is dropped and read again by resuming after the last durable token.
+        #    Replayed events already in the archive are skipped by add_many (duplicate _id).
+        if not self.writer.flush():
+            self.writer.discard()
+        try:
+            self.collec_cursor = self._open_stream(resume_after=self.writer.durable_token)
+        except pymongo.errors.OperationFailure, e:
+            # -- The token is no longer in the oplog (or belongs to an invalidated stream): start from now on
+            LOGGER.error('Cannot resume the change stream on {}: {}'.format(self.name_space(), e))
+            self.writer.durable_token = None
+            self.collec_cursor = self._open_stream()
+
+    def _route(self, op):
+        # -- Events of a database stream carry their own namespace; invalidate events carry none and are tagged
+        #    with the namespace(s) this producer is responsible for.
+        if op['operationType'] == 'invalidate':
+            op['ns'] = dict()
+            op['ns']['db'] = self.database
+            if self.stream_mode != 'database':
+                op['ns']['coll'] = self.collections[0]
+        elif 'ns' in op and op['ns'].get('coll') in self.ns_counts:
+            self.ns_counts[op['ns']['coll']] += 1
+
+    def name_space(self):
+        if self.stream_mode == 'database':
+            return '{}.* ({} collections)'.format(self.database, len(self.collections))
+        else:
+            return '{}.{}'.format(self.database, self.collections[0])
+
+    def _log_stats(self):
+        stats = self.writer.stats()
+        LOGGER.info('Archiver {}: {} ops written in {} flushes ({:.1f} ops/s, avg batch {:.1f}), lag {}s'.format(
+            self.name_space(), stats['ops_written'], stats['flushes'], stats['throughput'],
+            stats['avg_batch'], '{:.1f}'.format(stats['lag']) if stats['lag'] is not None else 'n/a'))
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        if self.collec_cursor is not None:
+            self.collec_cursor.close()
+        if self.mongo_sess is not None:
+            self.mongo_sess.close()
+        if self.archiver_repo_sess is not None and self.archiver_repo_sess.session is not None:
+            self.archiver_repo_sess.close()
 
     def run(self):
-        while True:
+        try:
+            self._stream()
+        finally:
+            # -- Also when the producer dies: the supervisor starts a new one with its own connections
+            self.close()
+
+    def _stream(self):
+        last_stats = time()
+        while not self.stop_event.is_set():
             try:
-                op = next(self.collec_cursor)
-                if op['operationType'] == 'invalidate':
-                    op['ns'] = dict()
-                    op['ns']['db'] = self.database
-                    op['ns']['coll'] = self.collection
-                op['created_at'] = datetime.now()
-                self.archiver_repo_sess.add(coll_name=self.cluster_name, doc=op)
-            except (StopIteration, pymongo.errors.OperationFailure):
-                db = self.mongo_sess[self.database]
-                self.watching_collec = db[self.collection]
-                self.collec_cursor = self.watching_collec.watch(full_document='updateLookup')
+                op = self.collec_cursor.try_next()
+                if op is not None:
+                    self._route(op)
+                    op['created_at'] = datetime.now()
+                    self.writer.add(op)
+
+                if self.writer.due():
+                    while not self.writer.flush():
+                        if not self.writer.full():
+                            break
+                        # -- A full batch that cannot be written stops the stream until the repository is back
+                        sleep(self.writer.flush_interval)
+
+                if op is not None and op['operationType'] == 'invalidate':
+                    # -- The stream is over and cannot be resumed: everything must be on disk before starting anew
+                    while not self.writer.flush():
+                        sleep(self.writer.flush_interval)
+                    self.writer.durable_token = None
+                    self._reopen_stream()
+
+                if time() - last_stats >= self.stats_interval:
+                    self._log_stats()
+                    last_stats = time()
+
+            except (StopIteration, pymongo.errors.OperationFailure, pymongo.errors.ConnectionFailure):
+                self._reopen_stream()
+
+        # -- Graceful stop: write what is still buffered, the next start resumes after it
+        for attempt in range(3):
+            if self.writer.flush():
+                break
+            sleep(self.writer.flush_interval)
+        self._log_stats()
+
+
+class ChildSupervisor:
+    # -- Keeps a set of children (producer threads or worker processes) alive. factory(unit) builds and starts the
+    #    child for a unit of work; a child that dies, or cannot be started, is started again after an exponential
+    #    backoff.
+    def __init__(self, factory=None, units=None, name=None, supervise_interval=5, restart_backoff=1,
+                 restart_backoff_max=300):
+        self.factory = factory
+        self.name = name
+        self.supervise_interval = supervise_interval
+        self.restart_backoff = restart_backoff
+        self.restart_backoff_max = restart_backoff_max
+
+        self.slots = list()
+        for unit in units:
+            self.slots.append({'unit': unit, 'child': None, 'started_at': None, 'restarts': 0, 'failures': 0,
+                               'next_start': 0})
+
+    def _start(self, slot):
+        try:
+            slot['child'] = self.factory(slot['unit'])
+            slot['started_at'] = time()
+        except Exception, e:
+            LOGGER.error('Cannot start {} for {}: {}'.format(self.name, slot['unit'], e))
+            self._schedule_restart(slot)
+
+    def _schedule_restart(self, slot):
+        slot['child'] = None
+        slot['failures'] += 1
+        delay = min(self.restart_backoff * (2 ** (slot['failures'] - 1)), self.restart_backoff_max)
+        slot['next_start'] = time() + delay
+        LOGGER.info('{} for {} will be restarted in {}s.'.format(self.name, slot['unit'], delay))
+
+    def supervise(self):
+        for slot in self.slots:
+            child = slot['child']
+            if child is None:
+                if time() >= slot['next_start']:
+                    if slot['failures'] > 0:
+                        slot['restarts'] += 1
+                    self._start(slot)
+            elif not child.is_alive():
+                LOGGER.error('{} for {} has died.'.format(self.name, slot['unit']))
+                self._schedule_restart(slot)
+            elif slot['failures'] > 0 and time() - slot['started_at'] >= self.restart_backoff_max:
+                # -- Stable again, the next crash starts over from the shortest backoff
+                slot['failures'] = 0
+
+    def next_wakeup(self):
+        wakeup = self.supervise_interval
+        for slot in self.slots:
+            if slot['child'] is None:
+                wakeup = min(wakeup, slot['next_start'] - time())
+        return max(wakeup, 0)
+
+    def alive(self, slot):
+        return slot['child'] is not None and slot['child'].is_alive()
+
+    def shutdown(self, timeout=30):
+        for slot in self.slots:
+            if slot['child'] is not None:
+                slot['child'].stop()
+        for slot in self.slots:
+            if slot['child'] is not None:
+                slot['child'].join(timeout=timeout)
+
+
+class ArchiverWorker(mp.Process):
+    # -- Worker process of a multiprocess archiver. It runs its own producers (own MongoClients, own writers and
+    #    resume tokens) for its share of the stream groups, and reports their stats to the parent through the
+    #    control queue. The parent asks it to stop through stop_event.
+    def __init__(self, app=None, worker_id=None, groups=None, control_queue=None, report_interval=10):
+        mp.Process.__init__(self, name='{}-worker-{}'.format(app.archiver_name, worker_id))
+        self.app = app
+        self.worker_id = worker_id
+        self.groups = groups
+        self.control_queue = control_queue
+        self.report_interval = report_interval
+        self.stop_event = mp.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _report(self, producers, state='running'):
+        self.control_queue.put({'worker': self.worker_id, 'pid': os.getpid(), 'state': state,
+                                'producers': self.app.producers_status(producers), 'at': datetime.now()})
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop_event.set())
+        producers = self.app.new_producer_supervisor(self.groups)
+
+        last_report = 0
+        while not self.stop_event.is_set():
+            producers.supervise()
+            if time() - last_report >= self.report_interval:
+                self._report(producers)
+                last_report = time()
+            self.stop_event.wait(producers.next_wakeup())
+
+        producers.shutdown(timeout=max(30, self.app.flush_interval * 5))
+        self._report(producers, state='stopped')
+        self.control_queue.close()
+        self.control_queue.join_thread()
 
 
 class AppKairosAPTR:
     def __init__(self, cluster_name=None, database_name=None, collections=None, mongodb_uri=None, archiver_name=None,
-                 archive_repo_uri=None, archive_repo_name=None):
+                 archive_repo_uri=None, archive_repo_name=None, batch_size=500, flush_interval=1.0,
+                 stream_mode='collection', catalog_uri=None, catalog_name=None, heartbeat_interval=30,
+                 supervise_interval=5, restart_backoff=1, restart_backoff_max=300, workers=1, bucket=None):
         self.cluster_name = cluster_name
         self.archiver_name = archiver_name
         self.mongodb_uri = mongodb_uri
@@ -77,26 +442,165 @@ class AppKairosAPTR:
         self.pidfilepath = '/tmp/kairosAPITR_' + self.cluster_name + '_' + self.archiver_name + '.pid'
         self.archive_repo_uri = archive_repo_uri
         self.archive_repo_name = archive_repo_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stream_mode = stream_mode
+        self.catalog_uri = catalog_uri
+        self.catalog_name = catalog_name
+        self.heartbeat_interval = heartbeat_interval
+        self.supervise_interval = supervise_interval
+        self.restart_backoff = restart_backoff
+        self.restart_backoff_max = restart_backoff_max
+        self.workers = workers
+        self.bucket = bucket
+        self.catalog_sess = None
+        self.stopping = False
 
         self.pidfile = daemon.pidfile.PIDLockFile(self.pidfilepath)
-        self.context = daemon.DaemonContext(detach_process=True, pidfile=self.pidfile)
+        self.context = daemon.DaemonContext(detach_process=True, pidfile=self.pidfile,
+                                            signal_map={signal.SIGTERM: self._handle_sigterm})
+
+    def _handle_sigterm(self, signum, frame):
+        # -- Only flags the supervisor; the signal interrupts its sleep and the shutdown runs from the main loop
+        self.stopping = True
+
+    def _stream_groups(self):
+        if self.stream_mode == 'database':
+            # -- One database wide stream per worker, each one matching its own share of the collections
+            n_streams = max(min(self.workers, len(self.collections)), 1)
+            return [self.collections[i::n_streams] for i in range(n_streams)]
+        else:
+            return [[coll] for coll in self.collections]
+
+    def _new_producer(self, collections):
+        producer = Producer(cluster_name=self.cluster_name, mongodb_uri=self.mongodb_uri,
+                            database=self.database_name, collections=collections,
+                            archiver_repo_uri=self.archive_repo_uri,
+                            archiver_repo_dbname=self.archive_repo_name,
+                            batch_size=self.batch_size, flush_interval=self.flush_interval,
+                            stream_mode=self.stream_mode, bucket=self.bucket)
+        producer.setDaemon(True)
+        producer.start()
+        return producer
+
+    def new_producer_supervisor(self, groups):
+        return ChildSupervisor(factory=self._new_producer, units=groups, name='Producer',
+                               supervise_interval=self.supervise_interval, restart_backoff=self.restart_backoff,
+                               restart_backoff_max=self.restart_backoff_max)
+
+    @staticmethod
+    def producers_status(producers):
+        status = list()
+        for slot in producers.slots:
+            producer_hb = dict()
+            producer_hb['collections'] = slot['unit']
+            producer_hb['restarts'] = slot['restarts']
+            producer_hb['alive'] = producers.alive(slot)
+            if slot['child'] is not None:
+                producer_hb['stats'] = slot['child'].writer.stats()
+            status.append(producer_hb)
+        return status
+
+    def _heartbeat(self, workers, state='running'):
+        try:
+            self.catalog_sess.edit(coll_name='archivers', query={'cluster_name': self.cluster_name,
+                                                                 'archiver_name': self.archiver_name},
+                                   update={'$set': {'heartbeat': {'at': datetime.now(), 'pid': os.getpid(),
+                                                                  'state': state, 'workers': workers}}})
+        except pymongo.errors.PyMongoError, e:
+            LOGGER.error('Cannot write the archiver heartbeat: {}'.format(e))
+
+    def _run_in_process(self):
+        producers = self.new_producer_supervisor(self._stream_groups())
+
+        def worker_status(state):
+            return [{'worker': 0, 'pid': os.getpid(), 'state': state, 'alive': True, 'restarts': 0,
+                     'producers': self.producers_status(producers)}]
+
+        last_heartbeat = 0
+        while not self.stopping:
+            producers.supervise()
+            if time() - last_heartbeat >= self.heartbeat_interval:
+                self._heartbeat(worker_status('running'))
+                last_heartbeat = time()
+            sleep(producers.next_wakeup())
+
+        LOGGER.info('{} is stopping, flushing buffered operations.'.format(self.archiver_name))
+        producers.shutdown(timeout=max(30, self.flush_interval * 5))
+        self._heartbeat(worker_status('stopped'), state='stopped')
+
+    def _run_workers(self):
+        groups = self._stream_groups()
+        n_workers = min(self.workers, len(groups))
+        control_queue = mp.Queue()
+        reports = dict()
+
+        def new_worker(worker_id):
+            worker = ArchiverWorker(app=self, worker_id=worker_id, groups=groups[worker_id::n_workers],
+                                    control_queue=control_queue,
+                                    report_interval=min(self.heartbeat_interval, 10))
+            worker.start()
+            return worker
+
+        workers = ChildSupervisor(factory=new_worker, units=range(n_workers), name='Worker',
+                                  supervise_interval=self.supervise_interval, restart_backoff=self.restart_backoff,
+                                  restart_backoff_max=self.restart_backoff_max)
+
+        def drain(timeout):
+            # -- Waiting on the control queue is also how the supervisor sleeps between checks
+            try:
+                report = control_queue.get(timeout=timeout)
+                reports[report['worker']] = report
+                while True:
+                    report = control_queue.get_nowait()
+                    reports[report['worker']] = report
+            except Queue.Empty:
+                pass
+            except (IOError, OSError):
+                # -- interrupted by SIGTERM
+                pass
+
+        def worker_status():
+            status = list()
+            for slot in workers.slots:
+                worker_hb = reports.get(slot['unit'], {'worker': slot['unit'], 'producers': []}).copy()
+                worker_hb['alive'] = workers.alive(slot)
+                worker_hb['restarts'] = slot['restarts']
+                status.append(worker_hb)
+            return status
+
+        last_heartbeat = 0
+        while not self.stopping:
+            workers.supervise()
+            if time() - last_heartbeat >= self.heartbeat_interval:
+                self._heartbeat(worker_status())
+                last_heartbeat = time()
+            drain(workers.next_wakeup())
+
+        LOGGER.info('{} is stopping its {} workers.'.format(self.archiver_name, n_workers))
+        for slot in workers.slots:
+            if slot['child'] is not None:
+                slot['child'].stop()
+        deadline = time() + max(60, self.flush_interval * 10)
+        while time() < deadline and len([slot for slot in workers.slots if workers.alive(slot)]) > 0:
+            drain(1)
+        drain(0)
+        workers.shutdown(timeout=1)
+        self._heartbeat(worker_status(), state='stopped')
 
     def start(self):
         logging.info('{} has been started for cluster {}'.format(self.archiver_name, self.cluster_name))
         with self.context:
-            producers = list()
-            for coll in self.collections:
-                producers.append(Producer(cluster_name=self.cluster_name, mongodb_uri=self.mongodb_uri,
-                                          database=self.database_name, collection=coll,
-                                          archiver_repo_uri=self.archive_repo_uri,
-                                          archiver_repo_dbname=self.archive_repo_name))
-
-            for producer in producers:
-                producer.setDaemon(True)
-                producer.start()
-
-            while True:
-                pass
+            # -- MongoClient is not fork safe, the catalog session is opened once the daemon is detached
+            self.catalog_sess = Catalog(repo_uri=self.catalog_uri, repo_name=self.catalog_name)
+            self.catalog_sess.connect()
+
+            if self.workers > 1:
+                self._run_workers()
+            else:
+                self._run_in_process()
+
+            self.catalog_sess.close()
 
     def get_pidfilename(self):
         return self.pidfilepath
@@ -2,11 +2,16 @@
 """ONTAP Module :: Connect and execute admin tasks on FAS and AFF systems
 """
 
+import logging
+import threading
+from concurrency import run_parallel
 from NaServer import NaServer, NaElement
+from time import sleep, time
 
 
 class ClusterSession:
-    def __init__(self, cluster_ip, user, password, vserver=None):
+    def __init__(self, cluster_ip, user, password, vserver=None, registry=None):
+        self.registry = registry
         self.server = NaServer(cluster_ip, 1, 100)
         self.server.set_server_type('FILER')
         self.server.set_transport_type('HTTP')
@@ -20,7 +25,15 @@ class ClusterSession:
         return self.server.get_vserver()
 
     def run_command(self, api):
-        return self.server.invoke_elem(api)
+        output = self.server.invoke_elem(api)
+        if self.registry is not None and _is_auth_failure(output):
+            logging.warning('Authentication failed on SVM {}, reloading its credentials.'.format(self.get_vserver()))
+            if self.registry.refresh(self):
+                output = self.server.invoke_elem(api)
+        return output
+
+    def set_credentials(self, user, password):
+        self.server.set_admin_user(user, password)
 
     def get_nodes(self):
         api_call = NaElement('cluster-node-get-iter')
@@ -38,6 +51,96 @@ class ClusterSession:
             return nodes_list
 
 
+class ClusterSessionRegistry:
+    # -- Hands out one ClusterSession per SVM for the whole run. Credentials are read from the ntapsystems
+    #    collection once, through loader (a callable returning the ntapsystems documents), and read again only when
+    #    ONTAP rejects them.
+    def __init__(self, loader=None):
+        self.loader = loader
+        self.credentials = None
+        self.sessions = dict()
+        self.lock = threading.Lock()
+
+    def _load_credentials(self):
+        self.credentials = dict()
+        for ntapsys in self.loader():
+            if 'svm-name' in ntapsys:
+                self.credentials[ntapsys['svm-name']] = ntapsys
+
+    def get(self, svm_name):
+        with self.lock:
+            if svm_name in self.sessions:
+                return self.sessions[svm_name]
+
+            loaded = False
+            if self.credentials is None:
+                self._load_credentials()
+                loaded = True
+
+            svm_info = self.credentials.get(svm_name)
+            if svm_info is None and not loaded:
+                # -- The SVM may have been registered after the credentials were read
+                self._load_credentials()
+                svm_info = self.credentials.get(svm_name)
+            if svm_info is None:
+                return None
+
+            session = ClusterSession(svm_info['netapp-ip'], svm_info['username'], svm_info['password'],
+                                     svm_info['svm-name'], registry=self)
+            self.sessions[svm_name] = session
+            return session
+
+    def refresh(self, session):
+        # -- Returns True when new credentials were found for the session's SVM and applied to it
+        svm_name = session.get_vserver()
+        with self.lock:
+            stale = self.credentials.get(svm_name) if self.credentials is not None else None
+            self._load_credentials()
+            svm_info = self.credentials.get(svm_name)
+
+            if svm_info is None or (stale is not None and stale['username'] == svm_info['username'] and
+                                    stale['password'] == svm_info['password']):
+                self.sessions.pop(svm_name, None)
+                return False
+
+            session.set_credentials(svm_info['username'], svm_info['password'])
+            return True
+
+
+def _get_iter(svm, api_name, query=None, max_records=500):
+    # -- Runs a *-get-iter call and follows next-tag until every page has been read
+    records = list()
+    tag = None
+    while True:
+        api_call = NaElement(api_name)
+        api_call.child_add_string('max-records', max_records)
+        if query is not None:
+            api_query = NaElement('query')
+            api_query.child_add(query)
+            api_call.child_add(api_query)
+        if tag is not None:
+            api_call.child_add_string('tag', tag)
+
+        output = svm.run_command(api_call)
+        if output.results_status() == 'failed':
+            return output.results_status(), output.results_reason()
+
+        attributes = output.child_get('attributes-list')
+        if attributes is not None:
+            records.extend(attributes.children_get())
+
+        tag = output.child_get_string('next-tag')
+        if tag is None:
+            return output.results_status(), records
+
+
+def _is_auth_failure(output):
+    if output.results_status() != 'failed':
+        return False
+    reason = str(output.results_reason())
+    return '401' in reason or 'Unauthorized' in reason or 'Authorization failed' in reason
+
+
 class Aggregate:
     def __init__(self, aggr_spec):
         self.node_name = aggr_spec['node-name']
@@ -342,6 +445,13 @@ class Snapshot:
         return output.results_status(), output.sprintf()
 
     def cgcreate(self, svm):
+        output = self.cg_start(svm)
+        if output[0] == 'passed':
+            return self.cg_commit(svm)
+        else:
+            return output
+
+    def cg_start(self, svm):
         api_cgstart = NaElement('cg-start')
         api_cgstart.child_add_string('snapshot', self.snapname)
         api_cgstart.child_add_string('timeout', self.cgtimeout)
@@ -352,14 +462,14 @@ class Snapshot:
 
         output = svm.run_command(api_cgstart)
         if output.results_status() == 'passed':
-            get_cgid = output.sprintf()
-            self.cgid = get_cgid[get_cgid.find('id>')+3:get_cgid.find('</cg')]
-            api_cgcommit = NaElement('cg-commit')
-            api_cgcommit.child_add_string('cg-id', self.cgid)
-            output_cgcommit = svm.run_command(api_cgcommit)
-            return output_cgcommit.results_status(), output_cgcommit.sprintf()
-        else:
-            return output.results_status(), output.sprintf()
+            self.cgid = output.child_get_string('cg-id')
+        return output.results_status(), output.sprintf()
+
+    def cg_commit(self, svm):
+        api_cgcommit = NaElement('cg-commit')
+        api_cgcommit.child_add_string('cg-id', self.cgid)
+        output_cgcommit = svm.run_command(api_cgcommit)
+        return output_cgcommit.results_status(), output_cgcommit.sprintf()
 
     def get_snaps(self, svm):
         api_call = NaElement('snapshot-get-iter')
@@ -403,4 +513,352 @@ class FlexClone:
         api_call.child_add_string('parent-snapshot', self.parent_snapshot)
 
         output = svm.run_command(api_call)
-        return output.results_status(), output.sprintf()
\ No newline at end of file
+        return output.results_status(), output.sprintf()
+
+    def create_async(self, svm):
+        api_call = NaElement('volume-clone-create-async')
+        api_call.child_add_string('volume', self.volume)
+        api_call.child_add_string('parent-volume', self.parent_volume)
+        api_call.child_add_string('parent-snapshot', self.parent_snapshot)
+
+        output = svm.run_command(api_call)
+        if output.results_status() == 'failed':
+            return output.results_status(), output.results_reason()
+        return output.results_status(), output.child_get_string('result-jobid')
+
+
+class CgSnapshotCoordinator:
+    # -- Takes a set of CG snapshots as one cluster wide consistency point: every cg-start is issued at the same
+    #    time, and only when all the write fences are in place every cg-commit is issued, again at the same time.
+    #    members is a list of (label, Snapshot, svm session) tuples.
+    def __init__(self, members=None):
+        self.members = members
+        self.fence_window = None
+
+    def _run_phase(self, indexes, phase):
+        # -- Results are keyed by the member index, labels are only used for logging and may be shared by members
+        #    running on the same host
+        tasks = list()
+        for index in indexes:
+            label, snapshot, svm = self.members[index]
+            tasks.append((index, getattr(snapshot, phase), {'svm': svm}))
+
+        results = dict()
+        for task in run_parallel(tasks=tasks):
+            if task.ok():
+                results[task.key] = task.result
+            else:
+                results[task.key] = ('failed', str(task.error))
+        return results
+
+    def run(self):
+        """Returns (passed, results), results being a list of (label, result) tuples."""
+        # -- Phase 1 :: fencing writes on every member
+        fence_start = time()
+        start_results = self._run_phase(range(len(self.members)), 'cg_start')
+        fenced = [index for index in sorted(start_results.keys()) if start_results[index][0] == 'passed']
+
+        # -- Phase 2 :: committing every member. When a cg-start failed the members that got fenced are still
+        #    committed, so their write fences are released right away, and then rolled back.
+        commit_results = self._run_phase(fenced, 'cg_commit')
+        self.fence_window = time() - fence_start
+
+        failures = list()
+        for index in range(len(self.members)):
+            if start_results[index][0] != 'passed':
+                failures.append((self.members[index][0], start_results[index]))
+            elif commit_results[index][0] != 'passed':
+                failures.append((self.members[index][0], commit_results[index]))
+
+        if len(failures) > 0:
+            committed = [self.members[index] for index in fenced if commit_results[index][0] == 'passed']
+            self._rollback(committed)
+            return False, failures
+
+        return True, [(self.members[index][0], commit_results[index]) for index in range(len(self.members))]
+
+    def _rollback(self, members):
+        tasks = list()
+        for label, snapshot, svm in members:
+            for volume in snapshot.volume:
+                snap_spec = dict()
+                snap_spec['volume'] = volume
+                snap_spec['snapname'] = snapshot.snapname
+                tasks.append((label, Snapshot(snap_spec).delete, {'svm': svm}))
+
+        for task in run_parallel(tasks=tasks, max_workers=8):
+            if not task.ok() or task.result[0] != 'passed':
+                logging.error('Could not roll back CG snapshot on member {}.'.format(task.key))
+            else:
+                logging.info('CG snapshot on member {} has been rolled back.'.format(task.key))
+
+
+class AsyncJobTracker:
+    # -- Follows ONTAP async jobs (the result-jobid of *-async calls) with one job-get-iter query per poll,
+    #    whatever the number of jobs being tracked.
+    def __init__(self, svm=None, poll_interval=1, timeout=1800):
+        self.svm = svm
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.jobs = dict()
+
+    def add(self, job_id=None, label=None):
+        self.jobs[job_id] = label
+
+    def wait(self):
+        results = dict()
+        pending = dict(self.jobs)
+        deadline = time() + self.timeout
+        while len(pending) > 0:
+            job_info = NaElement('job-info')
+            job_info.child_add_string('job-id', '|'.join(pending.keys()))
+            status, records = _get_iter(self.svm, 'job-get-iter', query=job_info)
+            if status == 'failed':
+                for job_id, label in pending.items():
+                    results[label] = ('failed', records)
+                break
+
+            for record in records:
+                job_id = record.child_get_string('job-id')
+                job_state = record.child_get_string('job-state')
+                if job_id in pending and job_state in ('success', 'failure', 'error', 'dead', 'quit'):
+                    label = pending.pop(job_id)
+                    if job_state == 'success':
+                        results[label] = ('passed', job_state)
+                    else:
+                        results[label] = ('failed', record.child_get_string('job-completion'))
+
+            if len(pending) == 0:
+                break
+            if time() > deadline:
+                for job_id, label in pending.items():
+                    results[label] = ('failed', 'Timed out waiting for job {}.'.format(job_id))
+                break
+            sleep(self.poll_interval)
+
+        self.jobs = dict()
+        return results
+
+
+class ProvisioningBatch:
+    # -- Storage side of the clone members living on one SVM, over the SVM's single session: every initiator group
+    #    is created (and its initiator added) at the same time, then every FlexClone is created at the same time with
+    #    volume-clone-create-async and the jobs are followed together, then every LUN is mapped at the same time.
+    #    A member whose igroup or FlexClone failed is left out of the following steps.
+    def __init__(self, svm=None, max_workers=8):
+        self.svm = svm
+        self.max_workers = max_workers
+        self.igroups = list()
+        self.clones = list()
+        self.lun_maps = list()
+
+    def add_igroup(self, label=None, igroup=None, initiator=None):
+        self.igroups.append((label, igroup, initiator))
+
+    def add_clone(self, label=None, flexclone=None):
+        self.clones.append((label, flexclone))
+
+    def add_lun_map(self, label=None, lun=None):
+        self.lun_maps.append((label, lun))
+
+    def _create_igroup(self, igroup=None, initiator=None):
+        result = igroup.create(svm=self.svm)
+        if result[0] == 'failed':
+            return result
+        return igroup.add_initiators(svm=self.svm, initiator_list=initiator)
+
+    def _run_step(self, tasks, failures, action):
+        # -- tasks are ((label, item), callable, kwargs). Returns (label, item, result) for the calls that passed,
+        #    the first failure of every label goes to failures.
+        passed = list()
+        for task in run_parallel(tasks=tasks, max_workers=self.max_workers):
+            label, item = task.key
+            if not task.ok():
+                failures.setdefault(label, 'Failed to {} {}: {}'.format(action, item, task.error))
+            elif task.result[0] == 'failed':
+                failures.setdefault(label, 'Failed to {} {}: {}'.format(action, item, task.result[1]))
+            else:
+                passed.append((label, item, task.result))
+        return passed
+
+    def run(self):
+        """Returns a {label: (status, reason)} dict with one entry per label added to the batch."""
+        failures = dict()
+        labels = set([igroup[0] for igroup in self.igroups] + [clone[0] for clone in self.clones] +
+                     [lun_map[0] for lun_map in self.lun_maps])
+
+        tasks = list()
+        for label, igroup, initiator in self.igroups:
+            tasks.append(((label, igroup.initiator_group_name), self._create_igroup,
+                          {'igroup': igroup, 'initiator': initiator}))
+        for label, igroup_name, result in self._run_step(tasks, failures, 'set up initiator group'):
+            logging.info('Initiator group {} has been created on SVM {}.'.format(igroup_name, self.svm.get_vserver()))
+
+        tasks = list()
+        for label, flexclone in self.clones:
+            if label not in failures:
+                tasks.append(((label, flexclone.volume), flexclone.create_async, {'svm': self.svm}))
+        tracker = AsyncJobTracker(svm=self.svm)
+        for label, volume, result in self._run_step(tasks, failures, 'create flexclone'):
+            if result[1] is None:
+                logging.info('FlexClone {} has been created.'.format(volume))
+            else:
+                tracker.add(job_id=result[1], label=(label, volume))
+        for (label, volume), result in tracker.wait().items():
+            if result[0] == 'failed':
+                failures.setdefault(label, 'Failed to create flexclone {}: {}'.format(volume, result[1]))
+            else:
+                logging.info('FlexClone {} has been created.'.format(volume))
+
+        tasks = list()
+        for label, lun in self.lun_maps:
+            if label not in failures:
+                tasks.append(((label, lun.path), lun.mapping, {'svm': self.svm}))
+        for label, path, result in self._run_step(tasks, failures, 'map LUN'):
+            logging.info('LUN {} has been mapped.'.format(path))
+
+        results = dict()
+        for label in labels:
+            if label in failures:
+                results[label] = ('failed', failures[label])
+            else:
+                results[label] = ('passed', None)
+        return results
+
+
+class VolumeBulkDestroy:
+    # -- Destroys many volumes of the same SVM: their state comes from a single (paged) volume-get-iter, every
+    #    online volume is taken offline with volume-offline-async, then every offline volume is destroyed with
+    #    volume-destroy-async, the jobs of each step being followed together. Volumes that no longer exist count as
+    #    destroyed and offline volumes skip the offline step, so a destroy that was interrupted can be run again.
+    def __init__(self, svm=None, volumes=None):
+        self.svm = svm
+        self.volumes = volumes
+
+    def get_states(self):
+        vol_id = NaElement('volume-id-attributes')
+        vol_id.child_add_string('name', '|'.join(self.volumes))
+        vol_attrs = NaElement('volume-attributes')
+        vol_attrs.child_add(vol_id)
+        status, records = _get_iter(self.svm, 'volume-get-iter', query=vol_attrs)
+        if status == 'failed':
+            return status, records
+
+        states = dict()
+        for record in records:
+            name = record.child_get('volume-id-attributes').child_get_string('name')
+            state_attrs = record.child_get('volume-state-attributes')
+            states[name] = state_attrs.child_get_string('state') if state_attrs is not None else None
+        return status, states
+
+    def _submit(self, api_name=None, volume=None):
+        api_call = NaElement(api_name)
+        api_call.child_add_string('volume-name', volume)
+        if api_name == 'volume-destroy-async':
+            api_call.child_add_string('force', True)
+
+        output = self.svm.run_command(api_call)
+        if output.results_status() == 'failed':
+            return output.results_status(), output.results_reason()
+        return output.results_status(), output.child_get_string('result-jobid')
+
+    def _run_step(self, api_name, volumes, max_workers, results):
+        tasks = list()
+        for volume in volumes:
+            tasks.append((volume, self._submit, {'api_name': api_name, 'volume': volume}))
+
+        passed = list()
+        tracker = AsyncJobTracker(svm=self.svm)
+        for task in run_parallel(tasks=tasks, max_workers=max_workers):
+            if not task.ok():
+                results[task.key] = ('failed', str(task.error))
+            elif task.result[0] == 'failed':
+                results[task.key] = task.result
+            elif task.result[1] is None:
+                passed.append(task.key)
+            else:
+                tracker.add(job_id=task.result[1], label=task.key)
+
+        for volume, result in tracker.wait().items():
+            if result[0] == 'failed':
+                results[volume] = result
+            else:
+                passed.append(volume)
+        return passed
+
+    def destroy(self, max_workers=8):
+        results = dict()
+        status, states = self.get_states()
+        if status == 'failed':
+            return dict([(volume, (status, states)) for volume in self.volumes])
+
+        for volume in self.volumes:
+            if volume not in states:
+                results[volume] = ('passed', 'absent')
+
+        online = [volume for volume in self.volumes if volume in states and states[volume] != 'offline']
+        offline = [volume for volume in self.volumes if volume in states and states[volume] == 'offline']
+        offline.extend(self._run_step('volume-offline-async', online, max_workers, results))
+
+        for volume in self._run_step('volume-destroy-async', offline, max_workers, results):
+            results[volume] = ('passed', 'destroyed')
+        return results
+
+
+class SnapshotBulkDelete:
+    # -- Deletes one snapshot from many volumes of the same SVM: the busy state of every volume's snapshot comes
+    #    from a single (paged) snapshot-get-iter, the deletes are submitted concurrently and their async jobs are
+    #    followed together.
+    def __init__(self, svm=None, snapname=None, volumes=None):
+        self.svm = svm
+        self.snapname = snapname
+        self.volumes = volumes
+
+    def get_busy(self):
+        snap_info = NaElement('snapshot-info')
+        snap_info.child_add_string('volume', '|'.join(self.volumes))
+        snap_info.child_add_string('name', self.snapname)
+        status, records = _get_iter(self.svm, 'snapshot-get-iter', query=snap_info)
+        if status == 'failed':
+            return status, records
+
+        busy = dict()
+        for record in records:
+            busy[record.child_get_string('volume')] = record.child_get_string('busy') == 'true'
+        return status, busy
+
+    def _submit_delete(self, volume=None, rate_limiter=None):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        api_call = NaElement('snapshot-delete-async')
+        api_call.child_add_string('volume', volume)
+        api_call.child_add_string('snapshot', self.snapname)
+
+        output = self.svm.run_command(api_call)
+        if output.results_status() == 'failed':
+            return output.results_status(), output.results_reason()
+        return output.results_status(), output.child_get_string('result-jobid')
+
+    def delete(self, volumes=None, max_workers=8, rate_limiter=None):
+        if volumes is None:
+            volumes = self.volumes
+
+        tasks = list()
+        for volume in volumes:
+            tasks.append((volume, self._submit_delete, {'volume': volume, 'rate_limiter': rate_limiter}))
+
+        results = dict()
+        tracker = AsyncJobTracker(svm=self.svm)
+        for task in run_parallel(tasks=tasks, max_workers=max_workers):
+            if not task.ok():
+                results[task.key] = ('failed', str(task.error))
+            elif task.result[0] == 'failed':
+                results[task.key] = task.result
+            elif task.result[1] is None:
+                results[task.key] = ('passed', None)
+            else:
+                tracker.add(job_id=task.result[1], label=task.key)
+
+        results.update(tracker.wait())
+        return results
@@ -4,17 +4,43 @@ import logging
 import pymongo
 import pymongo.errors
 import multiprocessing as mp
+from bson import BSON
+from datetime import datetime
+from kairoslib.catalog import Catalog
+from pymongo import DeleteOne, InsertOne, ReplaceOne
+from pymongo.write_concern import WriteConcern
 
 LOGGER = logging.getLogger(__name__)
 
 
 class RecoverConsumer(mp.Process):
-    def __init__(self, arch_queue=None, dest_cluster_uri=None):
+    # -- Applies recovered operations with unordered bulk writes. Operations are grouped per namespace and
+    #    coalesced per document id (the last one wins); every namespace is flushed together once batch_size
+    #    operations are pending, and only then are the queue items they came from marked as done.
+    def __init__(self, arch_queue=None, dest_cluster_uri=None, batch_size=1000, write_concern=None,
+                 stats_queue=None, checkpoint=None):
         mp.Process.__init__(self)
         self.dest_cluster = dest_cluster_uri
         self.arch_queue = arch_queue
+        self.batch_size = batch_size
+        self.write_concern = write_concern
+        self.stats_queue = stats_queue
         self.conn = None
 
+        # checkpoint: {'repo_uri', 'repo_name', 'recover_id', 'partition'}; after every flush the last operation
+        # applied by this consumer is saved there so an interrupted recovery can be resumed
+        self.checkpoint = checkpoint
+        self.checkpoint_sess = None
+        self.last_op = None
+        # set once a batch had failed operations: the checkpoint must not move past them, so a resumed run
+        # replays them
+        self.checkpoint_held = False
+
+        self.pending = dict()
+        self.pending_ops = 0
+        self.pending_items = 0
+        self.stats = dict()
+
     def run(self):
         # While using multiprocessing, pymongo doesn't recommend to open up a connection before a fork.
         # Opening a connection after fork
@@ -23,24 +49,129 @@ class RecoverConsumer(mp.Process):
         except pymongo.errors.ConnectionFailure, e:
             LOGGER.error(e)
             exit(1)
-        while not self.arch_queue.empty():
-            # Get a document from the queue
-            recover_doc = self.arch_queue.get()
+
+        if self.checkpoint is not None:
+            self.checkpoint_sess = Catalog(repo_uri=self.checkpoint['repo_uri'], repo_name=self.checkpoint['repo_name'])
+            self.checkpoint_sess.connect()
+
+        while True:
+            # Get a batch of documents from the queue, None means there is nothing left to recover
+            recover_batch = self.arch_queue.get()
+            if recover_batch is None:
+                self.flush()
+                self.arch_queue.task_done()
+                break
+
+            for recover_doc in recover_batch:
+                self.add(recover_doc)
+            self.pending_items += 1
+
+            if self.pending_ops >= self.batch_size:
+                self.flush()
+
+        if self.stats_queue is not None:
+            self.stats_queue.put(('consumer', self.stats))
+        self.conn.close()
+        if self.checkpoint_sess is not None:
+            self.checkpoint_sess.close()
+
+    def add(self, recover_doc):
+        namespace = (recover_doc['_id']['dbname'], recover_doc['_id']['collname'])
+        if namespace not in self.pending:
+            self.pending[namespace] = dict()
+        doc_key = self._doc_key(recover_doc['_id']['doc_id'])
+        if doc_key not in self.pending[namespace]:
+            self.pending_ops += 1
+        self.pending[namespace][doc_key] = (recover_doc['_id']['doc_id'], recover_doc['lastOp'])
+        self.last_op = {'bucket': recover_doc.get('bucket'), 'op_id': recover_doc['lastOp']['op_id']}
+
+    @staticmethod
+    def _doc_key(doc_id):
+        # Compound _id values are documents, which cannot be used as dict keys
+        try:
+            hash(doc_id)
+            return doc_id
+        except TypeError:
+            return BSON.encode({'_id': doc_id})
+
+    def save_checkpoint(self):
+        if self.checkpoint_sess is None or self.last_op is None or self.checkpoint_held:
+            return
+
+        applied = sum([ns_stats['applied'] for ns_stats in self.stats.values()])
+        failed = sum([ns_stats['failed'] for ns_stats in self.stats.values()])
+        try:
+            self.checkpoint_sess.edit(coll_name='recover_checkpoints',
+                                      query={'_id': '{}:{}'.format(self.checkpoint['recover_id'],
+                                                                   self.checkpoint['partition'])},
+                                      update={'$set': {'recover_id': self.checkpoint['recover_id'],
+                                                       'partition': self.checkpoint['partition'],
+                                                       'bucket': self.last_op['bucket'],
+                                                       'op_id': self.last_op['op_id'],
+                                                       'updated_at': datetime.now()},
+                                              '$inc': {'applied': applied - self.checkpoint.get('saved_applied', 0),
+                                                       'failed': failed - self.checkpoint.get('saved_failed', 0)}},
+                                      upsert=True)
+            self.checkpoint['saved_applied'] = applied
+            self.checkpoint['saved_failed'] = failed
+        except pymongo.errors.PyMongoError, e:
+            LOGGER.error('Cannot save recover checkpoint for partition {}: {}'.format(self.checkpoint['partition'], e))
+
+    @staticmethod
+    def _request(doc_id, last_op):
+        if last_op['op_type'] == 'insert':
+            return InsertOne(last_op['full_doc'])
+        elif last_op['op_type'] == 'update' or last_op['op_type'] == 'replace':
+            if last_op['full_doc'] is None:
+                # The document was already gone when the archiver looked it up, there is nothing to write
+                return None
+            return ReplaceOne({'_id': last_op['full_doc']['_id']}, last_op['full_doc'], upsert=True)
+        elif last_op['op_type'] == 'delete':
+            return DeleteOne({'_id': doc_id})
+        return None
+
+    def _coll(self, namespace):
+        coll = self.conn[namespace[0]][namespace[1]]
+        if self.write_concern is not None:
+            coll = coll.with_options(write_concern=WriteConcern(w=self.write_concern))
+        return coll
+
+    def flush(self):
+        for namespace in self.pending.keys():
+            requests = [self._request(doc_id, last_op) for doc_id, last_op in self.pending[namespace].values()]
+            requests = [request for request in requests if request is not None]
+            if len(requests) == 0:
+                continue
+
+            failed = 0
+            try:
+                self._coll(namespace).bulk_write(requests, ordered=False)
+            except pymongo.errors.BulkWriteError, e:
+                # An insert of a document that is already there is not a failure, the document is recovered
+                write_errors = [err for err in e.details['writeErrors'] if err['code'] != 11000]
+                failed = len(write_errors)
+                for err in write_errors[:5]:
+                    LOGGER.error('{}.{}: {}'.format(namespace[0], namespace[1], err['errmsg']))
+            except pymongo.errors.PyMongoError, e:
+                LOGGER.error('{}.{}: {}'.format(namespace[0], namespace[1], e))
+                failed = len(requests)
+
+            ns_name = '{}.{}'.format(namespace[0], namespace[1])
+            if ns_name not in self.stats:
+                self.stats[ns_name] = {'applied': 0, 'failed': 0}
+            self.stats[ns_name]['applied'] += len(requests) - failed
+            self.stats[ns_name]['failed'] += failed
+            if failed > 0 and not self.checkpoint_held and self.checkpoint is not None:
+                # The checkpoint saved by the previous flush is the last one before the failed operations
+                self.checkpoint_held = True
+                LOGGER.error('Partition {} keeps its checkpoint before the failed operations.'.format(
+                    self.checkpoint['partition']))
+
+        self.pending = dict()
+        self.pending_ops = 0
+        self.save_checkpoint()
+
+        # The queue items are done only once their operations have been written
+        for item in range(self.pending_items):
             self.arch_queue.task_done()
-            # Set the database to the one specified in the recover document
-            db = self.conn[recover_doc['_id']['dbname']]
-
-            # Set the collection to the one specified in the recover document
-            coll = db[recover_doc['_id']['collname']]
-
-            # Perform the operation according to the op_type specified in the recover document
-            if recover_doc['lastOp']['op_type'] == 'insert':
-                try:
-                    coll.insert_one(document=recover_doc['lastOp']['full_doc'])
-                except pymongo.errors.DuplicateKeyError, e:
-                    LOGGER.debug(e)
-            elif recover_doc['lastOp']['op_type'] == 'update':
-                coll.replace_one(filter={'_id': recover_doc['lastOp']['full_doc']['_id']},
-                                 replacement=recover_doc['lastOp']['full_doc'], upsert=True)
-            elif recover_doc['lastOp']['op_type'] == 'delete':
-                coll.delete_one(filter={'_id': recover_doc['_id']['doc_id']})
+        self.pending_items = 0
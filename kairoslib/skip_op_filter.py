@@ -0,0 +1,88 @@
+#!/usr/bin/env python2
+
+import json
+import logging
+from bson import json_util
+from datetime import datetime
+
+LOGGER = logging.getLogger(__name__)
+
+RULE_KEYS = ['namespace', 'op_types', 'doc_ids', 'from', 'until']
+OP_TYPES = ['insert', 'update', 'replace', 'delete', 'drop', 'rename', 'dropDatabase', 'invalidate']
+
+
+class SkipOpFilter:
+    # -- Operations to leave out of a recovery, from the --advanced-recover file:
+    #
+    #    {"skip": [{"namespace": "sales.orders", "op_types": ["delete"]},
+    #              {"namespace": "sales.*", "from": "2019-05-01 10:00:00", "until": "2019-05-01 10:05:00"},
+    #              {"namespace": "sales.customers", "doc_ids": [{"$oid": "5cc9c2d1e4b0a1b2c3d4e5f6"}, 42]}]}
+    #
+    #    Every key of a rule is optional but a rule needs at least one; an operation is skipped when it matches
+    #    all the keys of any rule. The rules are compiled into a $nor on the archived operations, so the
+    #    aggregation filters them on the archive repository and they are never sent to kairos. doc_ids use
+    #    MongoDB extended JSON for non JSON types.
+    def __init__(self, skip_cfg=None):
+        self.rules = list()
+        if skip_cfg is None:
+            return
+
+        if not isinstance(skip_cfg.get('skip', []), list):
+            LOGGER.error('Skip operations config: "skip" must be a list of rules.')
+            exit(1)
+
+        for rule in skip_cfg.get('skip', []):
+            self.rules.append(self._compile(rule))
+
+    @staticmethod
+    def _parse_date(rule_key, value):
+        for date_fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f']:
+            try:
+                return datetime.strptime(value, date_fmt)
+            except ValueError:
+                pass
+        LOGGER.error('Skip operations config: invalid date and time "{}" for {}.'.format(value, rule_key))
+        exit(1)
+
+    def _compile(self, rule):
+        unknown = [key for key in rule.keys() if key not in RULE_KEYS]
+        if len(unknown) > 0:
+            LOGGER.error('Skip operations config: unknown keys {} in rule {}.'.format(', '.join(unknown), rule))
+            exit(1)
+        if len(rule.keys()) == 0:
+            LOGGER.error('Skip operations config: empty rules would skip every operation.')
+            exit(1)
+
+        condition = dict()
+        if 'namespace' in rule:
+            # -- 'db', 'db.*' or 'db.coll'
+            ns = rule['namespace'].split('.', 1)
+            condition['ns.db'] = ns[0]
+            if len(ns) == 2 and ns[1] != '*':
+                condition['ns.coll'] = ns[1]
+
+        if 'op_types' in rule:
+            invalid = [op_type for op_type in rule['op_types'] if op_type not in OP_TYPES]
+            if len(invalid) > 0:
+                LOGGER.error('Skip operations config: unknown operation types {}.'.format(', '.join(invalid)))
+                exit(1)
+            condition['operationType'] = {'$in': rule['op_types']}
+
+        if 'doc_ids' in rule:
+            condition['documentKey._id'] = {'$in': [json_util.loads(json.dumps(doc_id))
+                                                    for doc_id in rule['doc_ids']]}
+
+        if 'from' in rule or 'until' in rule:
+            condition['created_at'] = dict()
+            if 'from' in rule:
+                condition['created_at']['$gte'] = self._parse_date('from', rule['from'])
+            if 'until' in rule:
+                condition['created_at']['$lte'] = self._parse_date('until', rule['until'])
+
+        return condition
+
+    def match(self):
+        # -- Condition to add to the $match of the recovery aggregation, None when nothing is skipped
+        if len(self.rules) == 0:
+            return None
+        return {'$nor': self.rules}
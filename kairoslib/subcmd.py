@@ -3,19 +3,27 @@
 import logging
 import multiprocessing as mp
 import multiprocessing.queues
-import xml.dom.minidom
+import Queue
 
+from kairoslib.arch_layout import ArchLayout
 from arch_temp_data import ArchTempData
+from bson import json_util
+from catalog import Catalog
+from clone_teardown import CloneTeardown
+from concurrency import run_parallel, DependencyScheduler, TaskPool
 from datetime import datetime, timedelta
-from host_conn import HostConn
+from host_conn import HOST_CONN_POOL, CommandMux
 from kairoslib.kairos_aptr import AppKairosAPTR
 from mongodbcluster import MongoDBCluster
-from ontap import ClusterSession, Snapshot, FlexClone, InitiatorGroup, Lun, Volume
+from ontap import ClusterSession, ClusterSessionRegistry, Snapshot, FlexClone, InitiatorGroup, Lun, CgSnapshotCoordinator
+from ontap import ProvisioningBatch, SnapshotBulkDelete
 from psutil import Process
 from pymongo import MongoClient, errors
 from recover_consumer import RecoverConsumer
+from skip_op_filter import SkipOpFilter
 from sys import exit
-from time import sleep, time
+from threading import BoundedSemaphore, Lock
+from time import time
 
 
 class SubCmdMongodb:
@@ -139,28 +147,8 @@ class SubCmdBackup:
         topology = mdbcluster.get_topology()
         logging.info(self.backup['cluster-name'] + ' is a ' + topology['cluster_type'] + ' cluster.')
 
-        if topology['cluster_type'] == 'replSet':
-            for rs_member in topology['members']:
-                if rs_member['stateStr'] == 'PRIMARY' or rs_member['stateStr'] == 'SECONDARY':
-                    host = HostConn(ipaddr=rs_member['name'].split(':')[0], username=self.backup['username'])
-                    rs_member['storage_info'] = host.get_storage_layout(cluster_info['mongodb-mongod-conf'])
-                    host.close()
-                    logging.info('Collecting info about host {}'.format(rs_member['name'].split(':')[0]))
-
-        elif topology['cluster_type'] == 'sharded':
-            for cs_member in topology['config_servers']:
-                if cs_member['stateStr'] == 'PRIMARY' or cs_member['stateStr'] == 'SECONDARY':
-                    host = HostConn(ipaddr=cs_member['name'].split(':')[0], username=self.backup['username'])
-                    cs_member['storage_info'] = host.get_storage_layout(cluster_info['mongodb-mongod-conf'])
-                    host.close()
-                    logging.info('Collecting info about config server {}'.format(cs_member['name'].split(':')[0]))
-            for shard_replset in topology['shards']:
-                for shard_member in shard_replset['shard_members']:
-                    if shard_member['stateStr'] == 'PRIMARY' or shard_member['stateStr'] == 'SECONDARY':
-                        host = HostConn(ipaddr=shard_member['name'].split(':')[0], username=self.backup['username'])
-                        shard_member['storage_info'] = host.get_storage_layout(cluster_info['mongodb-mongod-conf'])
-                        host.close()
-                        logging.info('Collecting info about shard member {}'.format(shard_member['name'].split(':')[0]))
+        # -- Collecting storage layout from every data bearing member concurrently
+        bkp_metadata['discovery'] = self._discover_storage(topology, cluster_info['mongodb-mongod-conf'])
 
         snapshot_list = list()
         if topology['cluster_type'] == 'replSet':
@@ -208,33 +196,42 @@ class SubCmdBackup:
 
                         snapshot_list.append(per_server_cg)
 
-        # -- If sharded cluster, stopping the balancer before taking any snapshot
-        if topology['cluster_type'] == 'sharded':
-            mdbcluster.stop_balancer()
-
-        # -- Creating CG snapshots
+        # -- Preparing one CG snapshot per member, with its SVM session, before the balancer gets stopped
         # -- -- Connecting to kairos_repo to get the storage credentials
-        kdb_netapp = kdb_session['ntapsystems']
+        svm_sessions = ClusterSessionRegistry(loader=lambda: kdb_session['ntapsystems'].find())
 
+        cg_members = list()
         for cgsnapshot in snapshot_list:
-            svm_info = kdb_netapp.find_one({'svm-name': cgsnapshot['svm-name']})
-            cs_svm = ClusterSession(svm_info['netapp-ip'], svm_info['username'], svm_info['password'], svm_info['svm-name'])
-            cgsnap = Snapshot(cgsnapshot)
-            result = cgsnap.cgcreate(cs_svm)
-            if result[0] == 'passed':
-                logging.info('CG Snapshot of member {} has been successfully taken.'.format(cgsnapshot['member_name']))
-            else:
-                #TODO: Rollback backup operation by deleting other volumes snapshots
-                logging.error('CG Snapshot of member {} has failed.'.format(cgsnapshot['member_name']))
-                logging.error(result[1])
-                if topology['cluster_type'] == 'sharded':
-                    mdbcluster.start_balancer()
+            cs_svm = svm_sessions.get(cgsnapshot['svm-name'])
+            if cs_svm is None:
+                logging.error('Cannot find SVM {} in the netapp repository collection.'.format(cgsnapshot['svm-name']))
                 exit(1)
+            cg_members.append((cgsnapshot['member_name'], Snapshot(cgsnapshot), cs_svm))
+
+        # -- If sharded cluster, stopping the balancer before taking any snapshot
+        if topology['cluster_type'] == 'sharded':
+            mdbcluster.stop_balancer()
+
+        # -- Creating CG snapshots :: cg-start on every member, then cg-commit on every member
+        cg_coordinator = CgSnapshotCoordinator(members=cg_members)
+        cg_passed, cg_results = cg_coordinator.run()
 
         # -- If sharded cluster, starting the balancer after taking a snapshot
         if topology['cluster_type'] == 'sharded':
             mdbcluster.start_balancer()
 
+        if not cg_passed:
+            for member_name, result in cg_results:
+                logging.error('CG Snapshot of member {} has failed.'.format(member_name))
+                logging.error(result[1])
+            exit(1)
+
+        for member_name, result in cg_results:
+            logging.info('CG Snapshot of member {} has been successfully taken.'.format(member_name))
+        logging.info('Write fences held for {:.2f} seconds across {} members.'.format(cg_coordinator.fence_window,
+                                                                                      len(cg_members)))
+        bkp_metadata['cg_fence_window'] = cg_coordinator.fence_window
+
         # -- Saving backup metadata to the repository database
         bkp_metadata['created_at'] = datetime.now()
         bkp_metadata['backup_name'] = self.backup['backup-name']
@@ -284,46 +281,46 @@ class SubCmdBackup:
                             else:
                                 delete_list[vol['svm-name']].append(vol['volume'])
 
-        # -- Checking if the snapshot is ready to be deleted across all volumes
-        kdb_netapp = kdb_session['ntapsystems']
+        # -- Checking if the snapshot is ready to be deleted across all volumes :: one query per SVM
+        svm_sessions = ClusterSessionRegistry(loader=lambda: kdb_session['ntapsystems'].find())
+        bulk_deletes = dict()
         for svm in delete_list.keys():
-            svm_info = kdb_netapp.find_one({'svm-name': svm})
-            cs_svm = ClusterSession(svm_info['netapp-ip'], svm_info['username'], svm_info['password'],
-                                    svm_info['svm-name'])
-            for volume in delete_list[svm]:
-                snapspec = dict()
-                snapspec['volume'] = volume
-                snapspec['snapname'] = bkp2delete['backup_name']
-                snapshot = Snapshot(snapspec)
-                result_getsnap = snapshot.get_snaps(cs_svm)
-                if result_getsnap[0] == 'passed':
-                    xmloutput = xml.dom.minidom.parseString(result_getsnap[1])
-                    snap_busy = xmloutput.getElementsByTagName('busy')[0].firstChild.data
-
-                    if snap_busy == 'false':
-                        logging.info('Snapshot ' + snapspec['snapname'] + ' from volume ' + snapspec['volume'] +
-                                     ' passed the inspection to be deleted.')
-                    else:
-                        logging.error('Snapshot ' + snapspec['snapname'] + ' from volume ' + snapspec['volume'] +
-                                      ' is busy and cannot be deleted.')
-                        exit(1)
+            svm_session = svm_sessions.get(svm)
+            if svm_session is None:
+                logging.error('Cannot find SVM {} in the netapp repository collection.'.format(svm))
+                exit(1)
+            bulk_deletes[svm] = SnapshotBulkDelete(svm=svm_session, snapname=bkp2delete['backup_name'],
+                                                   volumes=delete_list[svm])
+            result_getsnap = bulk_deletes[svm].get_busy()
+            if result_getsnap[0] == 'failed':
+                logging.error('Could not get snapshot ' + bkp2delete['backup_name'] + ' state on SVM ' + svm + '.')
+                logging.error(result_getsnap[1])
+                exit(1)
 
-        # -- Deleting snapshot across all volumes
-        kdb_netapp = kdb_session['ntapsystems']
-        for svm in delete_list.keys():
-            svm_info = kdb_netapp.find_one({'svm-name': svm})
-            cs_svm = ClusterSession(svm_info['netapp-ip'], svm_info['username'], svm_info['password'],
-                                    svm_info['svm-name'])
+            snap_busy = result_getsnap[1]
             for volume in delete_list[svm]:
-                snapspec = dict()
-                snapspec['volume'] = volume
-                snapspec['snapname'] = bkp2delete['backup_name']
-                snapshot = Snapshot(snapspec)
-                delete_result = snapshot.delete(cs_svm)
+                if volume not in snap_busy:
+                    logging.warning('Snapshot ' + bkp2delete['backup_name'] + ' not found on volume ' + volume + '.')
+                elif snap_busy[volume]:
+                    logging.error('Snapshot ' + bkp2delete['backup_name'] + ' from volume ' + volume +
+                                  ' is busy and cannot be deleted.')
+                    exit(1)
+                else:
+                    logging.info('Snapshot ' + bkp2delete['backup_name'] + ' from volume ' + volume +
+                                 ' passed the inspection to be deleted.')
+            bulk_deletes[svm].volumes = [volume for volume in delete_list[svm] if volume in snap_busy]
+
+        # -- Deleting snapshot across all volumes :: every SVM at once, deletes submitted concurrently per SVM
+        tasks = [(svm, bulk_deletes[svm].delete, {}) for svm in bulk_deletes.keys()]
+        for task in run_parallel(tasks=tasks):
+            if not task.ok():
+                logging.error('Failed to delete snapshot ' + bkp2delete['backup_name'] + ' on SVM ' + task.key + '.')
+                continue
+            for volume, delete_result in task.result.items():
                 if delete_result[0] == 'passed':
-                    logging.info('Snapshot ' + snapspec['snapname'] + ' has been deleted from volume ' + snapspec['volume'])
+                    logging.info('Snapshot ' + bkp2delete['backup_name'] + ' has been deleted from volume ' + volume)
                 else:
-                    logging.error('Failed to delete snapshot ' + snapspec['snapname'] + ' on volume ' + snapspec['volume'] + '.')
+                    logging.error('Failed to delete snapshot ' + bkp2delete['backup_name'] + ' on volume ' + volume + '.')
 
         result_bkp2delete = kdb_bkps.delete_one({'backup_name': self.backup['backup-name']})
 
@@ -357,6 +354,59 @@ class SubCmdBackup:
                                                 bkp['retention'].strftime('%Y-%m-%d %H:%M:%S.%f')
                                                 )
 
+    def _discover_storage(self, topology, mongod_conf):
+        # -- Every data bearing member (replicaset members, config servers and shard members) gets its storage
+        #    layout collected on its own worker. The member document is updated in place with its storage_info.
+        members = list()
+        if topology['cluster_type'] == 'replSet':
+            for rs_member in topology['members']:
+                members.append(('host', rs_member))
+        elif topology['cluster_type'] == 'sharded':
+            for cs_member in topology['config_servers']:
+                members.append(('config server', cs_member))
+            for shard_replset in topology['shards']:
+                for shard_member in shard_replset['shard_members']:
+                    members.append(('shard member', shard_member))
+
+        tasks = list()
+        for role, member in members:
+            if member['stateStr'] == 'PRIMARY' or member['stateStr'] == 'SECONDARY':
+                tasks.append((member['name'], self._discover_member, {'role': role, 'member': member,
+                                                                      'mongod_conf': mongod_conf}))
+
+        discovery_workers = self.backup.get('discovery-workers', 8)
+        fail_fast = self.backup.get('discovery-fail-fast', True)
+
+        discovery_start = time()
+        results = run_parallel(tasks=tasks, max_workers=discovery_workers, fail_fast=fail_fast)
+        discovery_elapsed = time() - discovery_start
+
+        failed = [task for task in results if not task.ok()]
+        for task in failed:
+            logging.error('Could not collect storage layout from {}: {}'.format(task.key, task.error))
+        if len(failed) > 0:
+            exit(1)
+
+        discovery = dict()
+        discovery['workers'] = min(discovery_workers, len(tasks))
+        discovery['elapsed'] = discovery_elapsed
+        discovery['hosts'] = list()
+        for task in sorted(results, key=lambda task: task.key):
+            discovery['hosts'].append({'name': task.key, 'elapsed': task.elapsed})
+
+        logging.info('Storage layout collected from {} members in {:.2f} seconds.'.format(len(results),
+                                                                                         discovery_elapsed))
+        return discovery
+
+    def _discover_member(self, role=None, member=None, mongod_conf=None):
+        hostname = member['name'].split(':')[0]
+        host = HOST_CONN_POOL.get(ipaddr=hostname, username=self.backup['username'])
+        try:
+            member['storage_info'] = host.get_storage_layout(mongod_conf)
+        finally:
+            host.close()
+        logging.info('Collecting info about {} {}'.format(role, hostname))
+
     def _calc_retention(self, retention, created_at):
         unit = retention[len(retention)-1:]
         value = retention[:-1]
@@ -377,6 +427,7 @@ class SubCmdRestore:
         self.username = rst_spec['username']
         self.archive_repo_uri = rst_spec['archive_repo_uri']
         self.archive_repo_name = rst_spec['archive_repo_name']
+        self.svm_restore_workers = rst_spec.get('svm-restore-workers', 4)
 
     def restore(self, catalog_sess=None):
         bkp2restore = catalog_sess.find_one(coll_name='backups', query={'backup_name': self.backup_name,
@@ -386,301 +437,247 @@ class SubCmdRestore:
             logging.error('Backup {} could not be found for cluster {}.'.format(self.backup_name, self.cluster_name))
             exit(1)
 
-        # -- Preparation phase for ReplicaSet Cluster
-        if bkp2restore['mongo_topology']['cluster_type'] == 'replSet':
-            for rs_member in bkp2restore['mongo_topology']['members']:
-                host = HostConn(ipaddr=rs_member['name'].split(':')[0], username=self.username)
-                # -- Stopping mongod
-                stop_mongo = host.stop_service('mongod')
-                if stop_mongo[1] != 0:
-                    logging.error('Cannot stop MongoDB on host {}.'.format(rs_member['name'].split(':')[0]))
-                    exit(1)
-                else:
-                    logging.info('MongoDB has been stopped on host {}.'.format(rs_member['name'].split(':')[0]))
-
-                # -- For every data bearing node: umount, vgchange and multipath stop
-                if rs_member['stateStr'] == 'PRIMARY' or rs_member['stateStr'] == 'SECONDARY':
-                    umount_fs = host.umount_fs(fs_mountpoint=rs_member['storage_info']['mountpoint'])
-                    if umount_fs[1] != 0:
-                        logging.error('Cannot unmount MongoDB file system {}.'.format(rs_member['storage_info']['mountpoint']))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB file system {} has been successfully unmounted.'.format(rs_member['storage_info']['mountpoint']))
-
-                    vgchange = host.disable_vg(vg_name=rs_member['storage_info']['lvm_vgname'])
-                    if vgchange[1] != 0:
-                        logging.error('Cannot deactive volume group {}.'.format(rs_member['storage_info']['lvm_vgname']))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB volume group {} has been successfully disabled.'.format(rs_member['storage_info']['lvm_vgname']))
-
-                    multipath = host.stop_service('multipathd')
-                    if multipath[1] != 0:
-                       logging.error('Cannot stop multipathd on host {}.'.format(rs_member['name'].split(':')[0]))
-                       exit(1)
-                    else:
-                        logging.info('Multipathd has been successfully stopped on host {}.'.format(rs_member['name'].split(':')[0]))
-
-        # -- Preparation phase for Sharded Clusters
-        if bkp2restore['mongo_topology']['cluster_type'] == 'sharded':
-            for cs_member in bkp2restore['mongo_topology']['config_servers']:
-                host = HostConn(ipaddr=cs_member['name'].split(':')[0], username=self.username)
-                # -- Stopping mongod
-                stop_mongo = host.stop_service('mongod')
-                if stop_mongo[1] != 0:
-                    logging.error(
-                        'Cannot stop MongoDB on host {}.'.format(cs_member['name'].split(':')[0]))
-                    exit(1)
-                else:
-                    logging.info(
-                        'MongoDB has been stopped on host {}.'.format(cs_member['name'].split(':')[0]))
-
-                # -- For every data bearing node: umount, vgchange and multipath stop
-                if cs_member['stateStr'] == 'PRIMARY' or cs_member['stateStr'] == 'SECONDARY':
-                    umount_fs = host.umount_fs(fs_mountpoint=cs_member['storage_info']['mountpoint'])
-                    if umount_fs[1] != 0:
-                        logging.error('Cannot unmount MongoDB file system {}.'.format(
-                            cs_member['storage_info']['mountpoint']))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB file system {} has been successfully unmounted.'.format(
-                            cs_member['storage_info']['mountpoint']))
-
-                    vgchange = host.disable_vg(vg_name=cs_member['storage_info']['lvm_vgname'])
-                    if vgchange[1] != 0:
-                        logging.error('Cannot deactive volume group {}.'.format(
-                            cs_member['storage_info']['lvm_vgname']))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB volume group {} has been successfully disabled.'.format(
-                            cs_member['storage_info']['lvm_vgname']))
-
-                    multipath = host.stop_service('multipathd')
-                    if multipath[1] != 0:
-                        logging.error('Cannot stop multipathd on host {}.'.format(
-                            cs_member['name'].split(':')[0]))
-                        exit(1)
-                    else:
-                        logging.info('Multipathd has been successfully stopped on host {}.'.format(
-                            cs_member['name'].split(':')[0]))
+        members = self._restore_members(bkp2restore['mongo_topology'])
+        restore_start = time()
 
-            for shard_replset in bkp2restore['mongo_topology']['shards']:
-                for shard_member in shard_replset['shard_members']:
-                    host = HostConn(ipaddr=shard_member['name'].split(':')[0], username=self.username)
-                    # -- Stopping mongod
-                    stop_mongo = host.stop_service('mongod')
-                    if stop_mongo[1] != 0:
-                        logging.error(
-                            'Cannot stop MongoDB on host {}.'.format(shard_member['name'].split(':')[0]))
-                        exit(1)
-                    else:
-                        logging.info(
-                            'MongoDB has been stopped on host {}.'.format(shard_member['name'].split(':')[0]))
+        # -- Preparation phase :: every step runs on all members at the same time
+        self._prepare_members(members)
+        prepare_elapsed = time() - restore_start
 
-                    # -- For every data bearing node: umount, vgchange and multipath stop
-                    if shard_member['stateStr'] == 'PRIMARY' or shard_member['stateStr'] == 'SECONDARY':
-                        umount_fs = host.umount_fs(fs_mountpoint=shard_member['storage_info']['mountpoint'])
-                        if umount_fs[1] != 0:
-                            logging.error('Cannot unmount MongoDB file system {}.'.format(
-                                shard_member['storage_info']['mountpoint']))
-                            exit(1)
-                        else:
-                            logging.info('MongoDB file system {} has been successfully unmounted.'.format(
-                                shard_member['storage_info']['mountpoint']))
+        # -- Restore and post restore phases :: SnapRestore runs on every volume concurrently, and a member is
+        #    brought back up (multipathd, vgchange, mount, mongod) as soon as all of its volumes are restored.
+        timings = self._restore_and_start_members(members, catalog_sess)
+        timings['prepare'] = prepare_elapsed
+        timings['total'] = time() - restore_start
 
-                        vgchange = host.disable_vg(vg_name=shard_member['storage_info']['lvm_vgname'])
-                        if vgchange[1] != 0:
-                            logging.error('Cannot deactive volume group {}.'.format(
-                                shard_member['storage_info']['lvm_vgname']))
-                            exit(1)
-                        else:
-                            logging.info('MongoDB volume group {} has been successfully disabled.'.format(
-                                shard_member['storage_info']['lvm_vgname']))
+        print 'Restore timing breakdown'
+        print '  Preparation .........: {:8.2f}s'.format(timings['prepare'])
+        print '  SnapRestore .........: {:8.2f}s'.format(timings['snaprestore'])
+        print '  Post restore ........: {:8.2f}s'.format(timings['post_restore'])
+        print '  Total ...............: {:8.2f}s'.format(timings['total'])
 
-                        multipath = host.stop_service('multipathd')
-                        if multipath[1] != 0:
-                            logging.error('Cannot stop multipathd on host {}.'.format(
-                                shard_member['name'].split(':')[0]))
-                            exit(1)
-                        else:
-                            logging.info('Multipathd has been successfully stopped on host {}.'.format(
-                                shard_member['name'].split(':')[0]))
+        if timings['failed']:
+            logging.error('Restore of backup {} did not complete on every member.'.format(self.backup_name))
+            exit(1)
 
-        # -- Restore phase
-        snaprestore_list = dict()
-        if bkp2restore['mongo_topology']['cluster_type'] == 'replSet':
-            for rs_member in bkp2restore['mongo_topology']['members']:
-                if rs_member['stateStr'] == 'PRIMARY' or rs_member['stateStr'] == 'SECONDARY':
-                    for vol in rs_member['storage_info']['volume_topology']:
-                        if vol['svm-name'] not in snaprestore_list.keys():
-                            snaprestore_list[vol['svm-name']] = list()
-                            snaprestore_list[vol['svm-name']].append(vol['volume'])
-                        else:
-                            snaprestore_list[vol['svm-name']].append(vol['volume'])
+        # -- Housekeeping on backup's metadata
+        delete_newers = catalog_sess.remove_many(coll_name='backups', query={'created_at':
+                                                                                 { '$gt': bkp2restore['created_at']}})
+        # -- restore completed
+        logging.info('Restore operation has been completed.')
 
-        elif bkp2restore['mongo_topology']['cluster_type'] == 'sharded':
-            for cs_member in bkp2restore['mongo_topology']['config_servers']:
-                if cs_member['stateStr'] == 'PRIMARY' or cs_member['stateStr'] == 'SECONDARY':
-                    for vol in cs_member['storage_info']['volume_topology']:
-                        if vol['svm-name'] not in snaprestore_list.keys():
-                            snaprestore_list[vol['svm-name']] = list()
-                            snaprestore_list[vol['svm-name']].append(vol['volume'])
-                        else:
-                            snaprestore_list[vol['svm-name']].append(vol['volume'])
+    @staticmethod
+    def _restore_members(topology):
+        members = list()
+        if topology['cluster_type'] == 'replSet':
+            members.extend(topology['members'])
+        elif topology['cluster_type'] == 'sharded':
+            members.extend(topology['config_servers'])
+            for shard_replset in topology['shards']:
+                members.extend(shard_replset['shard_members'])
+        return members
+
+    def _run_on_members(self, hosts, members, submit, error_msg, info_msg):
+        mux = CommandMux()
+        futures = list()
+        for member in members:
+            futures.append((member, submit(hosts[member['name']], member, mux)))
+        mux.wait()
+
+        failed = False
+        for member, future in futures:
+            if future.result()[1] != 0:
+                logging.error(error_msg(member))
+                failed = True
+            else:
+                logging.info(info_msg(member))
+        if failed:
+            exit(1)
 
-            for shard_replset in bkp2restore['mongo_topology']['shards']:
-                for shard_member in shard_replset['shard_members']:
-                    if shard_member['stateStr'] == 'PRIMARY' or shard_member[
-                        'stateStr'] == 'SECONDARY':
-                        for vol in shard_member['storage_info']['volume_topology']:
-                            if vol['svm-name'] not in snaprestore_list.keys():
-                                snaprestore_list[vol['svm-name']] = list()
-                                snaprestore_list[vol['svm-name']].append(vol['volume'])
-                            else:
-                                snaprestore_list[vol['svm-name']].append(vol['volume'])
-
-        for svm in snaprestore_list.keys():
-            svm_info = catalog_sess.find_one(coll_name='ntapsystems', query={'svm-name': svm})
-            cs_svm = ClusterSession(svm_info['netapp-ip'], svm_info['username'], svm_info['password'],
-                                    svm_info['svm-name'])
-            for volume in snaprestore_list[svm]:
-                snapspec = dict()
-                snapspec['volume'] = volume
-                snapspec['snapname'] = self.backup_name
-                snapshot = Snapshot(snapspec)
-                restore_result = snapshot.restore(cs_svm)
-                if restore_result[0] == 'passed':
-                    logging.info('Snapshot ' + snapspec['snapname'] + ' has been restored on volume ' + snapspec['volume'])
+    def _prepare_members(self, members):
+        hosts = dict()
+        for member in members:
+            hosts[member['name']] = HOST_CONN_POOL.get(ipaddr=member['name'].split(':')[0], username=self.username)
+
+        # -- Stopping mongod
+        self._run_on_members(hosts, members,
+                             lambda host, member, mux: host.stop_service('mongod', mux=mux),
+                             lambda member: 'Cannot stop MongoDB on host {}.'.format(member['name'].split(':')[0]),
+                             lambda member: 'MongoDB has been stopped on host {}.'.format(member['name'].split(':')[0]))
+
+        # -- For every data bearing node: umount, vgchange and multipath stop
+        data_members = [member for member in members
+                        if member['stateStr'] == 'PRIMARY' or member['stateStr'] == 'SECONDARY']
+
+        self._run_on_members(hosts, data_members,
+                             lambda host, member, mux: host.umount_fs(
+                                 fs_mountpoint=member['storage_info']['mountpoint'], mux=mux),
+                             lambda member: 'Cannot unmount MongoDB file system {}.'.format(
+                                 member['storage_info']['mountpoint']),
+                             lambda member: 'MongoDB file system {} has been successfully unmounted.'.format(
+                                 member['storage_info']['mountpoint']))
+
+        self._run_on_members(hosts, data_members,
+                             lambda host, member, mux: host.disable_vg(
+                                 vg_name=member['storage_info']['lvm_vgname'], mux=mux),
+                             lambda member: 'Cannot deactive volume group {}.'.format(
+                                 member['storage_info']['lvm_vgname']),
+                             lambda member: 'MongoDB volume group {} has been successfully disabled.'.format(
+                                 member['storage_info']['lvm_vgname']))
+
+        self._run_on_members(hosts, data_members,
+                             lambda host, member, mux: host.stop_service('multipathd', mux=mux),
+                             lambda member: 'Cannot stop multipathd on host {}.'.format(
+                                 member['name'].split(':')[0]),
+                             lambda member: 'Multipathd has been successfully stopped on host {}.'.format(
+                                 member['name'].split(':')[0]))
+
+        for host in hosts.values():
+            host.close()
+
+    def _restore_and_start_members(self, members, catalog_sess):
+        svm_sessions = ClusterSessionRegistry(loader=lambda: catalog_sess.find_all(coll_name='ntapsystems', query={}))
+        svm_slots = dict()
+        volumes = list()
+        for member in members:
+            if member['stateStr'] == 'PRIMARY' or member['stateStr'] == 'SECONDARY':
+                for vol in member['storage_info']['volume_topology']:
+                    if vol['svm-name'] not in svm_slots:
+                        svm_slots[vol['svm-name']] = BoundedSemaphore(self.svm_restore_workers)
+                    volumes.append((member, vol))
+
+        state = dict()
+        state['lock'] = Lock()
+        state['failed'] = False
+        state['pending'] = dict([(member['name'], 0) for member in members])
+        state['volume_failed'] = dict([(member['name'], False) for member in members])
+        state['snaprestore_end'] = time()
+        state['post_start'] = None
+        state['post_end'] = None
+        for member, vol in volumes:
+            state['pending'][member['name']] += 1
+
+        members_by_name = dict([(member['name'], member) for member in members])
+        post_pool = TaskPool(max_workers=max(len(members), 1))
+        volume_pool = TaskPool(max_workers=max(min(len(volumes), len(svm_slots) * self.svm_restore_workers), 1))
+
+        def on_member_done(task):
+            with state['lock']:
+                state['post_end'] = time()
+                if not task.ok():
+                    state['failed'] = True
+                    logging.error('Post restore steps failed on member {}: {}'.format(task.key, task.error))
+                elif not task.result:
+                    state['failed'] = True
+                    logging.error('Post restore steps did not complete on member {}.'.format(task.key))
+
+        def start_member(member_name):
+            with state['lock']:
+                if state['volume_failed'][member_name]:
+                    logging.error('Member {} will not be started, not all of its volumes were restored.'.format(
+                        member_name))
+                    state['failed'] = True
+                    return
+                if state['post_start'] is None:
+                    state['post_start'] = time()
+            post_pool.submit(key=member_name, func=self._post_restore_member,
+                             kwargs={'member': members_by_name[member_name]}, callback=on_member_done)
+
+        def on_volume_done(task):
+            member_name, volume = task.key
+            with state['lock']:
+                state['snaprestore_end'] = time()
+                state['pending'][member_name] -= 1
+                member_ready = state['pending'][member_name] == 0
+                if not task.ok() or task.result[0] != 'passed':
+                    state['volume_failed'][member_name] = True
+                    state['failed'] = True
+                    logging.error('Failed to restore snapshot ' + self.backup_name + ' on volume ' + volume + '.')
+                    logging.error(task.result[1] if task.ok() else task.error)
                 else:
-                    logging.error('Failed to restore snapshot ' + snapspec['snapname'] + ' on volume ' + snapspec['volume'] + '.')
-                    logging.error(restore_result[1])
-
-        # -- Post restore phase for ReplicaSet Cluster
-        if bkp2restore['mongo_topology']['cluster_type'] == 'replSet':
-            for rs_member in bkp2restore['mongo_topology']['members']:
-                host = HostConn(ipaddr=rs_member['name'].split(':')[0], username=self.username)
-                # -- For every data bearing node: multipath start, vgchange, mount
-                if rs_member['stateStr'] == 'PRIMARY' or rs_member['stateStr'] == 'SECONDARY':
-                    multipath = host.start_service('multipathd')
-                    if multipath[1] != 0:
-                        logging.error('Cannot start multipathd on host {}.'.format(rs_member['name'].split(':')[0]))
-                        exit(1)
-                    else:
-                        logging.info(
-                            'Multipathd has been successfully started on host {}.'.format(rs_member['name'].split(':')[0]))
-
-                    vgchange = host.enable_vg(vg_name=rs_member['storage_info']['lvm_vgname'])
-                    if vgchange[1] != 0:
-                        logging.error('Cannot activate volume group {} on host {}.'.format(rs_member['storage_info']['lvm_vgname'], rs_member['name'].split(':')[0]))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB volume group {} has been successfully activated.'.format(
-                            rs_member['storage_info']['lvm_vgname']))
-
-                    mount_fs = host.mount_fs(fs_mountpoint=rs_member['storage_info']['mountpoint'], fs_type=rs_member['storage_info']['fs_type'], device=rs_member['storage_info']['mdb_device'])
-                    if mount_fs[1] != 0:
-                        logging.error(
-                            'Cannot mount MongoDB file system {} on host {}.'.format(rs_member['storage_info']['mountpoint'], rs_member['name'].split(':')[0]))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB file system {} has been successfully mounted on host {}.'.format(
-                            rs_member['storage_info']['mountpoint'], rs_member['name'].split(':')[0]))
-
-                # -- Starting mongod
-                start_mongo = host.start_service('mongod')
-                if start_mongo[1] != 0:
-                    logging.error('Cannot start MongoDB on host {}.'.format(rs_member['name'].split(':')[0]))
-                    exit(1)
+                    logging.info('Snapshot ' + self.backup_name + ' has been restored on volume ' + volume)
+            if member_ready:
+                start_member(member_name)
+
+        snaprestore_start = time()
+
+        # -- Members without volumes to restore (arbiters) go straight to the post restore steps
+        for member in members:
+            if state['pending'][member['name']] == 0:
+                start_member(member['name'])
+
+        for member, vol in volumes:
+            volume_pool.submit(key=(member['name'], vol['volume']), func=self._restore_volume,
+                               kwargs={'svm': svm_sessions.get(vol['svm-name']), 'slot': svm_slots[vol['svm-name']],
+                                       'volume': vol['volume']},
+                               callback=on_volume_done)
+
+        volume_pool.join()
+        post_pool.join()
+
+        timings = dict()
+        timings['failed'] = state['failed']
+        timings['snaprestore'] = state['snaprestore_end'] - snaprestore_start if len(volumes) > 0 else 0.0
+        if state['post_start'] is not None and state['post_end'] is not None:
+            timings['post_restore'] = state['post_end'] - state['post_start']
+        else:
+            timings['post_restore'] = 0.0
+        return timings
+
+    def _restore_volume(self, svm=None, slot=None, volume=None):
+        if svm is None:
+            return 'failed', 'The SVM of volume {} is not in the netapp repository collection.'.format(volume)
+        snapspec = dict()
+        snapspec['volume'] = volume
+        snapspec['snapname'] = self.backup_name
+        snapshot = Snapshot(snapspec)
+        with slot:
+            return snapshot.restore(svm)
+
+    def _post_restore_member(self, member=None):
+        hostname = member['name'].split(':')[0]
+        host = HOST_CONN_POOL.get(ipaddr=hostname, username=self.username)
+        try:
+            # -- For every data bearing node: multipath start, vgchange, mount
+            if member['stateStr'] == 'PRIMARY' or member['stateStr'] == 'SECONDARY':
+                multipath = host.start_service('multipathd')
+                if multipath[1] != 0:
+                    logging.error('Cannot start multipathd on host {}.'.format(hostname))
+                    return False
                 else:
-                    logging.info('MongoDB has been started on host {}.'.format(rs_member['name'].split(':')[0]))
-
-        # -- Post restore phase for Sharded Clusters
-        if bkp2restore['mongo_topology']['cluster_type'] == 'sharded':
-            for cs_member in bkp2restore['mongo_topology']['config_servers']:
-                host = HostConn(ipaddr=cs_member['name'].split(':')[0], username=self.username)
-                # -- For every data bearing node: multipath start, vgchange, mount
-                if cs_member['stateStr'] == 'PRIMARY' or cs_member['stateStr'] == 'SECONDARY':
-                    multipath = host.start_service('multipathd')
-                    if multipath[1] != 0:
-                        logging.error('Cannot start multipathd on host {}.'.format(cs_member['name'].split(':')[0]))
-                        exit(1)
-                    else:
-                        logging.info(
-                            'Multipathd has been successfully started on host {}.'.format(cs_member['name'].split(':')[0]))
-
-                    vgchange = host.enable_vg(vg_name=cs_member['storage_info']['lvm_vgname'])
-                    if vgchange[1] != 0:
-                        logging.error('Cannot activate volume group {} on host {}.'.format(cs_member['storage_info']['lvm_vgname'], cs_member['name'].split(':')[0]))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB volume group {} has been successfully activated.'.format(
-                            cs_member['storage_info']['lvm_vgname']))
+                    logging.info('Multipathd has been successfully started on host {}.'.format(hostname))
 
-                    mount_fs = host.mount_fs(fs_mountpoint=cs_member['storage_info']['mountpoint'], fs_type=cs_member['storage_info']['fs_type'], device=cs_member['storage_info']['mdb_device'])
-                    if mount_fs[1] != 0:
-                        logging.error(
-                            'Cannot mount MongoDB file system {} on host {}.'.format(cs_member['storage_info']['mountpoint'], cs_member['name'].split(':')[0]))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB file system {} has been successfully mounted on host {}.'.format(
-                            cs_member['storage_info']['mountpoint'], cs_member['name'].split(':')[0]))
-
-                # -- Starting mongod
-                start_mongo = host.start_service('mongod')
-                if start_mongo[1] != 0:
-                    logging.error('Cannot start MongoDB on host {}.'.format(cs_member['name'].split(':')[0]))
-                    exit(1)
+                vgchange = host.enable_vg(vg_name=member['storage_info']['lvm_vgname'])
+                if vgchange[1] != 0:
+                    logging.error('Cannot activate volume group {} on host {}.'.format(
+                        member['storage_info']['lvm_vgname'], hostname))
+                    return False
                 else:
-                    logging.info('MongoDB has been started on host {}.'.format(cs_member['name'].split(':')[0]))
-
-            for shard_replset in bkp2restore['mongo_topology']['shards']:
-                for shard_member in shard_replset['shard_members']:
-                    host = HostConn(ipaddr=shard_member['name'].split(':')[0], username=self.username)
-                    # -- For every data bearing node: multipath start, vgchange, mount
-                    if shard_member['stateStr'] == 'PRIMARY' or shard_member['stateStr'] == 'SECONDARY':
-                        multipath = host.start_service('multipathd')
-                        if multipath[1] != 0:
-                            logging.error('Cannot start multipathd on host {}.'.format(shard_member['name'].split(':')[0]))
-                            exit(1)
-                        else:
-                            logging.info(
-                                'Multipathd has been successfully started on host {}.'.format(
-                                    shard_member['name'].split(':')[0]))
-
-                        vgchange = host.enable_vg(vg_name=shard_member['storage_info']['lvm_vgname'])
-                        if vgchange[1] != 0:
-                            logging.error('Cannot activate volume group {} on host {}.'.format(
-                                shard_member['storage_info']['lvm_vgname'], shard_member['name'].split(':')[0]))
-                            exit(1)
-                        else:
-                            logging.info('MongoDB volume group {} has been successfully activated.'.format(
-                                shard_member['storage_info']['lvm_vgname']))
-
-                        mount_fs = host.mount_fs(fs_mountpoint=shard_member['storage_info']['mountpoint'],
-                                                 fs_type=shard_member['storage_info']['fs_type'],
-                                                 device=shard_member['storage_info']['mdb_device'])
-                        if mount_fs[1] != 0:
-                            logging.error(
-                                'Cannot mount MongoDB file system {} on host {}.'.format(
-                                    shard_member['storage_info']['mountpoint'], shard_member['name'].split(':')[0]))
-                            exit(1)
-                        else:
-                            logging.info('MongoDB file system {} has been successfully mounted on host {}.'.format(
-                                shard_member['storage_info']['mountpoint'], shard_member['name'].split(':')[0]))
+                    logging.info('MongoDB volume group {} has been successfully activated.'.format(
+                        member['storage_info']['lvm_vgname']))
+
+                mount_fs = host.mount_fs(fs_mountpoint=member['storage_info']['mountpoint'],
+                                         fs_type=member['storage_info']['fs_type'],
+                                         device=member['storage_info']['mdb_device'])
+                if mount_fs[1] != 0:
+                    logging.error('Cannot mount MongoDB file system {} on host {}.'.format(
+                        member['storage_info']['mountpoint'], hostname))
+                    return False
+                else:
+                    logging.info('MongoDB file system {} has been successfully mounted on host {}.'.format(
+                        member['storage_info']['mountpoint'], hostname))
 
-                    # -- Starting mongod
-                    start_mongo = host.start_service('mongod')
-                    if start_mongo[1] != 0:
-                        logging.error('Cannot start MongoDB on host {}.'.format(shard_member['name'].split(':')[0]))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB has been started on host {}.'.format(shard_member['name'].split(':')[0]))
+            # -- Starting mongod
+            start_mongo = host.start_service('mongod')
+            if start_mongo[1] != 0:
+                logging.error('Cannot start MongoDB on host {}.'.format(hostname))
+                return False
+            else:
+                logging.info('MongoDB has been started on host {}.'.format(hostname))
+        finally:
+            host.close()
 
-        # -- Housekeeping on backup's metadata
-        delete_newers = catalog_sess.remove_many(coll_name='backups', query={'created_at':
-                                                                                 { '$gt': bkp2restore['created_at']}})
-        # -- restore completed
-        logging.info('Restore operation has been completed.')
+        return True
 
 
 class SubCmdClone:
@@ -696,6 +693,7 @@ class SubCmdClone:
         self.clone_name = clone_args['clone-name']
         self.clone_spec = clone_args['clone-spec']
         self.username = clone_args['username']
+        self.clone_workers = clone_args.get('clone-workers', 8)
         self.clone_uid = time()
 
     def create_storage_clone(self, kdb_session=None):
@@ -775,7 +773,7 @@ class SubCmdClone:
 
                 config_server = spec_cs_member
 
-                host = HostConn(ipaddr=spec_cs_member['hostname'], username=self.username)
+                host = HOST_CONN_POOL.get(ipaddr=spec_cs_member['hostname'], username=self.username)
                 
                 igroup_spec = dict()
                 result_get_hostname = host.get_hostname()
@@ -861,7 +859,7 @@ class SubCmdClone:
                     
                     member = spec_sh_member
                     
-                    host = HostConn(ipaddr=spec_sh_member['hostname'], username=self.username)
+                    host = HOST_CONN_POOL.get(ipaddr=spec_sh_member['hostname'], username=self.username)
                     
                     igroup_spec = dict()
                     result_get_hostname = host.get_hostname()
@@ -928,491 +926,72 @@ class SubCmdClone:
                 cloned_cluster['shards'].append(shard_replset)
 
             # -- Stage 2 :: Executing it
-            # -- running steps to clone config servers
+            # -- The ONTAP side of the members of every SVM is provisioned by one batch (igroups, then FlexClones,
+            #    then LUN maps, each step on all members at once). Every config server and shard member is then set
+            #    up and restarted on its own as soon as its SVM batch is done. Members sharing a host still run one
+            #    after the other (pkill mongod stops every mongod on the host), and mongos are started once all
+            #    config servers and shards are up.
+            svm_sessions = ClusterSessionRegistry(loader=lambda: kdb_session['ntapsystems'].find())
+            scheduler = DependencyScheduler(max_workers=self.clone_workers)
+            storage_results = dict()
+            svm_members = dict()
+            last_on_host = dict()
+            member_keys = list()
+
+            members = list()
             for cs in cloned_cluster['config_servers']['members']:
-                # -- Preparing recover and normal mode start string
-                if self.clone_spec['defaults']['dir_per_db']:
-                    recover_mode = '/usr/bin/mongod --logpath ' + self.clone_spec['defaults']['log_path'] + \
-                                   ' --dbpath ' + cs['mountpoint'] + ' --bind_ip ' + cs['hostname'] + ' --port ' + \
-                                   cs['port'] + ' --fork --directoryperdb'
-                    normal_mode = '/usr/bin/mongod --logpath ' + self.clone_spec['defaults']['log_path'] + \
-                                  ' --dbpath ' + cs['mountpoint'] + ' --bind_ip ' + cs['hostname'] + ' --port ' + \
-                                  cs['port'] + ' --replSet ' + cloned_cluster['config_servers']['setname'] + \
-                                  ' --fork --directoryperdb --configsvr'
-                else:
-                    recover_mode = '/usr/bin/mongod --logpath ' + self.clone_spec['defaults']['log_path'] + \
-                                   ' --dbpath ' + cs['mountpoint'] + ' --bind_ip ' + cs['hostname'] + ' --port ' + \
-                                   cs['port'] + ' --fork'
-                    normal_mode = '/usr/bin/mongod --logpath ' + self.clone_spec['defaults']['log_path'] + \
-                                  ' --dbpath ' + cs['mountpoint'] + ' --bind_ip ' + cs['hostname'] + ' --port ' + \
-                                  cs['port'] + ' --replSet ' + cloned_cluster['config_servers']['setname'] + \
-                                  ' --fork --configsvr'
-
-                # -- openning a ssh connection to run host side commands
-                host = HostConn(ipaddr=cs['hostname'], username=self.username)
-
-                # -- if member is only an arbiter, there isn't any netapp action to be taken.
-                if cs['arbiter_only']:
-                    # -- removing mongod.lock and mongod.pid
-                    host.remove_file(cs['mountpoint'] + '/mongod.lock')
-                    host.remove_file('/var/run/mongodb/mongod.pid')
-
-                    result = host.run_command('/sbin/runuser -l mongod -g mongod -c "' + recover_mode + '"')
-                    if result[1] != 0:
-                        logging.error('Cannot start mongodb in recover mode on host {}.'.format(cs['hostname']))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB has been started in recover mode on host {}.'.format(cs['hostname']))
-
-                    # -- Updating ReplicaSet info
-                    mdb_uri = 'mongodb://' + cs['hostname'] + ':' + cs['port']
-                    mdb_session = MongoDBCluster(mongodb_uri=mdb_uri)
-                    mdb_session.update_doc(dbname='local', collection='system.replset',
-                                           update_filter={'_id': cloned_cluster['config_servers']['setname']},
-                                           update_doc={'$unset': {'members': ''}}
-                                           )
-                    mdb_session.update_doc(dbname='local', collection='system.replset',
-                                           update_filter={'_id': cloned_cluster['config_servers']['setname']},
-                                           update_doc={'$set': {'members': []}}
-                                           )
-                    mdb_session.update_doc(dbname='local', collection='system.replset',
-                                           update_filter={'_id': cloned_cluster['config_servers']['setname']},
-                                           update_doc={'$set': cloned_cluster['config_servers']['reconfig']}
-                                           )
-
-                    # -- Stopping MongoDB recover mode
-                    result = host.run_command('pkill mongod')
-                    if result[1] != 0:
-                        logging.error('Cannot kill mongoDB on host {}'.format(cs['hostname']))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB has been stopped on host {}.'.format(cs['hostname']))
-                        host.remove_file(cs['mountpoint'] + '/mongod.lock')
-                        host.remove_file('/var/run/mongodb/mongod.pid')
-
-                    sleep(5)
-
-                    # -- Starting MongoDB normal mode
-                    result = host.run_command('/sbin/runuser -l mongod -g mongod -c "' + normal_mode + '"')
-                    if result[1] != 0:
-                        logging.error('Cannot start mongodb in normal mode on host {}.'.format(cs['hostname']))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB has been started in normal mode on host {}.'.format(cs['hostname']))
-                        host.close()
-
-                    continue
-
-                kdb_ntapsys = kdb_session['ntapsystems']
-                ntapsys = kdb_ntapsys.find_one({'svm-name': cs['svm-name']})
-                if ntapsys is None:
-                    logging.error('Cannot find SVM {} in the netapp repository collection.'.format(cs['svm-name']))
-                    exit(1)
-
-                svm_session = ClusterSession(cluster_ip=ntapsys['netapp-ip'], user=ntapsys['username'],
-                                             password=ntapsys['password'], vserver=ntapsys['svm-name'])
-
-                result = cs['igroup'].create(svm=svm_session)
-                if result[0] == 'failed':
-                    logging.error('Failed to create initiator group {} for host {}.'.format(cs['igroup'].initiator_group_name,
-                                                                                            cs['hostname']))
-                    exit(1)
-                else:
-                    logging.info('Initiator group {} has been created for host {}.'.format(cs['igroup'].initiator_group_name,
-                                                                                           cs['hostname']))
-                    result = cs['igroup'].add_initiators(svm=svm_session, initiator_list=cs['initiator'])
-                    if result[0] == 'failed':
-                        logging.error('Failed to add initiator {} to igroup {} for host {}.'.format(cs['initiator'],
-                                                                                                    cs['igroup'].initiator_group_name,
-                                                                                                    cs['hostname']))
-                        exit(1)
-                    else:
-                        logging.info('Initiator {} has been added to {} for host {}.'.format(cs['initiator'],
-                                                                                             cs['igroup'].initiator_group_name,
-                                                                                             cs['hostname']))
-                for volclone in cs['volclone_topology']:
-                    result = volclone.create(svm=svm_session)
-                    if result[0] == 'failed':
-                        logging.error('Failed to create flexclone {} for host {}.'.format(volclone.volume,
-                                                                                          cs['hostname']))
-                        exit(1)
-                    else:
-                        logging.info('FlexClone {} has been created.'.format(volclone.volume))
-
-                for lun in cs['lun_mapping']:
-                    result = lun.mapping(svm=svm_session)
-                    if result[0] == 'failed':
-                        logging.error('Failed to map LUN {} to igroup {} for host {}.'.format(lun.path,
-                                                                                              lun.igroup_name,
-                                                                                              cs['hostname']))
-                        exit(1)
-                    else:
-                        logging.info('LUN {} has been mapped to igroup {} for host {}.'.format(lun.path,
-                                                                                               lun.igroup_name,
-                                                                                               cs['hostname']))
-
-                result = host.iscsi_send_targets(iscsi_target=cs['iscsi_target'])
-                if result[1] != 0:
-                    logging.error('{} on host {}'.format(result[0], cs['hostname']))
-                    exit(1)
-                else:
-                    logging.info('Discovering targets on {} for host {}.'.format(cs['iscsi_target'], cs['hostname']))
-
-                result = host.iscsi_node_login()
-                if result[1] != 0:
-                    logging.error('{} on host {}.'.format(result[0], cs['hostname']))
-                    exit(1)
-                else:
-                    logging.info('Logged in to {} targets and ready to rescan devices on host {}.'.format(cs['igroup'].initiator_group_type,
-                                                                                                          cs['hostname']))
-
-                result = host.iscsi_rescan()
-                if result[1] != 0:
-                    logging.error('Could not rescan {} devices on host {}.'.format(cs['igroup'].initiator_group_type,
-                                                                                   cs['hostname']))
-                    exit(1)
-                else:
-                    logging.info('{} devices have been scanned on host {}.'.format(cs['igroup'].initiator_group_type,
-                                                                                   cs['hostname']))
-
-                result = host.enable_vg(vg_name=cs['storage_info']['lvm_vgname'])
-                if result[1] != 0:
-                    logging.error('Could not enable volume group {} on host {}.'.format(cs['storage_info']['lvm_vgname'],
-                                                                                        cs['hostname']))
-                    exit(1)
-                else:
-                    logging.info('Volume Group {} has been activated on host {}.'.format(cs['storage_info']['lvm_vgname'],
-                                                                                         cs['hostname']))
-
-                result = host.mount_fs(fs_mountpoint=cs['mountpoint'], fs_type=cs['storage_info']['fs_type'],
-                                       device=cs['storage_info']['mdb_device'])
-                if result[1] != 0:
-                    logging.error('Could not mount device {} on host {}.'.format(cs['storage_info']['mdb_device'],
-                                                                                 cs['hostname']))
-                    exit(1)
-                else:
-                    logging.info('Device {} has been mounted to {} on host {}.'.format(cs['storage_info']['mdb_device'],
-                                                                                       cs['mountpoint'],
-                                                                                       cs['hostname']))
-
-                # -- Starting MongoDB on recover mode
-                result = host.run_command('/sbin/runuser -l mongod -g mongod -c "' + recover_mode + '"')
-                if result[1] != 0:
-                    logging.error('Cannot start mongodb in recover mode on host {}.'.format(cs['hostname']))
-                    exit(1)
-                else:
-                    logging.info('MongoDB has been started in recover mode on host {}.'.format(cs['hostname']))
-
-                # -- Updating ReplicaSet info
-                mdb_uri = 'mongodb://' + cs['hostname'] + ':' + cs['port']
-                mdb_session = MongoDBCluster(mongodb_uri=mdb_uri)
-                mdb_session.update_doc(dbname='local', collection='system.replset',
-                                       update_filter={'_id': cloned_cluster['config_servers']['setname']},
-                                       update_doc={'$unset': {'members': ''}}
-                                       )
-                mdb_session.update_doc(dbname='local', collection='system.replset',
-                                       update_filter={'_id': cloned_cluster['config_servers']['setname']},
-                                       update_doc={'$set': {'members': []}}
-                                       )
-                mdb_session.update_doc(dbname='local', collection='system.replset',
-                                       update_filter={'_id': cloned_cluster['config_servers']['setname']},
-                                       update_doc={'$set': cloned_cluster['config_servers']['reconfig']}
-                                       )
-
-                mdb_session.delete_doc(dbname='admin', collection='system.version',
-                                       delete_filter={'_id': 'minOpTimeRecovery'})
-
-                for spec_shard in self.clone_spec['shards']:
-                    shard_string = spec_shard['shard_name'] + '/'
-                    count = 1
-                    for spec_sh_member in spec_shard['shard_members']:
-                        if count < len(spec_shard['shard_members']):
-                            shard_string += spec_sh_member['hostname'] + ':' + spec_sh_member['port'] + ','
-                        elif count == len(spec_shard['shard_members']):
-                            shard_string += spec_sh_member['hostname'] + ':' + spec_sh_member['port']
-                        count += 1
-
-                    mdb_session.update_doc(dbname='config', collection='shards', 
-                                           update_filter={'_id': spec_shard['shard_name']},
-                                           update_doc={'$set': {'host': shard_string}})
-
-                # -- Stopping MongoDB recover mode
-                result = host.run_command('pkill mongod')
-                if result[1] != 0:
-                    logging.error('Cannot kill mongoDB on host {}'.format(cs['hostname']))
-                    exit(1)
-                else:
-                    logging.info('MongoDB has been stopped on host {}.'.format(cs['hostname']))
-                    host.remove_file(cs['mountpoint'] + '/mongod.lock')
-                    host.remove_file('/var/run/mongodb/mongod.pid')
-
-                sleep(5)
-
-                # -- Starting MongoDB normal mode
-                result = host.run_command('/sbin/runuser -l mongod -g mongod -c "' + normal_mode + '"')
-                if result[1] != 0:
-                    logging.error('Cannot start mongodb in normal mode on host {}.'.format(cs['hostname']))
-                    exit(1)
-                else:
-                    logging.info('MongoDB has been started in normal mode on host {}.'.format(cs['hostname']))
-                    host.close()
-
-            # -- running steps to clone shards
+                members.append((('config server', cs['hostname'] + ':' + cs['port']), cs,
+                                cloned_cluster['config_servers'], 'configsvr'))
             for shard in cloned_cluster['shards']:
                 for shard_member in shard['members']:
-                    # -- Preparing recover and normal mode start string
-                    if self.clone_spec['defaults']['dir_per_db']:
-                        recover_mode = '/usr/bin/mongod --logpath ' + self.clone_spec['defaults']['log_path'] + \
-                                       ' --dbpath ' + shard_member['mountpoint'] + ' --bind_ip ' + shard_member['hostname'] + ' --port ' + \
-                                       shard_member['port'] + ' --fork --directoryperdb'
-                        normal_mode = '/usr/bin/mongod --logpath ' + self.clone_spec['defaults']['log_path'] + \
-                                      ' --dbpath ' + shard_member['mountpoint'] + ' --bind_ip ' + shard_member['hostname'] + ' --port ' + \
-                                      shard_member['port'] + ' --replSet ' + shard['name'] + \
-                                      ' --fork --directoryperdb --shardsvr'
-                    else:
-                        recover_mode = '/usr/bin/mongod --logpath ' + self.clone_spec['defaults']['log_path'] + \
-                                       ' --dbpath ' + shard_member['mountpoint'] + ' --bind_ip ' + shard_member['hostname'] + ' --port ' + \
-                                       shard_member['port'] + ' --fork'
-                        normal_mode = '/usr/bin/mongod --logpath ' + self.clone_spec['defaults']['log_path'] + \
-                                      ' --dbpath ' + shard_member['mountpoint'] + ' --bind_ip ' + shard_member['hostname'] + ' --port ' + \
-                                      shard_member['port'] + ' --replSet ' + shard['name'] + ' --fork --shardsvr'
-
-                    # -- openning a ssh connection to run host side commands
-                    host = HostConn(ipaddr=shard_member['hostname'], username=self.username)
-
-                    # -- if member is only an arbiter, there isn't any netapp action to be taken.
-                    if shard_member['arbiter_only']:
-                        # -- removing mongod.lock and mongod.pid
-                        host.remove_file(shard_member['mountpoint'] + '/mongod.lock')
-                        host.remove_file('/var/run/mongodb/mongod.pid')
-
-                        result = host.run_command('/sbin/runuser -l mongod -g mongod -c "' + recover_mode + '"')
-                        if result[1] != 0:
-                            logging.error('Cannot start mongodb in recover mode on host {}.'.format(shard_member['hostname']))
-                            exit(1)
-                        else:
-                            logging.info('MongoDB has been started in recover mode on host {}.'.format(shard_member['hostname']))
-
-                        # -- Updating ReplicaSet info
-                        mdb_uri = 'mongodb://' + shard_member['hostname'] + ':' + shard_member['port']
-                        mdb_session = MongoDBCluster(mongodb_uri=mdb_uri)
-                        mdb_session.update_doc(dbname='local', collection='system.replset',
-                                               update_filter={'_id': shard['name']},
-                                               update_doc={'$unset': {'members': ''}}
-                                               )
-                        mdb_session.update_doc(dbname='local', collection='system.replset',
-                                               update_filter={'_id': shard['name']},
-                                               update_doc={'$set': { 'members': []}}
-                                               )
-                        mdb_session.update_doc(dbname='local', collection='system.replset',
-                                               update_filter={'_id': shard['name']},
-                                               update_doc={'$set': shard['reconfig']}
-                                               )
-
-                        # -- Stopping MongoDB recover mode
-                        result = host.run_command('pkill mongod')
-                        if result[1] != 0:
-                            logging.error('Cannot kill mongoDB on host {}'.format(shard_member['hostname']))
-                            exit(1)
-                        else:
-                            logging.info('MongoDB has been stopped on host {}.'.format(shard_member['hostname']))
-                            host.remove_file(shard_member['mountpoint'] + '/mongod.lock')
-                            host.remove_file('/var/run/mongodb/mongod.pid')
-
-                        sleep(5)
-
-                        # -- Starting MongoDB normal mode
-                        result = host.run_command('/sbin/runuser -l mongod -g mongod -c "' + normal_mode + '"')
-                        if result[1] != 0:
-                            logging.error('Cannot start mongodb in normal mode on host {}.'.format(shard_member['hostname']))
-                            exit(1)
-                        else:
-                            logging.info('MongoDB has been started in normal mode on host {}.'.format(shard_member['hostname']))
-                            host.close()
-
-                        continue
-
-                    kdb_ntapsys = kdb_session['ntapsystems']
-                    ntapsys = kdb_ntapsys.find_one({'svm-name': shard_member['svm-name']})
-                    if ntapsys is None:
-                        logging.error('Cannot find SVM {} in the netapp repository collection.'.format(shard_member['svm-name']))
-                        exit(1)
-
-                    svm_session = ClusterSession(cluster_ip=ntapsys['netapp-ip'], user=ntapsys['username'],
-                                                 password=ntapsys['password'], vserver=ntapsys['svm-name'])
-
-                    result = shard_member['igroup'].create(svm=svm_session)
-                    if result[0] == 'failed':
-                        logging.error(
-                            'Failed to create initiator group {} for host {}.'.format(shard_member['igroup'].initiator_group_name,
-                                                                                      shard_member['hostname']))
-                        exit(1)
-                    else:
-                        logging.info(
-                            'Initiator group {} has been created for host {}.'.format(shard_member['igroup'].initiator_group_name,
-                                                                                      shard_member['hostname']))
-                        result = shard_member['igroup'].add_initiators(svm=svm_session, initiator_list=shard_member['initiator'])
-                        if result[0] == 'failed':
-                            logging.error('Failed to add initiator {} to igroup {} for host {}.'.format(shard_member['initiator'],
-                                                                                                        shard_member[
-                                                                                                            'igroup'].initiator_group_name,
-                                                                                                        shard_member['hostname']))
-                            exit(1)
-                        else:
-                            logging.info('Initiator {} has been added to {} for host {}.'.format(shard_member['initiator'],
-                                                                                                 shard_member[
-                                                                                                     'igroup'].initiator_group_name,
-                                                                                                 shard_member['hostname']))
-                    for volclone in shard_member['volclone_topology']:
-                        result = volclone.create(svm=svm_session)
-                        if result[0] == 'failed':
-                            logging.error('Failed to create flexclone {} for host {}.'.format(volclone.volume,
-                                                                                              shard_member['hostname']))
-                            exit(1)
-                        else:
-                            logging.info('FlexClone {} has been created.'.format(volclone.volume))
-
-                    for lun in shard_member['lun_mapping']:
-                        result = lun.mapping(svm=svm_session)
-                        if result[0] == 'failed':
-                            logging.error('Failed to map LUN {} to igroup {} for host {}.'.format(lun.path,
-                                                                                                  lun.igroup_name,
-                                                                                                  shard_member['hostname']))
-                            exit(1)
-                        else:
-                            logging.info('LUN {} has been mapped to igroup {} for host {}.'.format(lun.path,
-                                                                                                   lun.igroup_name,
-                                                                                                   shard_member['hostname']))
-
-                    result = host.iscsi_send_targets(iscsi_target=shard_member['iscsi_target'])
-                    if result[1] != 0:
-                        logging.error('{} on host {}'.format(result[0], shard_member['hostname']))
-                        exit(1)
-                    else:
-                        logging.info(
-                            'Discovering targets on {} for host {}.'.format(shard_member['iscsi_target'], shard_member['hostname']))
-
-                    result = host.iscsi_node_login()
-                    if result[1] != 0:
-                        logging.error('{} on host {}.'.format(result[0], shard_member['hostname']))
-                        exit(1)
-                    else:
-                        logging.info('Logged in to {} targets and ready to rescan devices on host {}.'.format(
-                            shard_member['igroup'].initiator_group_type,
-                            shard_member['hostname']))
-
-                    result = host.iscsi_rescan()
-                    if result[1] != 0:
-                        logging.error(
-                            'Could not rescan {} devices on host {}.'.format(shard_member['igroup'].initiator_group_type,
-                                                                             shard_member['hostname']))
-                        exit(1)
-                    else:
-                        logging.info(
-                            '{} devices have been scanned on host {}.'.format(shard_member['igroup'].initiator_group_type,
-                                                                              shard_member['hostname']))
-
-                    result = host.enable_vg(vg_name=shard_member['storage_info']['lvm_vgname'])
-                    if result[1] != 0:
-                        logging.error(
-                            'Could not enable volume group {} on host {}.'.format(shard_member['storage_info']['lvm_vgname'],
-                                                                                  shard_member['hostname']))
-                        exit(1)
-                    else:
-                        logging.info(
-                            'Volume Group {} has been activated on host {}.'.format(shard_member['storage_info']['lvm_vgname'],
-                                                                                    shard_member['hostname']))
-
-                    result = host.mount_fs(fs_mountpoint=shard_member['mountpoint'], fs_type=shard_member['storage_info']['fs_type'],
-                                           device=shard_member['storage_info']['mdb_device'])
-                    if result[1] != 0:
-                        logging.error('Could not mount device {} on host {}.'.format(shard_member['storage_info']['mdb_device'],
-                                                                                     shard_member['hostname']))
-                        exit(1)
-                    else:
-                        logging.info(
-                            'Device {} has been mounted to {} on host {}.'.format(shard_member['storage_info']['mdb_device'],
-                                                                                  shard_member['mountpoint'],
-                                                                                  shard_member['hostname']))
-
-                    # -- Starting MongoDB on recover mode
-                    result = host.run_command('/sbin/runuser -l mongod -g mongod -c "' + recover_mode + '"')
-                    if result[1] != 0:
-                        logging.error('Cannot start mongodb in recover mode on host {}.'.format(shard_member['hostname']))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB has been started in recover mode on host {}.'.format(shard_member['hostname']))
-
-                    # -- Updating ReplicaSet info
-                    mdb_uri = 'mongodb://' + shard_member['hostname'] + ':' + shard_member['port']
-                    mdb_session = MongoDBCluster(mongodb_uri=mdb_uri)
-                    mdb_session.update_doc(dbname='local', collection='system.replset',
-                                           update_filter={'_id': shard['name']},
-                                           update_doc={'$unset': {'members': ''}}
-                                           )
-                    mdb_session.update_doc(dbname='local', collection='system.replset',
-                                           update_filter={'_id': shard['name']},
-                                           update_doc={'$set': {'members': []}}
-                                           )
-                    mdb_session.update_doc(dbname='local', collection='system.replset',
-                                           update_filter={'_id': shard['name']},
-                                           update_doc={'$set': shard['reconfig']}
-                                           )
-
-                    mdb_session.delete_doc(dbname='admin', collection='system.version',
-                                           delete_filter={'_id': 'minOpTimeRecovery'})
-
-                    # -- creating configsrvConnectionString
-                    conn_string = self.clone_spec['config_servers']['setname'] + '/'
-                    for spec_cs_member in self.clone_spec['config_servers']['members']:
-                        hostport = spec_cs_member['hostname'] + ':' + spec_cs_member['port']
-                        conn_string += hostport + ','
-
-                    mdb_session.update_doc(dbname='admin', collection='system.version',
-                                           update_filter={'_id': 'shardIdentity'},
-                                           update_doc={'$set': {'configsvrConnectionString': conn_string[:-1]}})
-
-                    # -- Stopping MongoDB recover mode
-                    result = host.run_command('pkill mongod')
-                    if result[1] != 0:
-                        logging.error('Cannot kill mongoDB on host {}'.format(shard_member['hostname']))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB has been stopped on host {}.'.format(shard_member['hostname']))
-                        host.remove_file(shard_member['mountpoint'] + '/mongod.lock')
-                        host.remove_file('/var/run/mongodb/mongod.pid')
-
-                    sleep(5)
-
-                    # -- Starting MongoDB normal mode
-                    result = host.run_command('/sbin/runuser -l mongod -g mongod -c "' + normal_mode + '"')
-                    if result[1] != 0:
-                        logging.error('Cannot start mongodb in normal mode on host {}.'.format(shard_member['hostname']))
-                        exit(1)
-                    else:
-                        logging.info('MongoDB has been started in normal mode on host {}.'.format(shard_member['hostname']))
-                        host.close()
-
-            # -- Starting mongoses
-            count = 1
-            configdb = self.clone_spec['config_servers']['setname'] + '/'
-            for spec_cs_member in self.clone_spec['config_servers']['members']:
-                if count < len(self.clone_spec['config_servers']['members']):
-                    configdb += spec_cs_member['hostname'] + ':' + spec_cs_member['port'] + ','
-                elif count == len(self.clone_spec['config_servers']['members']):
-                    configdb += spec_cs_member['hostname'] + ':' + spec_cs_member['port']
-                count += 1
+                    members.append(((shard['name'], shard_member['hostname'] + ':' + shard_member['port']),
+                                    shard_member, {'setname': shard['name'], 'reconfig': shard['reconfig']},
+                                    'shardsvr'))
+
+            for key, member, replset, role in members:
+                if not member['arbiter_only']:
+                    svm_members.setdefault(member['svm-name'], list()).append((key, member))
+
+            for svm_name, svm_member_list in svm_members.items():
+                scheduler.add(key=('svm', svm_name), func=self._provision_svm,
+                              kwargs={'svm_name': svm_name, 'members': svm_member_list,
+                                      'svm_sessions': svm_sessions, 'storage_results': storage_results})
+
+            for key, member, replset, role in members:
+                depends_on = list()
+                if member['hostname'] in last_on_host:
+                    depends_on.append(last_on_host[member['hostname']])
+                if not member['arbiter_only']:
+                    depends_on.append(('svm', member['svm-name']))
+                scheduler.add(key=key, func=self._clone_member,
+                              kwargs={'member': member, 'member_key': key, 'replset': replset, 'role': role,
+                                      'storage_results': storage_results},
+                              depends_on=depends_on)
+                last_on_host[member['hostname']] = key
+                member_keys.append(key)
+
+            configdb = self.clone_spec['config_servers']['setname'] + '/' + \
+                       ','.join([spec_cs_member['hostname'] + ':' + spec_cs_member['port']
+                                 for spec_cs_member in self.clone_spec['config_servers']['members']])
 
             for mongos in self.clone_spec['mongos']:
-                host = HostConn(ipaddr=mongos, username=self.username)
-                result = host.run_command('/usr/bin/mongos --bind_ip ' + mongos + ' --configdb ' + configdb +
-                                          ' --fork --logpath /var/log/mongodb/mongos.log')
-                if result[1] != 0:
-                    logging.error('Could not start mongos on host {}.'.format(mongos))
-                    exit(1)
-                else:
-                    logging.info('mongos has been started on host {}.'.format(mongos))
-                    host.close()
+                scheduler.add(key=('mongos', mongos), func=self._start_mongos,
+                              kwargs={'mongos': mongos, 'configdb': configdb}, depends_on=member_keys)
+
+            clone_start = time()
+            results = scheduler.run()
+
+            print 'Clone timing breakdown (critical path)'
+            for key, started, elapsed in scheduler.critical_path():
+                print '  {:<40}: started at {:8.2f}s, took {:8.2f}s'.format(' '.join(key), started, elapsed)
+            print '  {:<40}: {:8.2f}s'.format('Total', time() - clone_start)
+
+            failed = [key for key in scheduler.order if not results[key].ok()]
+            if len(failed) > 0:
+                for key in failed:
+                    logging.error('Clone step {} has failed: {}'.format(' '.join(key), results[key].error))
+                logging.error('Clone {} could not be created.'.format(self.clone_name))
+                exit(1)
 
             # -- Stage 3 :: Cataloging it
             clone_metadata = dict()
@@ -1476,183 +1055,218 @@ class SubCmdClone:
             else:
                 logging.info('Clone has been created successfully.')
 
-    def delete(self, kdb_session=None):
-        kdb_clones = kdb_session['clones']
-        clone2del = kdb_clones.find_one({'clone_name': self.clone_name})
-
-        if clone2del is None:
-            logging.error('Cannot find clone {}.'.format(self.clone_name))
+    def _provision_svm(self, svm_name=None, members=None, svm_sessions=None, storage_results=None):
+        svm_session = svm_sessions.get(svm_name)
+        if svm_session is None:
+            logging.error('Cannot find SVM {} in the netapp repository collection.'.format(svm_name))
             exit(1)
 
-        for mongos in clone2del['mongos']:
-            host = HostConn(ipaddr=mongos, username=self.username)
-            result = host.run_command('pkill mongos')
-            if result[1] != 0:
-                logging.error('Could not kill mongos on host {}.'.format(mongos))
-#                exit(1)
+        batch = ProvisioningBatch(svm=svm_session)
+        for key, member in members:
+            batch.add_igroup(label=key, igroup=member['igroup'], initiator=member['initiator'])
+            for volclone in member['volclone_topology']:
+                batch.add_clone(label=key, flexclone=volclone)
+            for lun in member['lun_mapping']:
+                batch.add_lun_map(label=key, lun=lun)
+
+        storage_results.update(batch.run())
+
+    def _clone_member(self, member=None, member_key=None, replset=None, role=None, storage_results=None):
+        # -- Preparing recover and normal mode start string
+        recover_mode = '/usr/bin/mongod --logpath ' + self.clone_spec['defaults']['log_path'] + \
+                       ' --dbpath ' + member['mountpoint'] + ' --bind_ip ' + member['hostname'] + ' --port ' + \
+                       member['port'] + ' --fork'
+        normal_mode = '/usr/bin/mongod --logpath ' + self.clone_spec['defaults']['log_path'] + \
+                      ' --dbpath ' + member['mountpoint'] + ' --bind_ip ' + member['hostname'] + ' --port ' + \
+                      member['port'] + ' --replSet ' + replset['setname'] + ' --fork'
+        if self.clone_spec['defaults']['dir_per_db']:
+            recover_mode += ' --directoryperdb'
+            normal_mode += ' --directoryperdb'
+        normal_mode += ' --' + role
+
+        # -- openning a ssh connection to run host side commands
+        host = HOST_CONN_POOL.get(ipaddr=member['hostname'], username=self.username)
+        try:
+            # -- if member is only an arbiter, there isn't any netapp action to be taken.
+            if member['arbiter_only']:
+                # -- removing mongod.lock and mongod.pid
+                host.remove_file(member['mountpoint'] + '/mongod.lock')
+                host.remove_file('/var/run/mongodb/mongod.pid')
             else:
-                logging.info('mongos has been stopped on host {}.'.format(mongos))
-                host.close()
+                self._provision_member_storage(host=host, member=member,
+                                               storage_result=storage_results.get(member_key))
 
-        for cs_member in clone2del['config_server']:
-            host = HostConn(ipaddr=cs_member['hostname'], username=self.username)
-            
-            if cs_member['arbiter_only']:
-                result = host.run_command('pkill mongod')
-                if result[1] != 0:
-                    logging.error('Could not kill mongod on host {}'.format(cs_member['hostname']))
-#                    exit(1)
+            # -- Starting MongoDB on recover mode
+            result = host.run_command('/sbin/runuser -l mongod -g mongod -c "' + recover_mode + '"')
+            if result[1] != 0:
+                logging.error('Cannot start mongodb in recover mode on host {}.'.format(member['hostname']))
+                exit(1)
+            else:
+                logging.info('MongoDB has been started in recover mode on host {}.'.format(member['hostname']))
+
+            # -- Updating ReplicaSet info
+            mdb_uri = 'mongodb://' + member['hostname'] + ':' + member['port']
+            mdb_session = MongoDBCluster(mongodb_uri=mdb_uri)
+            mdb_session.update_doc(dbname='local', collection='system.replset',
+                                   update_filter={'_id': replset['setname']},
+                                   update_doc={'$unset': {'members': ''}}
+                                   )
+            mdb_session.update_doc(dbname='local', collection='system.replset',
+                                   update_filter={'_id': replset['setname']},
+                                   update_doc={'$set': {'members': []}}
+                                   )
+            mdb_session.update_doc(dbname='local', collection='system.replset',
+                                   update_filter={'_id': replset['setname']},
+                                   update_doc={'$set': replset['reconfig']}
+                                   )
+
+            if not member['arbiter_only']:
+                mdb_session.delete_doc(dbname='admin', collection='system.version',
+                                       delete_filter={'_id': 'minOpTimeRecovery'})
+                if role == 'configsvr':
+                    self._rewrite_shard_hosts(mdb_session)
                 else:
-                    logging.info('mongod has been stopped on host {}.'.format(cs_member['hostname']))
-                    continue
+                    self._rewrite_shard_identity(mdb_session)
 
+            # -- Stopping MongoDB recover mode, it is restarted once the process is gone and its port is free
             result = host.run_command('pkill mongod')
             if result[1] != 0:
-                logging.error('Could not kill mongod on host {}'.format(cs_member['hostname']))
-#                exit(1)
-            else:
-                logging.info('mongod has been stopped on host {}.'.format(cs_member['hostname']))
-                sleep(3)
+                logging.error('Cannot kill mongoDB on host {}'.format(member['hostname']))
+                exit(1)
 
-            result = host.umount_fs(fs_mountpoint=cs_member['mountpoint'])
-            if result[1] != 0:
-                logging.error('Could not unmount mongoDB file system {} on host {}.'.format(cs_member['mountpoint'],
-                                                                                           cs_member['hostname']))
-#                exit(1)
+            if host.wait_process_gone(process_name='mongod')[1] != 0 or \
+                    host.wait_port_closed(port=member['port'])[1] != 0:
+                logging.error('MongoDB did not stop on host {}.'.format(member['hostname']))
+                exit(1)
             else:
-                logging.info('mongoDB file system {} has been unmounted on host {}.'.format(cs_member['mountpoint'],
-                                                                                            cs_member['hostname']))
-                sleep(3)
+                logging.info('MongoDB has been stopped on host {}.'.format(member['hostname']))
+                host.remove_file(member['mountpoint'] + '/mongod.lock')
+                host.remove_file('/var/run/mongodb/mongod.pid')
 
-            result = host.disable_vg(vg_name=cs_member['lvm_vgname'])
+            # -- Starting MongoDB normal mode
+            result = host.run_command('/sbin/runuser -l mongod -g mongod -c "' + normal_mode + '"')
             if result[1] != 0:
-                logging.error('Could not disable volume group {} on host {}.'.format(cs_member['lvm_vgname'],
-                                                                                     cs_member['hostname']))
-#                exit(1)
+                logging.error('Cannot start mongodb in normal mode on host {}.'.format(member['hostname']))
+                exit(1)
+
+            if host.wait_port_open(port=member['port'])[1] != 0:
+                logging.error('MongoDB is not accepting connections on host {}.'.format(member['hostname']))
+                exit(1)
             else:
-                logging.info('Volume Group {} has been disabled on host {}.'.format(cs_member['lvm_vgname'],
-                                                                                    cs_member['hostname']))
-
-            # -- establishing NetApp cluster session to delete flexclones
-            # -- Putting volumes offline, then delete them.
-            # -- Destroying igroups
-            kdb_ntapsys = kdb_session['ntapsystems']
-            ntapsys = kdb_ntapsys.find_one({'svm-name': cs_member['svm_name']})
-            svm_session = ClusterSession(cluster_ip=ntapsys['netapp-ip'], user=ntapsys['username'],
-                                         password=ntapsys['password'], vserver=ntapsys['svm-name'])
-
-            for vol in cs_member['volclone_topology']:
-                vol_spec = dict()
-                vol_spec['volume'] =  vol
-                volclone = Volume(vol_spec)
-                result = volclone.destroy(svm=svm_session)
-                if result[0] == 'failed':
-                    logging.error('Could not delete flexvolume {} on SVM {}.'.format(vol, cs_member['svm_name']))
-#                    exit(1)
-                else:
-                    logging.info('FlexClone volume {} has been deleted on SVM {}.'.format(vol, cs_member['svm_name']))
+                logging.info('MongoDB has been started in normal mode on host {}.'.format(member['hostname']))
+        finally:
+            host.close()
+
+    def _provision_member_storage(self, host=None, member=None, storage_result=None):
+        if storage_result is None or storage_result[0] == 'failed':
+            logging.error('Storage provisioning failed for host {}: {}'.format(
+                member['hostname'], storage_result[1] if storage_result is not None else 'no result'))
+            exit(1)
+        else:
+            logging.info('Initiator group {}, FlexClones and LUN maps are ready for host {}.'.format(
+                member['igroup'].initiator_group_name, member['hostname']))
 
-            igroup_spec = dict()
-            igroup_spec['igroup-name'] = cs_member['igroup_name']
-            igroup = InitiatorGroup(igroup_spec)
+        result = host.iscsi_send_targets(iscsi_target=member['iscsi_target'])
+        if result[1] != 0:
+            logging.error('{} on host {}'.format(result[0], member['hostname']))
+            exit(1)
+        else:
+            logging.info('Discovering targets on {} for host {}.'.format(member['iscsi_target'], member['hostname']))
 
-            result = igroup.destroy(svm=svm_session)
-            if result[0] == 'failed':
-                logging.error('Could not destroy igroup {} on SVM {}.'.format(cs_member['igroup_name'],
-                                                                              cs_member['svm_name']))
-#                exit(1)
-            else:
-                logging.info('Igroup {} has been destroyed on SVM {}.'.format(cs_member['igroup_name'],
-                                                                              cs_member['svm_name']))
+        result = host.iscsi_node_login()
+        if result[1] != 0:
+            logging.error('{} on host {}.'.format(result[0], member['hostname']))
+            exit(1)
+        else:
+            logging.info('Logged in to {} targets and ready to rescan devices on host {}.'.format(member['igroup'].initiator_group_type,
+                                                                                                  member['hostname']))
 
-            result = host.iscsi_rescan()
+        result = host.iscsi_rescan()
+        if result[1] != 0:
+            logging.error('Could not rescan {} devices on host {}.'.format(member['igroup'].initiator_group_type,
+                                                                           member['hostname']))
+            exit(1)
+        else:
+            logging.info('{} devices have been scanned on host {}.'.format(member['igroup'].initiator_group_type,
+                                                                           member['hostname']))
+
+        result = host.wait_vg_visible(vg_name=member['storage_info']['lvm_vgname'])
+        if result[1] != 0:
+            logging.error('Volume group {} did not show up on host {}.'.format(member['storage_info']['lvm_vgname'],
+                                                                               member['hostname']))
+            exit(1)
+
+        result = host.enable_vg(vg_name=member['storage_info']['lvm_vgname'])
+        if result[1] != 0:
+            logging.error('Could not enable volume group {} on host {}.'.format(member['storage_info']['lvm_vgname'],
+                                                                                member['hostname']))
+            exit(1)
+        else:
+            logging.info('Volume Group {} has been activated on host {}.'.format(member['storage_info']['lvm_vgname'],
+                                                                                 member['hostname']))
+
+        result = host.mount_fs(fs_mountpoint=member['mountpoint'], fs_type=member['storage_info']['fs_type'],
+                               device=member['storage_info']['mdb_device'])
+        if result[1] == 0:
+            result = host.wait_mounted(fs_mountpoint=member['mountpoint'])
+        if result[1] != 0:
+            logging.error('Could not mount device {} on host {}.'.format(member['storage_info']['mdb_device'],
+                                                                         member['hostname']))
+            exit(1)
+        else:
+            logging.info('Device {} has been mounted to {} on host {}.'.format(member['storage_info']['mdb_device'],
+                                                                               member['mountpoint'],
+                                                                               member['hostname']))
+
+    def _rewrite_shard_hosts(self, mdb_session):
+        # -- config servers :: shards now live on the clone's hosts
+        for spec_shard in self.clone_spec['shards']:
+            shard_string = spec_shard['shard_name'] + '/' + \
+                           ','.join([spec_sh_member['hostname'] + ':' + spec_sh_member['port']
+                                     for spec_sh_member in spec_shard['shard_members']])
+
+            mdb_session.update_doc(dbname='config', collection='shards',
+                                   update_filter={'_id': spec_shard['shard_name']},
+                                   update_doc={'$set': {'host': shard_string}})
+
+    def _rewrite_shard_identity(self, mdb_session):
+        # -- shard members :: creating configsrvConnectionString
+        conn_string = self.clone_spec['config_servers']['setname'] + '/' + \
+                      ','.join([spec_cs_member['hostname'] + ':' + spec_cs_member['port']
+                                for spec_cs_member in self.clone_spec['config_servers']['members']])
+
+        mdb_session.update_doc(dbname='admin', collection='system.version',
+                               update_filter={'_id': 'shardIdentity'},
+                               update_doc={'$set': {'configsvrConnectionString': conn_string}})
+
+    def _start_mongos(self, mongos=None, configdb=None):
+        host = HOST_CONN_POOL.get(ipaddr=mongos, username=self.username)
+        try:
+            result = host.run_command('/usr/bin/mongos --bind_ip ' + mongos + ' --configdb ' + configdb +
+                                      ' --fork --logpath /var/log/mongodb/mongos.log')
             if result[1] != 0:
-                logging.error('Could not rescan devices on host {}.'.format(cs_member['hostname']))
-#                exit(1)
+                logging.error('Could not start mongos on host {}.'.format(mongos))
+                exit(1)
             else:
-                logging.info('Stale devices has been removed on host {}.'.format(cs_member['hostname']))
-                host.close()
-
-        for shard in clone2del['shards']:
-            for sh_member in shard['members']:
-                host = HostConn(ipaddr=sh_member['hostname'], username=self.username)
-
-                if sh_member['arbiter_only']:
-                    result = host.run_command('pkill mongod')
-                    if result[1] != 0:
-                        logging.error('Could not kill mongod on host {}'.format(sh_member['hostname']))
-#                        exit(1)
-                    else:
-                        logging.info('mongod has been stopped on host {}.'.format(sh_member['hostname']))
-                        continue
+                logging.info('mongos has been started on host {}.'.format(mongos))
+        finally:
+            host.close()
 
-                result = host.run_command('pkill mongod')
-                if result[1] != 0:
-                    logging.error('Could not kill mongod on host {}'.format(sh_member['hostname']))
-#                    exit(1)
-                else:
-                    logging.info('mongod has been stopped on host {}.'.format(sh_member['hostname']))
-                    sleep(3)
-
-                result = host.umount_fs(fs_mountpoint=sh_member['mountpoint'])
-                if result[1] != 0:
-                    logging.error('Could not unmount mongoDB file system {} on host {}.'.format(sh_member['mountpoint'],
-                                                                                                sh_member['hostname']))
-#                    exit(1)
-                else:
-                    logging.info('mongoDB file system {} has been unmounted on host {}.'.format(sh_member['mountpoint'],
-                                                                                                sh_member['hostname']))
-                    sleep(3)
-
-                result = host.disable_vg(vg_name=sh_member['lvm_vgname'])
-                if result[1] != 0:
-                    logging.error('Could not disable volume group {} on host {}.'.format(sh_member['lvm_vgname'],
-                                                                                         sh_member['hostname']))
-#                    exit(1)
-                else:
-                    logging.info('Volume Group {} has been disabled on host {}.'.format(sh_member['lvm_vgname'],
-                                                                                        sh_member['hostname']))
-
-                # -- establishing NetApp cluster session to delete flexclones
-                # -- Putting volumes offline, then delete them.
-                # -- Destroying igroups
-                kdb_ntapsys = kdb_session['ntapsystems']
-                ntapsys = kdb_ntapsys.find_one({'svm-name': sh_member['svm_name']})
-                svm_session = ClusterSession(cluster_ip=ntapsys['netapp-ip'], user=ntapsys['username'],
-                                             password=ntapsys['password'], vserver=ntapsys['svm-name'])
-
-                for vol in sh_member['volclone_topology']:
-                    vol_spec = dict()
-                    vol_spec['volume'] = vol
-                    volclone = Volume(vol_spec)
-                    result = volclone.destroy(svm=svm_session)
-                    if result[0] == 'failed':
-                        logging.error('Could not delete flexvolume {} on SVM {}.'.format(vol, sh_member['svm_name']))
-#                        exit(1)
-                    else:
-                        logging.info(
-                            'FlexClone volume {} has been deleted on SVM {}.'.format(vol, sh_member['svm_name']))
+    def delete(self, kdb_session=None):
+        kdb_clones = kdb_session['clones']
+        clone2del = kdb_clones.find_one({'clone_name': self.clone_name})
 
-                igroup_spec = dict()
-                igroup_spec['igroup-name'] = sh_member['igroup_name']
-                igroup = InitiatorGroup(igroup_spec)
-
-                result = igroup.destroy(svm=svm_session)
-                if result[0] == 'failed':
-                    logging.error('Could not destroy igroup {} on SVM {}.'.format(sh_member['igroup_name'],
-                                                                                  sh_member['svm_name']))
-#                    exit(1)
-                else:
-                    logging.info('Igroup {} has been destroyed on SVM {}.'.format(sh_member['igroup_name'],
-                                                                                  sh_member['svm_name']))
+        if clone2del is None:
+            logging.error('Cannot find clone {}.'.format(self.clone_name))
+            exit(1)
 
-                result = host.iscsi_rescan()
-                if result[1] != 0:
-                    logging.error('Could not rescan devices on host {}.'.format(sh_member['hostname']))
-#                    exit(1)
-                else:
-                    logging.info('Stale devices has been removed on host {}.'.format(sh_member['hostname']))
-                    host.close()
+        svm_sessions = ClusterSessionRegistry(loader=lambda: kdb_session['ntapsystems'].find())
+        teardown = CloneTeardown(clone_doc=clone2del, clones_coll=kdb_clones, svm_sessions=svm_sessions,
+                                 username=self.username, max_workers=self.clone_workers)
+        if not teardown.run():
+            logging.error('Clone {} has not been entirely deleted, run the delete again to resume it.'.format(
+                self.clone_name))
+            exit(1)
 
         result = kdb_clones.delete_one({'clone_name': self.clone_name})
         if result is not None:
@@ -1685,55 +1299,202 @@ class SubCmdRecover:
         self.until_date = rec_spec['until-date']
         self.arch_repo_name = rec_spec['arch-repo-name']
         self.arch_repo_uri = rec_spec['arch-repo-uri']
-        self.temp_coll = 'temp_' + self.cluster_name + '_' + str(int(time()))
+        self.allow_disk_use = rec_spec.get('allow-disk-use', False)
+        self.skip_filter = None
         if 'skip_op_cfg' in rec_spec:
-            self.skip_op = rec_spec['skip_op_cfg']
+            self.skip_filter = SkipOpFilter(rec_spec['skip_op_cfg'])
 
-        if (mp.cpu_count()/2)-1 == 0:
+        if rec_spec.get('workers') is not None:
+            self.num_consumers = rec_spec['workers']
+        elif (mp.cpu_count()/2)-1 == 0:
             self.num_consumers = 1
         else:
             self.num_consumers = (mp.cpu_count()/2)-1
 
+        self.batch_size = rec_spec.get('batch-size', 1000)
+        self.read_batch_size = rec_spec.get('read-batch-size', self.batch_size)
+        self.write_concern = rec_spec.get('write-concern')
+        self.queue_depth = rec_spec.get('queue-depth', 2)
+
+        self.skip_op_cfg = rec_spec.get('skip_op_cfg')
+        self.resume = rec_spec.get('recover-id') is not None
+        if self.resume:
+            self.recover_id = rec_spec['recover-id']
+        else:
+            self.recover_id = '{}_{}'.format(self.cluster_name, datetime.now().strftime('%Y%m%d%H%M%S'))
+
+    def _run_doc(self):
+        # -- Everything needed to run this recovery again with --resume. The number of workers is part of it: it
+        #    decides which consumer, hence which checkpoint, every document belongs to.
+        run_doc = dict()
+        run_doc['type'] = 'run'
+        run_doc['status'] = 'running'
+        run_doc['started_at'] = datetime.now()
+        run_doc['spec'] = {'from-cluster-name': self.cluster_name, 'dest-mongodb-uri': self.dest_mongodb_uri,
+                           'from-date': self.from_date, 'until-date': self.until_date, 'workers': self.num_consumers,
+                           'batch-size': self.batch_size, 'write-concern': self.write_concern,
+                           'allow-disk-use': self.allow_disk_use}
+        if self.skip_op_cfg is not None:
+            # -- kept as a JSON string, extended JSON keys ($oid, ...) cannot be stored as field names
+            run_doc['spec']['skip_op_cfg'] = json_util.dumps(self.skip_op_cfg)
+        return run_doc
+
+    @staticmethod
+    def load_run(arch_repo_sess=None, recover_id=None):
+        # -- recover_spec of a previous recovery, for --resume
+        run_doc = arch_repo_sess.find_one(coll_name='recover_checkpoints', query={'_id': recover_id, 'type': 'run'})
+        if run_doc is None:
+            logging.error('Could not find recover {}.'.format(recover_id))
+            exit(1)
+        if run_doc['status'] == 'completed':
+            logging.error('Recover {} has already been completed.'.format(recover_id))
+            exit(1)
+
+        rec_spec = dict(run_doc['spec'])
+        if 'skip_op_cfg' in rec_spec:
+            rec_spec['skip_op_cfg'] = json_util.loads(rec_spec['skip_op_cfg'])
+        rec_spec['recover-id'] = recover_id
+        return rec_spec
+
+    def _load_checkpoints(self, arch_repo_sess):
+        checkpoints = dict()
+        for checkpoint in arch_repo_sess.find_all(coll_name='recover_checkpoints',
+                                                  query={'recover_id': self.recover_id}):
+            checkpoints[checkpoint['partition']] = checkpoint
+            logging.info('Partition {} resumes after {} applied operations.'.format(checkpoint['partition'],
+                                                                                   checkpoint['applied']))
+        return checkpoints
+
     def start(self):
-        # Initiate a queue and lock to be used by consumers and producers
-        recover_queue = multiprocessing.queues.JoinableQueue()
+        arch_repo_sess = Catalog(repo_uri=self.arch_repo_uri, repo_name=self.arch_repo_name)
+        arch_repo_sess.connect()
+        if self.resume:
+            checkpoints = self._load_checkpoints(arch_repo_sess)
+            arch_repo_sess.edit(coll_name='recover_checkpoints', query={'_id': self.recover_id},
+                                update={'$set': {'status': 'running', 'resumed_at': datetime.now()}})
+        else:
+            checkpoints = None
+            run_doc = self._run_doc()
+            run_doc['_id'] = self.recover_id
+            arch_repo_sess.add(coll_name='recover_checkpoints', doc=run_doc)
+        print 'Recover id: {}'.format(self.recover_id)
+
+        # Initiate one bounded queue per consumer; the reader routes every document to the consumer owning it
+        recover_queues = list()
+        for num_procs in range(self.num_consumers):
+            recover_queues.append(multiprocessing.queues.JoinableQueue(maxsize=self.queue_depth))
+        stats_queue = mp.Queue()
 
         # Recover Producer instance
         atd = ArchTempData(arch_repo_uri=self.arch_repo_uri, arch_repo_name=self.arch_repo_name,
                            source_cluster_name=self.cluster_name, begin_from=self.from_date, upto=self.until_date,
-                           temp_coll=self.temp_coll, arch_queue=recover_queue)
-
-        # Create a temporary collection containing the data that will be added back to the databases
-        atd.create_temp_data()
+                           arch_queue=recover_queues, allow_disk_use=self.allow_disk_use,
+                           skip_filter=self.skip_filter)
 
-        # Create a process to read temp data and insert in the queue
-        atd.read_temp_data()
-
-        # prepare the list of consumer instances
-        consumers = list()
-        num_procs = 0
-        while num_procs < self.num_consumers:
-            consumers.append(RecoverConsumer(arch_queue=recover_queue, dest_cluster_uri=self.dest_mongodb_uri))
-            num_procs += 1
-
-        # prepare list of consumer process instances
+        # Consumers apply batches while the reader process is still streaming the last operations
         consumer_procs = list()
-        for consumer in consumers:
-            consumer_procs.append(mp.Process(target=consumer.run))
+        for recover_queue in recover_queues:
+            consumer_procs.append(RecoverConsumer(arch_queue=recover_queue, dest_cluster_uri=self.dest_mongodb_uri,
+                                                  batch_size=self.batch_size, write_concern=self.write_concern,
+                                                  stats_queue=stats_queue,
+                                                  checkpoint={'repo_uri': self.arch_repo_uri,
+                                                              'repo_name': self.arch_repo_name,
+                                                              'recover_id': self.recover_id,
+                                                              'partition': len(consumer_procs)}))
 
-        # kicking off consumer processes
         for consumer_proc in consumer_procs:
             consumer_proc.start()
 
+        reader_proc = mp.Process(target=atd.read_last_ops, kwargs={'batch_size': self.read_batch_size,
+                                                                    'stats_queue': stats_queue,
+                                                                    'checkpoints': checkpoints})
+        reader_proc.start()
+
+        # The reader reports how it routed the operations and every consumer its applied/failed counters per
+        # collection; they are read before joining the processes so none of them blocks on a full pipe
+        recover_stats = dict()
+        routing_stats = None
+        reports = 0
+        while reports < len(consumer_procs) + 1:
+            try:
+                source, proc_stats = stats_queue.get(timeout=1)
+            except Queue.Empty:
+                if len([proc for proc in consumer_procs + [reader_proc] if proc.is_alive()]) == 0:
+                    break
+                # A process that died leaves the others blocked on its queue (the reader on a full one, the
+                # consumers waiting for the end of the stream), so the whole recovery is stopped; it can be
+                # resumed from the checkpoints saved so far
+                crashed = [proc for proc in consumer_procs + [reader_proc]
+                           if proc.exitcode is not None and proc.exitcode != 0]
+                if len(crashed) > 0:
+                    logging.error('A recover process exited with code {}, stopping the recovery.'.format(
+                        crashed[0].exitcode))
+                    for proc in consumer_procs + [reader_proc]:
+                        if proc.is_alive():
+                            proc.terminate()
+                    break
+                continue
+            reports += 1
+            if source == 'reader':
+                routing_stats = proc_stats
+                continue
+            for ns_name in proc_stats.keys():
+                if ns_name not in recover_stats:
+                    recover_stats[ns_name] = {'applied': 0, 'failed': 0}
+                recover_stats[ns_name]['applied'] += proc_stats[ns_name]['applied']
+                recover_stats[ns_name]['failed'] += proc_stats[ns_name]['failed']
+
         # Waiting processes to finish their work
+        reader_proc.join()
         for consumer_proc in consumer_procs:
             consumer_proc.join()
 
-        # Destroy temp data collection
-        atd.destroy_temp_data()
+        print '{:50} {:>12} {:>12}'.format('Namespace', 'Applied', 'Failed')
+        for ns_name in sorted(recover_stats.keys()):
+            print '{:50} {:>12} {:>12}'.format(ns_name, recover_stats[ns_name]['applied'],
+                                               recover_stats[ns_name]['failed'])
+
+        if routing_stats is not None:
+            self._print_skew(routing_stats)
+
+        failed_ops = sum([ns_stats['failed'] for ns_stats in recover_stats.values()])
+        completed = reader_proc.exitcode == 0 and reports == len(consumer_procs) + 1 and failed_ops == 0
+        arch_repo_sess.edit(coll_name='recover_checkpoints', query={'_id': self.recover_id},
+                            update={'$set': {'status': 'completed' if completed else 'failed',
+                                             'ended_at': datetime.now()}})
+        arch_repo_sess.close()
+
+        if reader_proc.exitcode != 0:
+            logging.error('Failed to read the operations to recover from the archive of cluster {}.'.format(
+                self.cluster_name))
+        if reports < len(consumer_procs) + 1:
+            logging.error('{} recover processes did not complete.'.format(len(consumer_procs) + 1 - reports))
+        if failed_ops > 0:
+            logging.error('{} operations could not be applied.'.format(failed_ops))
+        if not completed:
+            logging.error('Run kairos recover --resume {} to continue from the last checkpoints.'.format(
+                self.recover_id))
+            exit(1)
 
         logging.info('Recover process has been completed.')
 
+    @staticmethod
+    def _print_skew(routing_stats):
+        routed = routing_stats['routed']
+        total = sum(routed)
+        if total == 0:
+            return
+
+        # -- Skew is the busiest worker's share over a perfectly even share; 1.00 means balanced
+        mean = float(total) / len(routed)
+        print ''
+        print 'Operations per worker: {}  (skew {:.2f})'.format(' '.join([str(ops) for ops in routed]),
+                                                                 max(routed) / mean)
+
+        hot = sorted(routing_stats['per_namespace'].items(), key=lambda item: item[1], reverse=True)[:5]
+        print 'Hottest collections  : {}'.format(', '.join(['{} {:.1f}%'.format(ns_name, ops * 100.0 / total)
+                                                             for ns_name, ops in hot]))
+
 
 class SubCmdArchiver:
     def __init__(self, archiver_spec=None):
@@ -1772,7 +1533,14 @@ class SubCmdArchiver:
                                  collections=self.arch_spec['collections'], mongodb_uri=self.arch_spec['mongodb_uri'],
                                  archiver_name=self.arch_spec['archiver_name'],
                                  archive_repo_uri=self.arch_spec['archive_repo_uri'],
-                                 archive_repo_name=self.arch_spec['archive_repo_name'])
+                                 archive_repo_name=self.arch_spec['archive_repo_name'],
+                                 batch_size=self.arch_spec.get('batch_size', 500),
+                                 flush_interval=self.arch_spec.get('flush_interval', 1.0),
+                                 stream_mode=self.arch_spec.get('stream_mode', 'collection'),
+                                 catalog_uri=self.arch_spec['catalog_uri'],
+                                 catalog_name=self.arch_spec['catalog_name'],
+                                 workers=self.arch_spec.get('workers', 1),
+                                 bucket=self.arch_spec.get('bucket'))
 
         catalog_sess.edit(coll_name='archivers', query={'cluster_name': self.arch_spec['cluster_name'],
                                                         'archiver_name': self.arch_spec['archiver_name']},
@@ -1780,6 +1548,11 @@ class SubCmdArchiver:
 
         appKAPTR.start()
 
+    @staticmethod
+    def purge(arch_repo_sess=None, cluster_name=None, before=None):
+        layout = ArchLayout(catalog_sess=arch_repo_sess, cluster_name=cluster_name)
+        return layout.drop_buckets_before(before=before)
+
     def status(self, catalog_sess=None):
         # Getting the PID filename from Kairos' repository
         archiver = catalog_sess.find_one(coll_name='archivers',
@@ -1803,103 +1576,206 @@ class SubCmdArchiver:
             if proc.name() == 'python' and self.arch_spec['archiver_name'] in proc.cmdline():
                 return True
 
+    def workers_status(self, catalog_sess=None):
+        # -- Per worker rates, summed up from the producers' stats of the last heartbeat
+        archiver = catalog_sess.find_one(coll_name='archivers',
+                                         query={'cluster_name': self.arch_spec['cluster_name'],
+                                                'archiver_name': self.arch_spec['archiver_name']})
+        if 'heartbeat' not in archiver.keys():
+            return list()
+
+        workers = list()
+        for worker_hb in archiver['heartbeat']['workers']:
+            worker = dict()
+            worker['worker'] = worker_hb['worker']
+            worker['pid'] = worker_hb.get('pid')
+            worker['restarts'] = worker_hb.get('restarts', 0)
+            worker['producers'] = len(worker_hb['producers'])
+            worker['producers_alive'] = len([p for p in worker_hb['producers'] if p['alive']])
+            worker['throughput'] = 0.0
+            worker['ops_written'] = 0
+            worker['lag'] = None
+            for producer in worker_hb['producers']:
+                if 'stats' in producer:
+                    worker['throughput'] += producer['stats']['throughput']
+                    worker['ops_written'] += producer['stats']['ops_written']
+                    if producer['stats']['lag'] is not None:
+                        worker['lag'] = max(worker['lag'], producer['stats']['lag'])
+            workers.append(worker)
+        return workers
+
 
 class SubCmdOperations:
+    # -- Reports are answered from the per minute rollups the archiver maintains (<cluster>_opstats). Operations
+    #    archived before the rollups existed, and the partial minutes at the edges of a window, are read from the
+    #    archive itself. Archived operations may be spread over several time buckets (see ArchLayout); raw queries
+    #    run on the buckets of their window only and the partial results are combined here.
     def __init__(self, catalog_sess=None):
         self.catalog = catalog_sess
 
-    def get_first_and_last_ops_per_coll(self, cluster_name=None):
-        # Aggregation query to list the first and last operation grouped by database
-        pipeline = [
-            {'$sort': {'created_at': 1}},
-            {'$group': {'_id': {'dbname':'$ns.db', 'collname':'$ns.coll'},
-                        'firstOperation': {'$first': '$created_at'},
-                        'lastOperation': {'$last': '$created_at'}
-                        }
-            },
-            {'$sort': {'firstOperation': 1}}
-        ]
+    def _arch_collections(self, cluster_name=None, from_date=None, until_date=None):
+        layout = ArchLayout(catalog_sess=self.catalog, cluster_name=cluster_name)
+        return layout.collections_in_window(from_date=from_date, until_date=until_date)
 
-        aggr_ops = self.catalog.run_aggregation(coll_name=cluster_name, aggr_pipeline=pipeline)
-        return aggr_ops
+    def _run_on_buckets(self, cluster_name=None, pipeline=None, from_date=None, until_date=None):
+        results = list()
+        for arch_coll in self._arch_collections(cluster_name, from_date, until_date):
+            results.extend(self.catalog.run_aggregation(coll_name=arch_coll, aggr_pipeline=pipeline))
+        return results
 
-    def get_first_and_last_ops_cluster(self, cluster_name=None):
-        # Aggregation query to list the first and last operation for the whole cluster
+    @staticmethod
+    def _stats_coll(cluster_name):
+        return ArchLayout(cluster_name=cluster_name).stats_collection()
+
+    def _rollup_start(self, cluster_name=None):
+        # -- First whole minute covered by the rollups, None when there are no rollups at all
+        meta = self.catalog.find_one(coll_name=self._stats_coll(cluster_name), query={'_id': 'meta'})
+        if meta is None:
+            return None
+        start = meta['since'].replace(second=0, microsecond=0)
+        if start < meta['since']:
+            start += timedelta(minutes=1)
+        return start
+
+    @staticmethod
+    def _created_at_range(from_date=None, until_date=None, until_inclusive=True):
+        created_at = dict()
+        if from_date is not None:
+            created_at['$gte'] = from_date
+        if until_date is not None:
+            created_at['$lte' if until_inclusive else '$lt'] = until_date
+        return {'created_at': created_at}
+
+    def _raw_first_and_last(self, cluster_name=None, until_date=None):
         pipeline = [
-            {'$sort': {'created_at': 1}},
-            {'$group': {'_id': 'cluster',
-                        'firstOperation': {'$first': '$created_at'},
-                        'lastOperation': {'$last': '$created_at'}
+            {'$group': {'_id': {'dbname':'$ns.db', 'collname':'$ns.coll'},
+                        'firstOperation': {'$min': '$created_at'},
+                        'lastOperation': {'$max': '$created_at'}
                         }
-            },
-            {'$sort': {'firstOperation': 1}}
+            }
         ]
+        if until_date is not None:
+            pipeline.insert(0, {'$match': self._created_at_range(until_date=until_date, until_inclusive=False)})
 
-        aggr_ops = self.catalog.run_aggregation(coll_name=cluster_name, aggr_pipeline=pipeline)
-        return aggr_ops
+        return self._run_on_buckets(cluster_name=cluster_name, pipeline=pipeline, until_date=until_date)
 
-    def get_ops_per_type(self, cluster_name=None, from_date=None, until_date=None):
-        # Aggregation query to list operations per type/database/coll
+    def _raw_counts(self, cluster_name=None, from_date=None, until_date=None, until_inclusive=True):
         pipeline = [
-            {
-                '$match': {
-                    '$and': [
-                        {'created_at': {'$gte': from_date}},
-                        {'created_at': {'$lte': until_date}}
-                    ]
-                }
-            },
+            {'$match': self._created_at_range(from_date, until_date, until_inclusive)},
             {
                 '$group': {
                     '_id': {'dbname': '$ns.db', 'collname': '$ns.coll', 'op_type': '$operationType'},
                     'totalOps': {'$sum': 1}
                 }
-            },
-            {
-                '$project': {
-                    '_id': 0,
-                    'dbname': '$_id.dbname',
-                    'collname': '$_id.collname',
-                    'op_type': '$_id.op_type',
-                    'totalOps': 1
-                }
-            },
-            {
-                '$group': {
-                    '_id': {'dbname': '$dbname', 'collname': '$collname'},
-                    'per_type': {
-                        '$push': {'op_type': '$op_type', 'totalOps': '$totalOps'}
-                    }
-                }
-            },
-            {'$sort': {'_id': 1, 'per_type.op_type': 1}}
+            }
         ]
 
-        aggr_ops = self.catalog.run_aggregation(coll_name=cluster_name, aggr_pipeline=pipeline)
-        return aggr_ops
+        counts = dict()
+        for op in self._run_on_buckets(cluster_name=cluster_name, pipeline=pipeline, from_date=from_date,
+                                       until_date=until_date):
+            key = (op['_id']['dbname'], op['_id'].get('collname'), op['_id']['op_type'])
+            counts[key] = counts.get(key, 0) + op['totalOps']
+        return counts
 
-    def get_total_ops_per_collection(self, cluster_name=None, from_date=None, until_date=None):
-        # Aggregation query to count all operations per database/coll
+    def _rollup_counts(self, cluster_name=None, from_minute=None, until_minute=None):
         pipeline = [
-            {
-                '$match': {
-                    'created_at': {'$gte': from_date},
-                    'created_at': {'$lte': until_date}
-                }
-            },
-            {
-                '$group': {
-                    '_id': {'dbname': '$ns.db', 'collname': '$ns.coll', 'op_type': '$operationType'},
-                    'totalOps': {'$sum': 1}
-                }
-            },
-            {
-                '$group': {
-                    '_id': {'dbname':'$_id.dbname', 'collname': '$_id.collname'},
-                    'totalCollOps': { '$sum': '$totalOps'}
-                }
-            }
+            {'$match': {'_id.minute': {'$gte': from_minute, '$lt': until_minute}}},
+            {'$group': {'_id': {'dbname': '$_id.db', 'collname': '$_id.coll', 'op_type': '$_id.op'},
+                        'totalOps': {'$sum': '$count'}}}
         ]
 
-        aggr_ops = self.catalog.run_aggregation(coll_name=cluster_name, aggr_pipeline=pipeline)
+        counts = dict()
+        for op in self.catalog.run_aggregation(coll_name=self._stats_coll(cluster_name), aggr_pipeline=pipeline):
+            key = (op['_id']['dbname'], op['_id'].get('collname'), op['_id']['op_type'])
+            counts[key] = counts.get(key, 0) + op['totalOps']
+        return counts
+
+    def _counts(self, cluster_name=None, from_date=None, until_date=None):
+        # -- Operations per (db, coll, type) between from_date and until_date: whole minutes from the rollups, the
+        #    rest from the archive
+        rollup_start = self._rollup_start(cluster_name)
+        if rollup_start is None:
+            return self._raw_counts(cluster_name, from_date, until_date)
+
+        rollup_from = from_date.replace(second=0, microsecond=0)
+        if rollup_from < from_date:
+            rollup_from += timedelta(minutes=1)
+        rollup_from = max(rollup_from, rollup_start)
+        rollup_until = until_date.replace(second=0, microsecond=0)
+        if rollup_from >= rollup_until:
+            return self._raw_counts(cluster_name, from_date, until_date)
+
+        counts = dict()
+        for partial in [self._raw_counts(cluster_name, from_date, rollup_from, until_inclusive=False),
+                        self._rollup_counts(cluster_name, rollup_from, rollup_until),
+                        self._raw_counts(cluster_name, rollup_until, until_date)]:
+            for key, total_ops in partial.items():
+                counts[key] = counts.get(key, 0) + total_ops
+        return counts
+
+    def get_first_and_last_ops_per_coll(self, cluster_name=None):
+        # First and last operation per database/collection
+        rollup_start = self._rollup_start(cluster_name)
+        if rollup_start is None:
+            partials = self._raw_first_and_last(cluster_name)
+        else:
+            pipeline = [
+                {'$match': {'_id.minute': {'$gte': rollup_start}}},
+                {'$group': {'_id': {'dbname': '$_id.db', 'collname': '$_id.coll'},
+                            'firstOperation': {'$min': '$first'},
+                            'lastOperation': {'$max': '$last'}}}
+            ]
+            partials = self.catalog.run_aggregation(coll_name=self._stats_coll(cluster_name), aggr_pipeline=pipeline)
+            partials.extend(self._raw_first_and_last(cluster_name, until_date=rollup_start))
+
+        per_coll = dict()
+        for op in partials:
+            key = (op['_id']['dbname'], op['_id'].get('collname'))
+            if key not in per_coll:
+                per_coll[key] = op
+            else:
+                per_coll[key]['firstOperation'] = min(per_coll[key]['firstOperation'], op['firstOperation'])
+                per_coll[key]['lastOperation'] = max(per_coll[key]['lastOperation'], op['lastOperation'])
+
+        return sorted(per_coll.values(), key=lambda op: op['firstOperation'])
+
+    def get_first_and_last_ops_cluster(self, cluster_name=None):
+        # First and last operation for the whole cluster, read from the created_at index of each bucket
+        first_op = None
+        last_op = None
+        for arch_coll in self._arch_collections(cluster_name):
+            first = self.catalog.find_one(coll_name=arch_coll, query={}, ordered=[('created_at', 1)])
+            last = self.catalog.find_one(coll_name=arch_coll, query={}, ordered=[('created_at', -1)])
+            if first is None:
+                continue
+            if first_op is None or first['created_at'] < first_op:
+                first_op = first['created_at']
+            if last_op is None or last['created_at'] > last_op:
+                last_op = last['created_at']
+
+        if first_op is None:
+            return list()
+        return [{'_id': 'cluster', 'firstOperation': first_op, 'lastOperation': last_op}]
+
+    def get_ops_per_type(self, cluster_name=None, from_date=None, until_date=None):
+        # Operations per type/database/coll
+        per_type = dict()
+        for (dbname, collname, op_type), total_ops in self._counts(cluster_name, from_date, until_date).items():
+            per_type.setdefault((dbname, collname), dict())
+            per_type[(dbname, collname)][op_type] = total_ops
+
+        aggr_ops = list()
+        for key in sorted(per_type.keys()):
+            aggr_ops.append({'_id': {'dbname': key[0], 'collname': key[1]},
+                             'per_type': [{'op_type': op_type, 'totalOps': per_type[key][op_type]}
+                                          for op_type in sorted(per_type[key].keys())]})
         return aggr_ops
+
+    def get_total_ops_per_collection(self, cluster_name=None, from_date=None, until_date=None):
+        # All operations per database/coll
+        per_coll = dict()
+        for (dbname, collname, op_type), total_ops in self._counts(cluster_name, from_date, until_date).items():
+            per_coll[(dbname, collname)] = per_coll.get((dbname, collname), 0) + total_ops
+
+        return [{'_id': {'dbname': key[0], 'collname': key[1]}, 'totalCollOps': per_coll[key]}
+                for key in sorted(per_coll.keys())]